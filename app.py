@@ -5,22 +5,97 @@ from marshmallow.exceptions import ValidationError
 
 from init import db, ma
 from controllers.cli_controller import db_commands
+from controllers.diagnostics_controller import diagnostics_bp
+from controllers.metrics_controller import metrics_bp
 from controllers.game_masters_controller import game_masters_bp
 from controllers.players_controller import players_bp
 from controllers.campaigns_controller import campaigns_bp
 from controllers.characters_controller import characters_bp
 from controllers.player_campaigns_controller import player_campaigns_bp
 from controllers.played_games_controller import played_games_bp
+from utils.cache import init_cache
+from utils.compression import compress_response
+from utils.json_provider import json_provider_class
+from utils.metrics import init_metrics
+from utils.pool import engine_options_from_env, env_flag
+from utils.profiling import init_profiling
+from utils.slow_queries import init_slow_query_log
 
 
 def create_app():
     app = Flask(__name__)
 
     app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URI")
+    # Connection pool settings (size, overflow, recycle, pre-ping, timeouts) from DB_* variables
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options_from_env(
+        app.config["SQLALCHEMY_DATABASE_URI"])
 
+    # An optional read replica for GET requests, used while it is within REPLICA_MAX_LAG seconds
+    replica_uri = os.environ.get("REPLICA_DATABASE_URI")
+    if replica_uri:
+        app.config["SQLALCHEMY_BINDS"] = {
+            "replica": {"url": replica_uri, **engine_options_from_env(replica_uri)}}
+    app.config["REPLICA_MAX_LAG"] = float(os.environ.get("REPLICA_MAX_LAG", 5))
+    app.config["REPLICA_LAG_CHECK_INTERVAL"] = float(
+        os.environ.get("REPLICA_LAG_CHECK_INTERVAL", 1))
+
+    # Dumps flat list schemas straight from their columns (check with `flask db compare-serializers`)
+    app.config["FAST_SERIALIZER"] = env_flag("FAST_SERIALIZER", False)
+
+    # Page sizes for ?limit=, rows fetched per round trip when streaming, and the size of bulk requests
+    app.config["PAGINATION_DEFAULT_LIMIT"] = int(os.environ.get("PAGINATION_DEFAULT_LIMIT", 50))
+    app.config["PAGINATION_MAX_LIMIT"] = int(os.environ.get("PAGINATION_MAX_LIMIT", 500))
+    app.config["STREAM_BATCH_SIZE"] = int(os.environ.get("STREAM_BATCH_SIZE", 1000))
+    app.config["BULK_BATCH_SIZE"] = int(os.environ.get("BULK_BATCH_SIZE", 500))
+    app.config["BULK_MAX_ITEMS"] = int(os.environ.get("BULK_MAX_ITEMS", 10000))
+
+    # Remembers the rows each request has looked up by primary key, so they're only fetched once
+    app.config["ENTITY_LOOKUP_MEMO"] = env_flag("ENTITY_LOOKUP_MEMO", True)
+
+    # Caches single campaigns, game masters and lists for RESOURCE_CACHE_TTL seconds,
+    # in each worker ("memory") or shared by every worker ("redis", at CACHE_URL)
+    app.config["CACHE_BACKEND"] = os.environ.get("CACHE_BACKEND", "memory")
+    app.config["CACHE_URL"] = os.environ.get("CACHE_URL")
+    app.config["RESOURCE_CACHE_TTL"] = float(os.environ.get("RESOURCE_CACHE_TTL", 30))
+    app.config["RESOURCE_CACHE_SIZE"] = int(os.environ.get("RESOURCE_CACHE_SIZE", 1024))
+    app.config["CACHE_MAX_LIST_ITEMS"] = int(os.environ.get("CACHE_MAX_LIST_ITEMS", 1000))
+    init_cache(app)
+
+    # Encodes JSON with orjson when it's installed ("auto"), or always/never with "orjson"/"stdlib"
+    app.json = json_provider_class(os.environ.get("JSON_PROVIDER", "auto"))(app)
     # Returns data in the order they've been added (instead of alphabetical)
     app.json.sort_keys = False
 
+    # Times each request, counts its SQL statements and profiles a sample of them
+    app.config["PROFILING"] = env_flag("PROFILING", False)
+    app.config["PROFILE_SAMPLE_RATE"] = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+    app.config["PROFILE_SLOW_MS"] = float(os.environ.get("PROFILE_SLOW_MS", 500))
+    app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", "profiles")
+    init_profiling(app)
+
+    # Counts requests for GET /metrics, added up across the gunicorn workers sharing METRICS_DIR
+    app.config["METRICS"] = env_flag("METRICS", True)
+    app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR")
+    app.config["METRICS_FLUSH_INTERVAL"] = float(os.environ.get("METRICS_FLUSH_INTERVAL", 1))
+    init_metrics(app)
+
+    # Logs statements slower than SLOW_QUERY_MS with their EXPLAIN plan (see `flask db slowlog`)
+    app.config["SLOW_QUERY_MS"] = float(os.environ.get("SLOW_QUERY_MS", 0))
+    app.config["SLOW_QUERY_LOG_SIZE"] = int(os.environ.get("SLOW_QUERY_LOG_SIZE", 100))
+    app.config["SLOW_QUERY_DIR"] = os.environ.get("SLOW_QUERY_DIR", "slow_queries")
+    app.config["SLOW_QUERY_EXPLAIN"] = env_flag("SLOW_QUERY_EXPLAIN", True)
+    init_slow_query_log(app)
+
+    # Compresses JSON responses of at least COMPRESS_MIN_SIZE bytes with br or gzip.
+    # after_request hooks run last registered first, so this is registered after the
+    # profiling and metrics hooks, and their request times include the compression
+    app.config["COMPRESSION"] = env_flag("COMPRESSION", True)
+    app.config["COMPRESS_MIN_SIZE"] = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+    app.config["COMPRESS_LEVEL"] = int(os.environ.get("COMPRESS_LEVEL", 6))
+    app.config["COMPRESS_BROTLI_QUALITY"] = int(os.environ.get("COMPRESS_BROTLI_QUALITY", 4))
+    app.config["COMPRESS_FLUSH_SIZE"] = int(os.environ.get("COMPRESS_FLUSH_SIZE", 65536))
+    app.after_request(compress_response)
+
     # Initialises Libraries
     db.init_app(app)
     ma.init_app(app)
@@ -40,6 +115,10 @@ def create_app():
 
     # registers the controllers
     app.register_blueprint(db_commands)
+    app.register_blueprint(diagnostics_bp)
+    # GET /metrics is only there while the requests are being counted
+    if app.config["METRICS"]:
+        app.register_blueprint(metrics_bp)
     app.register_blueprint(campaigns_bp)
     app.register_blueprint(characters_bp)
     app.register_blueprint(game_masters_bp)
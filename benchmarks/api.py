@@ -0,0 +1,412 @@
+import argparse
+import json
+import logging
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from app import create_app
+from init import db
+from models.campaigns import Campaign
+from models.characters import Character
+from models.game_masters import GameMaster
+from models.played_games import PlayedGame
+from models.player_campaigns import PlayerCampaign
+from models.players import Player
+from utils.pagination import encode_cursor
+from utils.upserts import upsert_insert
+
+# API BENCHMARK SUITE
+
+# This script measures every CRUD endpoint of every resource, so a change can be
+# compared with the last release. To do this, the application:
+# - creates the tables and runs `flask db seed`, if the database is empty
+# - tops every table up to --rows rows with bulk inserts (10000 to 1000000 is typical).
+#   Rows that are already there are kept, so a second run at the same scale starts straight away
+# - sends --requests requests to each endpoint through the Flask test client (after
+#   --warmup untimed ones), with ids and pages picked by a random generator seeded with --seed
+# - reports p50, p95 and p99 latency, throughput (requests per second, one at a time),
+#   the peak memory the warmup requests allocated, and the status codes returned.
+#   Every request must succeed (2xx or 304), so an error path is never measured by mistake
+# - writes the results and the settings they were measured with as JSON (--output), and
+#   compares them with an earlier run (--compare), failing if any p95 got slower than
+#   --max-regression percent
+#
+# It runs against the database in DATABASE_URI and leaves the seeded rows there,
+# so use a database that is only for benchmarking.
+# The response cache serves repeated reads, so use --no-cache to measure the database instead.
+#
+# Run it from the project folder:
+#   python -m benchmarks.api --rows 100000 --requests 500 --output results.json
+#   python -m benchmarks.api --rows 100000 --requests 500 --compare results.json
+
+SEED_BATCH_SIZE = 10000
+
+
+# This returns a phone number the validator accepts. kind keeps numbers made for
+# different purposes apart, and run keeps them apart from earlier runs
+def phone(kind, run, number):
+    return f"+{kind}{run:09d}{number:06d}"
+
+
+# This turns a number into letters (0 is "a", 26 is "ba"), as the text fields only allow letters
+def letters(number):
+    text = ""
+    while True:
+        number, remainder = divmod(number, 26)
+        text = chr(ord("a") + remainder) + text
+        if number == 0:
+            return text
+
+
+# SEEDING
+
+# This adds rows to a table until it has the given number, in batches.
+# make_row gets the number of each new row, and rows that clash with one that's
+# already there are skipped, so a top up can always be run again.
+def top_up(model, rows, make_row):
+    existing = db.session.scalar(db.select(db.func.count()).select_from(model))
+    for start in range(existing, rows, SEED_BATCH_SIZE):
+        stop = min(rows, start + SEED_BATCH_SIZE)
+        db.session.execute(upsert_insert(model).on_conflict_do_nothing(),
+                           [make_row(number) for number in range(start, stop)])
+        db.session.commit()
+    if rows > existing:
+        print(f"  {model.__tablename__}: {existing} -> {rows} rows", file=sys.stderr)
+
+
+# This returns every id in a table
+def all_ids(column):
+    return db.session.scalars(db.select(column)).all()
+
+
+# This fills every table up to the given number of rows
+def seed_scale(rows, rng):
+    top_up(GameMaster, rows, lambda number: {
+        "first_name": "Bench", "last_name": f"Master {letters(number)}",
+        "email": f"gm{number}@bench.example", "phone": phone(9, 0, number)})
+    top_up(Player, rows, lambda number: {
+        "first_name": "Bench", "last_name": f"Player {letters(number)}",
+        "email": f"player{number}@bench.example", "phone": phone(9, 0, number)})
+
+    game_master_ids = all_ids(GameMaster.id)
+    top_up(Campaign, rows, lambda number: {
+        "name": f"Bench Campaign {letters(number)}", "genre": rng.choice(GENRES),
+        "description": "A benchmark campaign", "game_master_id": rng.choice(game_master_ids)})
+
+    player_ids = all_ids(Player.id)
+    campaign_ids = all_ids(Campaign.id)
+    top_up(Character, rows, lambda number: {
+        "name": f"Bench Character {letters(number)}", "backstory": "Made for benchmarks",
+        "skills": "Waiting", "campaign_id": rng.choice(campaign_ids),
+        "player_id": rng.choice(player_ids)})
+    top_up(PlayedGame, rows, lambda number: {
+        "synopsis": "A benchmark session", "campaign_id": rng.choice(campaign_ids)})
+    top_up(PlayerCampaign, rows, lambda number: {
+        "player_id": rng.choice(player_ids), "campaign_id": rng.choice(campaign_ids)})
+
+
+GENRES = ["Fantasy", "Horror", "Western", "Science Fiction", "Mystery"]
+
+
+# ENDPOINTS
+
+# This returns each endpoint to measure, as (name, method, make_request).
+# make_request gets the number of the request and returns its url and JSON body (or None).
+# Deletes remove rows made for them before the timing starts, and the player campaigns
+# they remove are put back afterwards, so the tables keep their size between runs.
+def build_endpoints(rng, requests, run):
+    token = letters(run)
+    ids = {model: all_ids(model.id) for model in
+           (Campaign, Character, GameMaster, PlayedGame, Player)}
+    pairs = db.session.execute(db.select(PlayerCampaign.player_id, PlayerCampaign.campaign_id)
+                               .limit(requests * 10)).all()
+
+    def pick(model):
+        return rng.choice(ids[model])
+
+    def page(model):
+        return f"?limit=50&after={encode_cursor([pick(model)])}"
+
+    doomed = {}
+    endpoints = []
+
+    def crud(path, model, create, update):
+        endpoints.append((f"GET {path}/", "GET", lambda n: (f"{path}/{page(model)}", None)))
+        endpoints.append((f"GET {path}/<id>", "GET", lambda n: (f"{path}/{pick(model)}", None)))
+        endpoints.append((f"POST {path}/", "POST", lambda n: (f"{path}/", create(n))))
+        endpoints.append((f"PATCH {path}/<id>", "PATCH",
+                          lambda n: (f"{path}/{pick(model)}", update(n))))
+        endpoints.append((f"DELETE {path}/<id>", "DELETE",
+                          lambda n: (f"{path}/{doomed[model][n]}", None)))
+
+    crud("/campaigns", Campaign,
+         lambda n: {"name": f"Bench Created {token} {letters(n)}", "genre": "Fantasy",
+                    "game_master_id": pick(GameMaster)},
+         lambda n: {"description": f"Updated {letters(n)}"})
+    crud("/characters", Character,
+         lambda n: {"name": f"Bench Created {token} {letters(n)}", "campaign_id": pick(Campaign),
+                    "player_id": pick(Player)},
+         lambda n: {"backstory": f"Updated {letters(n)}"})
+    crud("/game_masters", GameMaster,
+         lambda n: {"first_name": "Bench", "last_name": f"Created {token} {letters(n)}",
+                    "email": f"gm-{token}-{n}@bench.example", "phone": phone(1, run, n)},
+         lambda n: {"last_name": f"Updated {letters(n)}"})
+    crud("/played_games", PlayedGame,
+         lambda n: {"synopsis": "A created benchmark session", "campaign_id": pick(Campaign)},
+         lambda n: {"synopsis": f"Updated {letters(n)}"})
+    crud("/players", Player,
+         lambda n: {"first_name": "Bench", "last_name": f"Created {token} {letters(n)}",
+                    "email": f"player-{token}-{n}@bench.example", "phone": phone(1, run, n)},
+         lambda n: {"last_name": f"Updated {letters(n)}"})
+
+    # The player campaigns are found by both of their ids, and only have a PUT to update
+    def pair(n):
+        player_id, campaign_id = pairs[n % len(pairs)]
+        return f"{player_id}/{campaign_id}"
+
+    # Each POST needs a pair that isn't there yet, or it would be a 409
+    taken = set()
+
+    def free_pair():
+        while True:
+            candidate = (pick(Player), pick(Campaign))
+            if candidate not in taken and db.session.get(PlayerCampaign, candidate) is None:
+                taken.add(candidate)
+                return {"player_id": candidate[0], "campaign_id": candidate[1]}
+
+    new_pairs = [free_pair() for _ in range(requests)]
+
+    endpoints.append(("GET /player_campaigns/", "GET", lambda n: (
+        f"/player_campaigns/?limit=50&after={encode_cursor(rng.choice(pairs))}", None)))
+    endpoints.append(("GET /player_campaigns/<ids>", "GET",
+                      lambda n: (f"/player_campaigns/{pair(n)}", None)))
+    endpoints.append(("POST /player_campaigns/", "POST",
+                      lambda n: ("/player_campaigns/", new_pairs[n])))
+    # A PUT sends the whole row, with the same ids as the url
+    endpoints.append(("PUT /player_campaigns/<ids>", "PUT", lambda n: (
+        f"/player_campaigns/{pair(n)}",
+        dict(zip(("player_id", "campaign_id"), pairs[n % len(pairs)])))))
+    endpoints.append(("DELETE /player_campaigns/<ids>", "DELETE",
+                      lambda n: (f"/player_campaigns/{pair(n)}", None)))
+
+    return endpoints, doomed, pairs
+
+
+# This makes the rows the delete endpoints remove, one for each request (and warmup)
+def make_doomed_rows(doomed, count, run, rng):
+    token = letters(run)
+    game_master_ids = all_ids(GameMaster.id)
+    campaign_ids = all_ids(Campaign.id)
+    player_ids = all_ids(Player.id)
+    rows = {
+        GameMaster: lambda n: {"first_name": "Bench", "last_name": f"Doomed {token} {letters(n)}",
+                               "email": f"doomed-gm-{token}-{n}@bench.example",
+                               "phone": phone(2, run, n)},
+        Player: lambda n: {"first_name": "Bench", "last_name": f"Doomed {token} {letters(n)}",
+                           "email": f"doomed-player-{token}-{n}@bench.example",
+                           "phone": phone(2, run, n)},
+        Campaign: lambda n: {"name": f"Bench Doomed {token} {letters(n)}",
+                             "game_master_id": rng.choice(game_master_ids)},
+        Character: lambda n: {"name": f"Bench Doomed {token} {letters(n)}",
+                              "campaign_id": rng.choice(campaign_ids),
+                              "player_id": rng.choice(player_ids)},
+        PlayedGame: lambda n: {"synopsis": "A doomed session",
+                               "campaign_id": rng.choice(campaign_ids)},
+    }
+    for model, make_row in rows.items():
+        doomed[model] = db.session.scalars(
+            db.insert(model).returning(model.id),
+            [make_row(n) for n in range(count)]).all()
+    db.session.commit()
+
+
+# MEASURING
+
+# This returns the given percentiles of the timings
+def percentiles(timings, points=(50, 95, 99)):
+    if len(timings) < 2:
+        return {f"p{point}": round(timings[0], 3) for point in points}
+    cuts = statistics.quantiles(timings, n=100, method="inclusive")
+    return {f"p{point}": round(cuts[point - 1], 3) for point in points}
+
+
+# This sends one request and stops the benchmark if it failed
+def send(client, name, method, url, body):
+    response = client.open(url, method=method, json=body)
+    data = response.get_data()
+    if not (200 <= response.status_code < 300 or response.status_code == 304):
+        sys.exit(f"{name}: {method} {url} returned {response.status_code}: {data[:300]!r}")
+    return response
+
+
+# This sends the requests to one endpoint and returns its results.
+# The warmup requests run under tracemalloc, which resets for each endpoint, so the peak is
+# this endpoint's own. Tracing slows every allocation down, so the timed requests run without it
+def measure(client, name, method, make_request, requests, warmup):
+    tracemalloc.start()
+    try:
+        for n in range(warmup):
+            url, body = make_request(n)
+            send(client, name, method, url, body)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    timings = []
+    statuses = {}
+    started = time.perf_counter()
+    for n in range(warmup, warmup + requests):
+        url, body = make_request(n)
+        start = time.perf_counter()
+        response = send(client, name, method, url, body)
+        timings.append((time.perf_counter() - start) * 1000)
+        status = str(response.status_code)
+        statuses[status] = statuses.get(status, 0) + 1
+    elapsed = time.perf_counter() - started
+
+    result = {"endpoint": name, "requests": requests}
+    result.update(percentiles(timings))
+    result.update({
+        "mean": round(statistics.fmean(timings), 3),
+        "max": round(max(timings), 3),
+        "throughput": round(requests / elapsed, 1),
+        "peak_alloc_kb": round(peak / 1024, 1) if warmup else None,
+        "statuses": statuses,
+    })
+    return result
+
+
+# This returns the commit being measured, if this is a git checkout
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# This prints how each endpoint's p95 changed since the baseline, and returns the
+# endpoints that got slower than the allowed percentage
+def compare(results, baseline, max_regression):
+    before = {result["endpoint"]: result for result in baseline["results"]}
+    regressions = []
+    print(f"\n{'endpoint':<34} {'p95 before':>11} {'p95 now':>9} {'change':>8}")
+    for result in results:
+        previous = before.get(result["endpoint"])
+        if previous is None or not previous["p95"]:
+            continue
+        change = (result["p95"] - previous["p95"]) / previous["p95"] * 100
+        flag = "  SLOWER" if change > max_regression else ""
+        print(f"{result['endpoint']:<34} {previous['p95']:>11.2f} {result['p95']:>9.2f} "
+              f"{change:>+7.1f}%{flag}")
+        if flag:
+            regressions.append(result["endpoint"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the latency of every API endpoint")
+    parser.add_argument("--rows", type=int, default=10000,
+                        help="rows in each table (default 10000)")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="timed requests per endpoint (default 200)")
+    parser.add_argument("--warmup", type=int, default=20,
+                        help="untimed requests per endpoint first (default 20)")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the random ids")
+    parser.add_argument("--endpoint", nargs="+",
+                        help="only measure endpoints whose name contains one of these")
+    parser.add_argument("--no-cache", action="store_true", help="turn the response cache off")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument("--max-regression", type=float, default=20,
+                        help="p95 slowdown (percent) that fails --compare (default 20)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # Created rows need names and phone numbers no earlier run has used
+    run = random.SystemRandom().randrange(26 ** 6)
+
+    app = create_app()
+    if args.no_cache:
+        app.config["RESOURCE_CACHE_TTL"] = 0
+    # Failed requests are counted in the statuses instead of logging each traceback
+    app.logger.setLevel(logging.CRITICAL)
+    runner = app.test_cli_runner()
+    client = app.test_client()
+
+    with app.app_context():
+        print("Seeding", file=sys.stderr)
+        runner.invoke(args=["db", "create"])
+        if not db.session.scalar(db.select(db.func.count()).select_from(GameMaster)):
+            runner.invoke(args=["db", "seed"])
+        seed_scale(args.rows, rng)
+        db.session.commit()
+
+        endpoints, doomed, pairs = build_endpoints(rng, args.requests + args.warmup, run)
+        if args.endpoint:
+            endpoints = [endpoint for endpoint in endpoints
+                         if any(part in endpoint[0] for part in args.endpoint)]
+        make_doomed_rows(doomed, args.requests + args.warmup, run, rng)
+        database = db.engine.dialect.name
+
+    # The requests run outside the app context above, so each one gets its own
+    # session like it would in production, instead of sharing one with the seeding
+    results = []
+    print(f"{'endpoint':<34} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'req/s':>8} {'peak KB':>8}  statuses")
+    try:
+        for name, method, make_request in endpoints:
+            result = measure(client, name, method, make_request, args.requests, args.warmup)
+            results.append(result)
+            print(f"{name:<34} {result['p50']:>8.2f} {result['p95']:>8.2f} "
+                  f"{result['p99']:>8.2f} {result['throughput']:>8.1f} "
+                  f"{result['peak_alloc_kb'] or 0:>8.1f}  {result['statuses']}")
+    finally:
+        # The deleted player campaigns are put back, and any doomed rows left are removed
+        with app.app_context():
+            db.session.execute(upsert_insert(PlayerCampaign).on_conflict_do_nothing(),
+                               [{"player_id": player_id, "campaign_id": campaign_id}
+                                for player_id, campaign_id in pairs])
+            for model, model_ids in doomed.items():
+                db.session.execute(db.delete(model).where(model.id.in_(model_ids)))
+            db.session.commit()
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "database": database,
+        "settings": {
+            "rows": args.rows,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "seed": args.seed,
+            "cache_ttl": app.config["RESOURCE_CACHE_TTL"],
+            "json_provider": type(app.json).__name__,
+            "fast_serializer": app.config["FAST_SERIALIZER"],
+            "compression": app.config["COMPRESSION"],
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.max_regression)
+        if regressions:
+            print(f"{len(regressions)} endpoint(s) got more than {args.max_regression:g}% slower")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import statistics
+import time
+
+from app import create_app
+from init import db
+from models.campaigns import Campaign
+from models.characters import Character
+from models.game_masters import GameMaster
+from models.played_games import PlayedGame
+from models.player_campaigns import PlayerCampaign
+from models.players import Player
+
+# CASCADE DELETE BENCHMARK
+
+# This script measures how long DELETE /campaigns/<id> takes as the number of
+# child rows (characters, played games and player campaigns) grows.
+# With ON DELETE CASCADE the time should stay close to flat, because the
+# database removes the children in the same statement instead of the ORM
+# loading and deleting each one.
+#
+# It runs against the database in DATABASE_URI (the tables must already exist,
+# see `flask db create`) and removes every row it creates.
+#
+# Run it from the project folder:
+#   python -m benchmarks.delete_cascade --children 0 100 1000 10000 --repeat 3
+
+
+# This creates a campaign with the given number of each kind of child row
+def create_campaign(game_master, run, children):
+    campaign = Campaign(
+        name=f"Benchmark Campaign {run}",
+        game_master_id=game_master.id
+    )
+    db.session.add(campaign)
+    db.session.flush()
+
+    # Each child row needs its own player, so the player campaigns stay unique
+    players = db.session.scalars(
+        db.insert(Player).returning(Player.id),
+        [{
+            "first_name": "Bench",
+            "last_name": "Player",
+            "email": f"bench{run}-{i}@example.com",
+            "phone": f"b{run}-{i}"
+        } for i in range(children)]
+    ).all() if children else []
+
+    if children:
+        db.session.execute(db.insert(PlayedGame), [
+            {"campaign_id": campaign.id, "synopsis": "Benchmark session"}
+            for _ in range(children)
+        ])
+        db.session.execute(db.insert(Character), [
+            {"campaign_id": campaign.id, "player_id": player_id, "name": f"Character {i}"}
+            for i, player_id in enumerate(players)
+        ])
+        db.session.execute(db.insert(PlayerCampaign), [
+            {"campaign_id": campaign.id, "player_id": player_id}
+            for player_id in players
+        ])
+    db.session.commit()
+    return campaign.id, players
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure campaign delete latency against child row count")
+    parser.add_argument("--children", type=int, nargs="+",
+                        default=[0, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    app = create_app()
+    client = app.test_client()
+
+    with app.app_context():
+        game_master = GameMaster(
+            first_name="Bench", last_name="Master",
+            email="benchmaster@example.com", phone="bench-gm")
+        db.session.add(game_master)
+        db.session.commit()
+
+        print(f"{'children':>10} {'median ms':>10} {'min ms':>10} {'max ms':>10}")
+        run = 0
+        try:
+            for children in args.children:
+                timings = []
+                for _ in range(args.repeat):
+                    run += 1
+                    campaign_id, players = create_campaign(game_master, run, children)
+
+                    start = time.perf_counter()
+                    response = client.delete(f"/campaigns/{campaign_id}")
+                    timings.append((time.perf_counter() - start) * 1000)
+                    assert response.status_code == 200, response.get_json()
+
+                    # The players aren't children of the campaign, so they're removed separately
+                    if players:
+                        db.session.execute(db.delete(Player).where(Player.id.in_(players)))
+                        db.session.commit()
+
+                print(f"{children:>10} {statistics.median(timings):>10.2f} "
+                      f"{min(timings):>10.2f} {max(timings):>10.2f}")
+        finally:
+            db.session.rollback()
+            db.session.execute(db.delete(GameMaster).where(
+                GameMaster.id == game_master.id))
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import time
+
+from marshmallow import ValidationError
+
+from models.campaigns import campaign_schema
+from models.characters import character_schema
+from models.game_masters import game_master_schema
+from models.played_games import played_game_schema
+from models.players import player_schema
+
+# SCHEMA LOAD BENCHMARK
+
+# This script measures how many request bodies each schema can load (deserialise
+# and validate) per second, which is the validation part of a POST or PUT.
+# It doesn't need a database or the app, only the schemas.
+#
+# Run it from the project folder:
+#   python -m benchmarks.schema_load --loads 20000 --repeat 3
+
+# A typical request body for each schema
+SAMPLES = {
+    "campaign": (campaign_schema, {
+        "name": "The Lost Mines", "genre": "Fantasy", "description": "A classic adventure"}),
+    "character": (character_schema, {
+        "name": "Aria Stormwind", "backstory": "Raised by wolves", "skills": "Archery & Stealth"}),
+    "game_master": (game_master_schema, {
+        "first_name": "Mary", "last_name": "O'Neil", "email": "mary@example.com", "phone": "0400 000 005"}),
+    "played_game": (played_game_schema, {
+        "synopsis": "The party reached the mines and met the goblin king"}),
+    "player": (player_schema, {
+        "first_name": "Sam", "last_name": "Lee-Smith", "email": "sam@example.com", "phone": "0400 000 006"}),
+}
+
+
+# This loads the body the given number of times and returns how long it took, in seconds
+def time_loads(schema, body, loads):
+    start = time.perf_counter()
+    for _ in range(loads):
+        try:
+            schema.load(body)
+        except ValidationError:
+            pass
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure schema load throughput")
+    parser.add_argument("--loads", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--schema", choices=sorted(SAMPLES), nargs="+", default=sorted(SAMPLES))
+    args = parser.parse_args()
+
+    print(f"{'schema':>12} {'loads/s':>10} {'us/load':>10}")
+    for name in args.schema:
+        schema, body = SAMPLES[name]
+        # The best of the runs is the least disturbed by anything else on the machine
+        best = min(time_loads(schema, body, args.loads) for _ in range(args.repeat))
+        print(f"{name:>12} {args.loads / best:>10.0f} {best / args.loads * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
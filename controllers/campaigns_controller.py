@@ -1,13 +1,53 @@
 from flask import Blueprint, request
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, with_parent
+from sqlalchemy.orm.exc import StaleDataError
 from psycopg2 import errorcodes
 
 from init import db
 from models.campaigns import Campaign, campaigns_schema, campaign_schema
+from models.characters import Character, characters_schema
+from models.played_games import PlayedGame, played_games_schema
+from models.player_campaigns import PlayerCampaign
+from models.players import Player, players_schema
+from utils.bulk import bulk_delete, bulk_update
+from utils.cache import cached_entity
+from utils.etags import collection_etag, is_not_modified, is_precondition_failed, not_modified, row_etag, with_etag
+from utils.filtering import SortOrder, apply_filters, get_expand, get_sort_order
+from utils.listing import list_response
+from utils.lookups import get_entity
+from utils.serializing import timed_dump
+from utils.updates import can_update_directly, changed_values, update_returning
 
 # This blueprint builds a prefix for the routing to enable shorter code blocks for the Campaign Controller.
 campaigns_bp = Blueprint("campaigns", __name__, url_prefix="/campaigns")
 
+# These columns can be used to filter the list, bulk update and bulk delete routes
+CAMPAIGNS_FILTERS = {
+    "game_master_id": Campaign.game_master_id,
+    "genre": Campaign.genre,
+}
+
+# These columns can be used to sort the list routes with ?sort=<column> or ?sort=-<column>
+CAMPAIGNS_SORTS = {
+    "id": Campaign.id,
+    "name": Campaign.name,
+}
+
+# These related rows can be added to a single campaign with ?expand=<name>,<name>
+# selectinload fetches each kind in one extra query, instead of one query per row
+CAMPAIGN_EXPANDS = {
+    "characters": selectinload(Campaign.characters),
+    "played_games": selectinload(Campaign.played_games),
+    "players": selectinload(Campaign.players).selectinload(PlayerCampaign.player),
+}
+# The tables each expand reads, for the ETag of an expanded campaign
+CAMPAIGN_EXPAND_TABLES = {
+    "characters": ["characters"],
+    "played_games": ["played_games"],
+    "players": ["player_campaigns", "players"],
+}
+
 # CREATE A CAMPAIGN
 
 # This function creates a new campaign
@@ -39,7 +79,7 @@ def create_campaign():
         db.session.commit()
 
         # This returns the new campaign
-        return campaign_schema.dump(new_campaign), 201
+        return timed_dump(campaign_schema, new_campaign), 201
     # This checks for conflicts between requests and conditions ie unique, null (409)
     except IntegrityError as err:
         # This checks for breaches of NON-NULL
@@ -66,12 +106,13 @@ def create_campaign():
 def get_campaigns():
     # This statement selects all inputs from the Campaign table using the Campaign Class
     stmt = db.select(Campaign)
-    # This retrieves the results as a list. Scalars will provide multiple results.
-    campaigns_list = db.session.scalars(stmt)
-    # This converts the list into a JSON format using .dump
-    data = campaigns_schema.dump(campaigns_list)
-    # This returns the list
-    return data
+    # This adds any filters from the query string (?<column>=<value>) as a WHERE clause
+    stmt = apply_filters(stmt, CAMPAIGNS_FILTERS)
+    # This reads ?sort= and works out the order of the list
+    order = get_sort_order(CAMPAIGNS_SORTS, [Campaign.id])
+    # This returns the list as a stream (?stream=1), a single page (?limit= or ?after=)
+    # or the whole list, converted into JSON with .dump
+    return list_response(stmt, order, campaigns_schema)
 
 # READ A SELECT CAMPAIGN
 
@@ -81,29 +122,100 @@ def get_campaigns():
 # - selects the entity via it's id and filtering it with filter.by
 # - Retrieves the result
 # - if correct, converts to json and returns it
+# - keeps the json in the resource cache, so the next request skips the database
+# - adds any related rows asked for with ?expand=
 # - else returns an error message
 
 
 # This defines the route for a GET request. It is shortened by the above blueprint.
 @campaigns_bp.route("/<int:campaign_id>")
 def get_campaign(campaign_id):
-    # This statement selects the campaign based on the id and filters it using filter.by
-    stmt = db.select(Campaign).filter_by(id=campaign_id)
-    # This retrieves the result. Scalar means it retrieves a single result.
-    campaign = db.session.scalar(stmt)
+    # This reads ?expand= to see which related rows to load alongside the campaign
+    expand = get_expand(CAMPAIGN_EXPANDS)
+    if not expand:
+        # This finds the campaign's data and ETag. Campaigns rarely change, so they come
+        # from the resource cache when it has them, and from the database (then cached) when not.
+        cached = cached_entity(Campaign, campaign_id, campaign_schema, row_etag)
+        if not cached:
+            return {"message": f"Campaign with id {campaign_id} does not exist"}, 404
+        data, etag = cached
+        # if the client's copy is still current (If-None-Match), return 304
+        if is_not_modified(etag):
+            return not_modified(etag)
+        return with_etag(data, etag)
+
+    # This finds the campaign and eager loads the related rows in a fixed number of queries
+    campaign = db.session.get(
+        Campaign, campaign_id, options=[CAMPAIGN_EXPANDS[name] for name in expand])
     # Check if the campaign matching the idea was found
     if campaign:
-        # if so, convert into a json using .dump
-        data = campaign_schema.dump(campaign)
-        # return the data
-        return data
+        # if the client's copy is still current (If-None-Match), skip the dump and return 304.
+        # Expanded responses also change with the related tables, so they use their change counters.
+        etag = collection_etag(
+            ["campaigns"] + [table for name in expand for table in CAMPAIGN_EXPAND_TABLES[name]])
+        if is_not_modified(etag):
+            return not_modified(etag)
+        # if not, convert into a json using .dump
+        data = timed_dump(campaign_schema, campaign)
+        # add the related rows that were asked for
+        if "characters" in expand:
+            data["characters"] = timed_dump(characters_schema, campaign.characters)
+        if "played_games" in expand:
+            data["played_games"] = timed_dump(played_games_schema, campaign.played_games)
+        if "players" in expand:
+            players = [player_campaign.player for player_campaign in campaign.players]
+            data["players"] = timed_dump(players_schema, players)
+        # return the data along with its ETag
+        return with_etag(data, etag)
     else:
         # else return a 404 error message with the id
         return {"message": f"Campaign with id {campaign_id} does not exist"}, 404
 
+# READ A CAMPAIGN'S CHARACTERS, PLAYED GAMES AND PLAYERS
+
+# These functions return the rows related to one campaign, so clients don't have to
+# download every list and join them themselves.
+# To do this, the application:
+# - finds the campaign, returning a 404 if it doesn't exist
+# - selects the related rows through the campaign's relationships (with_parent)
+# - returns them like the other lists (?stream=1, ?limit= and ?after= all work)
+
+
+# This defines the route for the campaign's characters. It is shortened by the above blueprint.
+@campaigns_bp.route("/<int:campaign_id>/characters")
+def get_campaign_characters(campaign_id):
+    campaign = get_entity(Campaign, campaign_id)
+    if not campaign:
+        return {"message": f"Campaign with id {campaign_id} does not exist"}, 404
+    stmt = db.select(Character).where(with_parent(campaign, Campaign.characters))
+    return list_response(stmt, SortOrder([Character.id]), characters_schema)
+
+
+# This defines the route for the campaign's played games. It is shortened by the above blueprint.
+@campaigns_bp.route("/<int:campaign_id>/played_games")
+def get_campaign_played_games(campaign_id):
+    campaign = get_entity(Campaign, campaign_id)
+    if not campaign:
+        return {"message": f"Campaign with id {campaign_id} does not exist"}, 404
+    stmt = db.select(PlayedGame).where(with_parent(campaign, Campaign.played_games))
+    return list_response(stmt, SortOrder([PlayedGame.id]), played_games_schema)
+
+
+# This defines the route for the campaign's players. It is shortened by the above blueprint.
+@campaigns_bp.route("/<int:campaign_id>/players")
+def get_campaign_players(campaign_id):
+    campaign = get_entity(Campaign, campaign_id)
+    if not campaign:
+        return {"message": f"Campaign with id {campaign_id} does not exist"}, 404
+    # Players are linked to campaigns through the player_campaigns table
+    stmt = db.select(Player).join(Player.campaigns).where(
+        with_parent(campaign, Campaign.players))
+    return list_response(stmt, SortOrder([Player.id]), players_schema)
+
 # UPDATE A CAMPAIGN
 # This function finds an object with the matching id and replaces the contents with the new data
 # To do this, this application:
+# - A PATCH without If-Match skips the lookup and runs one UPDATE ... RETURNING
 # - Finds the campaign (select), with the campaign id (filter by) and loads it (.load)
 # - If it exists, overwrite the data with the new request
 # - Commits and returns the data
@@ -115,15 +227,29 @@ def get_campaign(campaign_id):
 @campaigns_bp.route("/<int:campaign_id>", methods=["PUT", "PATCH"])
 def update_campaign(campaign_id):
     try:
-        # This finds the campaign to be updated
-        stmt = db.select(Campaign).filter_by(id=campaign_id)
-        campaign = db.session.scalar(stmt)
-
         # This loads the data from the request
         body_data = campaign_schema.load(request.get_json(), partial=True)
 
+        # A PATCH without If-Match is a single UPDATE ... RETURNING, with no lookup first
+        values = changed_values(Campaign, body_data)
+        if can_update_directly(values):
+            campaign = update_returning(Campaign, campaign_id, values)
+            if campaign:
+                # Dump before committing so the row doesn't need to be reloaded afterwards
+                data, etag = timed_dump(campaign_schema, campaign), row_etag(campaign)
+                db.session.commit()
+                return with_etag(data, etag)
+            return {"message": f"Campaign with id {campaign_id} doesn't exist"}, 404
+
+        # This finds the campaign to be updated
+        campaign = get_entity(Campaign, campaign_id)
+
         # If the campaign exists
         if campaign:
+            # If the client sent If-Match, it must be the version they are changing
+            if is_precondition_failed(campaign):
+                return {"message": f"Campaign with id {campaign_id} has changed since it was last read"}, 412
+
             # Update the campaign data using the data from the request body
             campaign.name = body_data.get("name") or campaign.name
             campaign.genre = body_data.get("genre") or campaign.genre
@@ -132,17 +258,23 @@ def update_campaign(campaign_id):
             campaign.game_master_id = body_data.get(
                 "game_master_id") or campaign.game_master_id
 
-            # Commit the changes
+            # Flush so version_id is bumped, then dump before committing so the row
+            # doesn't need to be reloaded afterwards
+            db.session.flush()
+            data, etag = timed_dump(campaign_schema, campaign), row_etag(campaign)
             db.session.commit()
-
-            # Return the data
-            return campaign_schema.dump(campaign)
+            return with_etag(data, etag)
 
         # If the campaign doesn't exist
         else:
             # Return a 404 error message with the id
             return {"message": f"Campaign with id {campaign_id} doesn't exist"}, 404
 
+    except StaleDataError:
+        # Another request updated the row between the lookup and the commit
+        db.session.rollback()
+        return {"message": f"Campaign with id {campaign_id} has changed since it was last read"}, 412
+
     except IntegrityError as err:
         # This checks for breaches of NON-NULL
         if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
@@ -163,10 +295,9 @@ def update_campaign(campaign_id):
 # This defines the route for the DELETE request. It is shortened by the above blueprint.
 @campaigns_bp.route("/<int:campaign_id>", methods=["DELETE"])
 def delete_campaign(campaign_id):
-    # This statement selects the campaign based on the id and filters it using filter.by
-    stmt = db.select(Campaign).filter_by(id=campaign_id)
-    # This retrieves the result. Scalar means it retrieves a single result.
-    campaign = db.session.scalar(stmt)
+    # This finds the campaign by its id. Rows already loaded in this request
+    # come from the session's identity map instead of a new SELECT.
+    campaign = get_entity(Campaign, campaign_id)
     # if it exists:
     if campaign:
         # delete the campaign
@@ -179,3 +310,52 @@ def delete_campaign(campaign_id):
     else:
         # return a 404 error message with the id
         return {"message": f"Campaign with id {campaign_id} does not exist"}, 404
+
+
+# UPDATE CAMPAIGNS IN BULK
+# This function updates many campaigns with a single UPDATE statement
+# To do this, the application:
+# - Picks the campaigns by a list of ids or by a filter
+# - Loads the new values with the schema (partial=True)
+# - Runs one UPDATE ... RETURNING and commits
+# - Integrity checks for Non Nullable, Unique and Foreign Key constraints
+
+
+# This defines the route for the bulk UPDATE request. It is shortened by the above blueprint.
+@campaigns_bp.route("/bulk", methods=["PATCH"])
+def update_campaigns_bulk():
+    try:
+        # This updates every selected row and returns the updated rows
+        return bulk_update(Campaign, campaigns_schema, CAMPAIGNS_FILTERS)
+
+    except IntegrityError as err:
+        # This checks for breaches of NON-NULL
+        if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
+            return {"message": f"{err.orig.diag.column_name} is required"}, 409
+        # This checks for breaches of UNIQUE
+        if err.orig.pgcode == errorcodes.UNIQUE_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
+
+
+# DELETE CAMPAIGNS IN BULK
+# This function deletes many campaigns with a single DELETE statement
+# To do so, the application:
+# - Picks the campaigns by a list of ids or by a filter
+# - Runs one DELETE ... RETURNING and commits
+# - Returns what was deleted
+
+
+# This defines the route for the bulk DELETE request. It is shortened by the above blueprint.
+@campaigns_bp.route("/bulk", methods=["DELETE"])
+def delete_campaigns_bulk():
+    try:
+        # This deletes every selected row
+        return bulk_delete(Campaign, campaigns_schema, CAMPAIGNS_FILTERS)
+
+    except IntegrityError as err:
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
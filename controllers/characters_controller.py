@@ -1,13 +1,33 @@
 from flask import Blueprint, request
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 from psycopg2 import errorcodes
 
 from init import db
 from models.characters import Character, characters_schema, character_schema
+from utils.bulk import bulk_create, bulk_delete, bulk_update
+from utils.etags import is_not_modified, is_precondition_failed, not_modified, row_etag, with_etag
+from utils.filtering import apply_filters, get_sort_order
+from utils.listing import list_response
+from utils.lookups import get_entity
+from utils.serializing import timed_dump
+from utils.updates import can_update_directly, changed_values, update_returning
 
 # This blueprint builds a prefix for the routing to enable shorter code blocks for the Character Controller.
 characters_bp = Blueprint("characters", __name__, url_prefix="/characters")
 
+# These columns can be used to filter the list, bulk update and bulk delete routes
+CHARACTERS_FILTERS = {
+    "campaign_id": Character.campaign_id,
+    "player_id": Character.player_id,
+}
+
+# These columns can be used to sort the list routes with ?sort=<column> or ?sort=-<column>
+CHARACTERS_SORTS = {
+    "id": Character.id,
+    "name": Character.name,
+}
+
 # CREATE A CHARACTER
 
 # This function creates a new entry
@@ -24,7 +44,7 @@ def create_character():
 
     try:
         # This loads in the character schema
-        body_data = character_schema().load(request.get_json())
+        body_data = character_schema.load(request.get_json())
 
         # This creates a new object with the required criteria
         new_character = Character(
@@ -40,7 +60,7 @@ def create_character():
         db.session.commit()
 
         # This returns the new entry
-        return character_schema().dump(new_character), 201
+        return timed_dump(character_schema, new_character), 201
     # This checks for conflicts between requests and conditions ie unique, null (409)
     except IntegrityError as err:
         # This checks for breaches of NON-NULL
@@ -50,6 +70,22 @@ def create_character():
         if err.orig.pgcode == errorcodes.UNIQUE_VIOLATION:
             return {"message": "Character name must be unique within the campaign"}, 409
 
+# CREATE CHARACTERS IN BULK
+
+# This function creates many characters in a single request and transaction
+# To do this, the application:
+# - Loads the list of characters with the schema (many=True)
+# - Inserts them with multi-row INSERT ... RETURNING statements
+# - Commits once and returns the new characters
+# - Reports each conflict against the position of the item that caused it, and creates nothing
+
+
+# This defines the route for the request. It is shortened by the above blueprint.
+@characters_bp.route("/bulk", methods=["POST"])
+def create_characters_bulk():
+    # This validates and inserts every character in the request body
+    return bulk_create(Character, characters_schema)
+
 # READ ALL CHARACTERS
 
 # This function finds the requested list using an SQL Query and returns it in JSON.
@@ -67,12 +103,13 @@ def create_character():
 def get_characters():
     # This statement selects all inputs from the Character table using the Character Class
     stmt = db.select(Character)
-    # This retrieves the results as a list. Scalars will provide multiple results.
-    characters_list = db.session.scalars(stmt)
-    # This converts the list into a JSON format using .dump
-    data = characters_schema.dump(characters_list)
-    # This returns the list
-    return data
+    # This adds any filters from the query string (?<column>=<value>) as a WHERE clause
+    stmt = apply_filters(stmt, CHARACTERS_FILTERS)
+    # This reads ?sort= and works out the order of the list
+    order = get_sort_order(CHARACTERS_SORTS, [Character.id])
+    # This returns the list as a stream (?stream=1), a single page (?limit= or ?after=)
+    # or the whole list, converted into JSON with .dump
+    return list_response(stmt, order, characters_schema)
 
 # READ A SELECT CHARACTER
 
@@ -88,16 +125,19 @@ def get_characters():
 # This defines the route for a GET request. It is shortened by the above blueprint.
 @characters_bp.route("/<int:character_id>")
 def get_character(character_id):
-    # This statement selects the entity based on the id and filters it using filter.by
-    stmt = db.select(Character).filter_by(id=character_id)
-    # This retrieves the result. Scalar means it retrieves a single result.
-    character = db.session.scalar(stmt)
+    # This finds the character by its id. Rows already loaded in this request
+    # come from the session's identity map instead of a new SELECT.
+    character = get_entity(Character, character_id)
     # Check if the character matching the idea was found
     if character:
-        # if so, convert into a json using .dump
-        data = character_schema.dump(character)
-        # return the data
-        return data
+        # if the client's copy is still current (If-None-Match), skip the dump and return 304
+        etag = row_etag(character)
+        if is_not_modified(etag):
+            return not_modified(etag)
+        # if not, convert into a json using .dump
+        data = timed_dump(character_schema, character)
+        # return the data along with its ETag
+        return with_etag(data, etag)
     else:
         # else return a 404 error message with the id
         return {"message": f"Character with id {character_id} does not exist"}, 404
@@ -105,6 +145,7 @@ def get_character(character_id):
 # UPDATE A CHARACTER
 # This function finds an object with the matching id and replaces the contents with the new data
 # To do this, this application:
+# - A PATCH without If-Match skips the lookup and runs one UPDATE ... RETURNING
 # - Finds the character (select), with the character id (filter by) and loads it (.load)
 # - If it exists, overwrite the data with the new request
 # - Commits and returns the data
@@ -115,15 +156,29 @@ def get_character(character_id):
 @characters_bp.route("/<int:character_id>", methods=["PUT", "PATCH"])
 def update_character(character_id):
     try:
-        # This finds the character to be updated
-        stmt = db.select(Character).filter_by(id=character_id)
-        character = db.session.scalar(stmt)
-
         # This loads the data from the request
         body_data = character_schema.load(request.get_json(), partial=True)
 
+        # A PATCH without If-Match is a single UPDATE ... RETURNING, with no lookup first
+        values = changed_values(Character, body_data)
+        if can_update_directly(values):
+            character = update_returning(Character, character_id, values)
+            if character:
+                # Dump before committing so the row doesn't need to be reloaded afterwards
+                data, etag = timed_dump(character_schema, character), row_etag(character)
+                db.session.commit()
+                return with_etag(data, etag)
+            return {"message": f"Character with id {character_id} doesn't exist"}, 404
+
+        # This finds the character to be updated
+        character = get_entity(Character, character_id)
+
         # If the character exists
         if character:
+            # If the client sent If-Match, it must be the version they are changing
+            if is_precondition_failed(character):
+                return {"message": f"Character with id {character_id} has changed since it was last read"}, 412
+
             # Update the character data using the data from the request body
             character.name = body_data.get("name") or character.name
             character.backstory = body_data.get(
@@ -134,17 +189,23 @@ def update_character(character_id):
             character.player_id = body_data.get(
                 "player_id") or character.player_id
 
-            # Commit the changes
+            # Flush so version_id is bumped, then dump before committing so the row
+            # doesn't need to be reloaded afterwards
+            db.session.flush()
+            data, etag = timed_dump(character_schema, character), row_etag(character)
             db.session.commit()
-
-            # Return the updated character data
-            return character_schema.dump(character)
+            return with_etag(data, etag)
 
         # If the character doesn't exist
         else:
             # Return a 404 error message with the id
             return {"message": f"Character with id {character_id} doesn't exist"}, 404
 
+    except StaleDataError:
+        # Another request updated the row between the lookup and the commit
+        db.session.rollback()
+        return {"message": f"Character with id {character_id} has changed since it was last read"}, 412
+
     except IntegrityError as err:
         # This checks for breaches of NON-NULL
         if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
@@ -162,10 +223,9 @@ def update_character(character_id):
 # This defines the route for the DELETE request. It is shortened by the above blueprint.
 @characters_bp.route("/<int:character_id>", methods=["DELETE"])
 def delete_character(character_id):
-    # This statement selects the campaign based on the id and filters it using filter.by
-    stmt = db.select(Character).filter_by(id=character_id)
-    # This retrieves the result. Scalar means it retrieves a single result.
-    character = db.session.scalar(stmt)
+    # This finds the character by its id. Rows already loaded in this request
+    # come from the session's identity map instead of a new SELECT.
+    character = get_entity(Character, character_id)
     # if it exists:
     if character:
         # delete the character
@@ -178,3 +238,52 @@ def delete_character(character_id):
     else:
         # return a 404 error message with the id
         return {"message": f"Character with id {character_id} does not exist"}, 404
+
+
+# UPDATE CHARACTERS IN BULK
+# This function updates many characters with a single UPDATE statement
+# To do this, the application:
+# - Picks the characters by a list of ids or by a filter
+# - Loads the new values with the schema (partial=True)
+# - Runs one UPDATE ... RETURNING and commits
+# - Integrity checks for Non Nullable, Unique and Foreign Key constraints
+
+
+# This defines the route for the bulk UPDATE request. It is shortened by the above blueprint.
+@characters_bp.route("/bulk", methods=["PATCH"])
+def update_characters_bulk():
+    try:
+        # This updates every selected row and returns the updated rows
+        return bulk_update(Character, characters_schema, CHARACTERS_FILTERS)
+
+    except IntegrityError as err:
+        # This checks for breaches of NON-NULL
+        if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
+            return {"message": f"{err.orig.diag.column_name} is required"}, 409
+        # This checks for breaches of UNIQUE
+        if err.orig.pgcode == errorcodes.UNIQUE_VIOLATION:
+            return {"message": "Character name must be unique within the campaign"}, 409
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
+
+
+# DELETE CHARACTERS IN BULK
+# This function deletes many characters with a single DELETE statement
+# To do so, the application:
+# - Picks the characters by a list of ids or by a filter
+# - Runs one DELETE ... RETURNING and commits
+# - Returns what was deleted
+
+
+# This defines the route for the bulk DELETE request. It is shortened by the above blueprint.
+@characters_bp.route("/bulk", methods=["DELETE"])
+def delete_characters_bulk():
+    try:
+        # This deletes every selected row
+        return bulk_delete(Character, characters_schema, CHARACTERS_FILTERS)
+
+    except IntegrityError as err:
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
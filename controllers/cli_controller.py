@@ -1,12 +1,20 @@
-from flask import Blueprint
+import sys
+
+import click
+from flask import Blueprint, current_app
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import AddConstraint, CreateColumn
 
 from init import db
-from models.campaigns import Campaign
-from models.characters import Character
-from models.game_masters import GameMaster
-from models.played_games import PlayedGame
-from models.player_campaigns import PlayerCampaign
-from models.players import Player
+from models.campaigns import Campaign, campaigns_schema
+from models.change_counters import ChangeCounter
+from models.characters import Character, characters_schema
+from models.game_masters import GameMaster, game_masters_schema
+from models.played_games import PlayedGame, played_games_schema
+from models.player_campaigns import PlayerCampaign, player_campaigns_schema
+from models.players import Player, players_schema
+from utils.serializing import ColumnSerializer, SchemaSerializer, schema_columns
+from utils.slow_queries import clear_slow_queries, read_slow_queries
 
 db_commands = Blueprint("db", __name__)
 
@@ -14,9 +22,80 @@ db_commands = Blueprint("db", __name__)
 # Create Table Function
 
 
+# create_all skips tables that already exist, so this also brings those tables up to
+# date with the models:
+# - missing columns are added, if they can be NULL or have a server default to fill
+#   the existing rows with (ie version_id)
+# - foreign keys whose ON DELETE has changed are dropped and added again (PostgreSQL only,
+#   SQLite can't alter a constraint, so those tables are listed to be recreated)
+# - any missing indexes are added
+
+
+# This returns the ON DELETE of a foreign key, in the form the database reports it
+def on_delete(action):
+    return (action or "NO ACTION").upper()
+
+
+# This adds the columns existing tables are missing
+def add_missing_columns():
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)
+        quote = connection.dialect.identifier_preparer.quote
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    print(f"{table.name}.{column.name} has no default for the existing rows, "
+                          "recreate the table with flask db drop and flask db create")
+                    continue
+                spec = CreateColumn(column).compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {spec}"))
+                print(f"Added {table.name}.{column.name}")
+
+
+# This makes the foreign keys of existing tables match the models' ON DELETE
+def update_foreign_keys():
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)
+        quote = connection.dialect.identifier_preparer.quote
+        for table in db.metadata.sorted_tables:
+            existing = {(tuple(key["constrained_columns"]), key["referred_table"]): key
+                        for key in inspector.get_foreign_keys(table.name)}
+            for constraint in table.foreign_key_constraints:
+                key = existing.get((tuple(constraint.column_keys), constraint.referred_table.name))
+                if key is None:
+                    continue
+                if on_delete(key["options"].get("ondelete")) == on_delete(constraint.ondelete):
+                    continue
+                columns = ", ".join(constraint.column_keys)
+                if connection.dialect.name == "sqlite" or not key["name"]:
+                    print(f"{table.name} ({columns}) needs ON DELETE {on_delete(constraint.ondelete)}, "
+                          "recreate the table with flask db drop and flask db create")
+                    continue
+                connection.execute(text(
+                    f"ALTER TABLE {quote(table.name)} DROP CONSTRAINT {quote(key['name'])}"))
+                connection.execute(AddConstraint(constraint))
+                print(f"Updated {table.name} ({columns}) to ON DELETE {on_delete(constraint.ondelete)}")
+
+
 @db_commands.cli.command("create")
 def create_tables():
-    db.create_all()
+    # The tables are only made on the primary, a read replica gets them from replication
+    db.create_all(bind_key=None)
+    add_missing_columns()
+    update_foreign_keys()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    # Every table gets a change counter, which the list ETags are built from
+    counted = set(db.session.scalars(db.select(ChangeCounter.table_name)))
+    db.session.add_all(
+        ChangeCounter(table_name=table.name, version=0)
+        for table in db.metadata.sorted_tables
+        if table.name not in counted and table.name != ChangeCounter.__tablename__)
+    db.session.commit()
     print("Tables Successfully Created")
 
 # Delete Table Function
@@ -24,9 +103,164 @@ def create_tables():
 
 @db_commands.cli.command("drop")
 def drop_tables():
-    db.drop_all()
+    db.drop_all(bind_key=None)
     print("Tables Successfully Dropped")
 
+# Query Plan Check Function
+
+# This function runs EXPLAIN on the query shapes the application uses and
+# flags any that can only be answered with a sequential scan.
+# To do this, the application:
+# - builds a sample of each statement the controllers run
+# - turns off sequential scans for the transaction, so PostgreSQL uses an index
+#   whenever one exists (small tables would otherwise always be scanned)
+# - runs EXPLAIN on each statement and looks for "Seq Scan" in the plan
+# - rolls back, so nothing is changed
+
+
+# These are the statements the controllers run, with sample values
+def known_query_shapes():
+    return [
+        ("campaigns by id", db.select(Campaign).filter_by(id=1)),
+        ("campaigns page", db.select(Campaign).where(
+            Campaign.id > 1).order_by(Campaign.id).limit(51)),
+        ("campaigns by game master", db.select(Campaign).filter_by(game_master_id=1)),
+        ("campaigns by genre", db.select(Campaign).filter_by(genre="Fantasy")),
+        ("campaigns sorted by name", db.select(Campaign).order_by(
+            Campaign.name, Campaign.id).limit(51)),
+        ("characters by id", db.select(Character).filter_by(id=1)),
+        ("characters page", db.select(Character).where(
+            Character.id > 1).order_by(Character.id).limit(51)),
+        ("characters by campaign", db.select(Character).filter_by(campaign_id=1)),
+        ("characters by player", db.select(Character).filter_by(player_id=1)),
+        ("characters sorted by name", db.select(Character).order_by(
+            Character.name, Character.id).limit(51)),
+        ("game masters by id", db.select(GameMaster).filter_by(id=1)),
+        ("game masters by email", db.select(GameMaster).filter_by(email="a@example.com")),
+        ("played games by id", db.select(PlayedGame).filter_by(id=1)),
+        ("played games page", db.select(PlayedGame).where(
+            PlayedGame.id > 1).order_by(PlayedGame.id).limit(51)),
+        ("played games by campaign", db.select(PlayedGame).filter_by(campaign_id=1)),
+        ("players by id", db.select(Player).filter_by(id=1)),
+        ("players by email", db.select(Player).filter_by(email="a@example.com")),
+        ("player campaigns by ids", db.select(PlayerCampaign).filter_by(
+            player_id=1, campaign_id=1)),
+        ("player campaigns by player", db.select(PlayerCampaign).filter_by(player_id=1)),
+        ("player campaigns by campaign", db.select(PlayerCampaign).filter_by(campaign_id=1)),
+        ("cascade characters of campaign", db.delete(Character).filter_by(campaign_id=1)),
+        ("cascade played games of campaign", db.delete(PlayedGame).filter_by(campaign_id=1)),
+        ("cascade player campaigns of campaign",
+         db.delete(PlayerCampaign).filter_by(campaign_id=1)),
+        ("cascade player campaigns of player",
+         db.delete(PlayerCampaign).filter_by(player_id=1)),
+    ]
+
+
+@db_commands.cli.command("explain")
+def explain_queries():
+    if db.engine.dialect.name != "postgresql":
+        print("The query plan check needs a PostgreSQL database")
+        return
+
+    flagged = []
+    with db.engine.connect() as connection:
+        with connection.begin() as transaction:
+            connection.execute(text("SET LOCAL enable_seqscan = off"))
+            for name, stmt in known_query_shapes():
+                sql = str(stmt.compile(dialect=db.engine.dialect,
+                                       compile_kwargs={"literal_binds": True}))
+                plan = "\n".join(row[0] for row in connection.execute(
+                    text("EXPLAIN " + sql)))
+                if "Seq Scan" in plan:
+                    flagged.append(name)
+                    print(f"SEQ SCAN  {name}\n{plan}\n")
+                else:
+                    print(f"OK        {name}")
+            transaction.rollback()
+
+    if flagged:
+        print(f"{len(flagged)} query shape(s) need a sequential scan")
+        sys.exit(1)
+    print("All query shapes can use an index")
+
+
+# Serialiser Comparison Function
+
+# This function checks that the column serialiser (FAST_SERIALIZER) gives exactly
+# the same JSON as the marshmallow schemas, using the rows in the database.
+# To do this, the application:
+# - dumps every list with the schema, and again straight from its columns
+# - compares the JSON text of the two, byte for byte
+# - reports the schemas that can't use the column serialiser (they always use the schema)
+
+# These are the lists the serialiser is used for
+LIST_SCHEMAS = [
+    (Campaign, campaigns_schema),
+    (Character, characters_schema),
+    (GameMaster, game_masters_schema),
+    (PlayedGame, played_games_schema),
+    (PlayerCampaign, player_campaigns_schema),
+    (Player, players_schema),
+]
+
+
+@db_commands.cli.command("compare-serializers")
+def compare_serializers():
+    dumps = current_app.json.dumps
+    mismatched = []
+    for model, schema in LIST_SCHEMAS:
+        name = model.__tablename__
+        flat = schema_columns(schema, model)
+        if flat is None:
+            print(f"SCHEMA    {name} (not a flat schema)")
+            continue
+        stmt = db.select(model).order_by(*inspect(model).primary_key)
+        serializers = [SchemaSerializer(schema), ColumnSerializer(*flat)]
+        expected, actual = (
+            dumps(serializer.dump(serializer.rows(stmt))).encode() for serializer in serializers)
+        if expected == actual:
+            print(f"OK        {name} ({len(expected)} bytes)")
+        else:
+            mismatched.append(name)
+            print(f"MISMATCH  {name}\n  schema:  {expected[:200]}\n  columns: {actual[:200]}")
+        db.session.expunge_all()
+
+    if mismatched:
+        print(f"{len(mismatched)} list(s) dump differently")
+        sys.exit(1)
+    print("The column serialiser matches the schemas")
+
+# Slow Query Log Function
+
+# This function prints the statements that took longer than SLOW_QUERY_MS, newest first,
+# from the log every worker saves to SLOW_QUERY_DIR.
+# For each one it shows:
+# - when it ran, how long it took and the endpoint (or "cli") that ran it
+# - the statement and its bound parameters
+# - its EXPLAIN plan, where a "Seq Scan" points at a missing index
+# --clear deletes the log once it has been read.
+
+
+@db_commands.cli.command("slowlog")
+@click.option("--limit", default=20, show_default=True, help="How many statements to show.")
+@click.option("--clear", is_flag=True, help="Delete the log after showing it.")
+def show_slow_queries(limit, clear):
+    directory = current_app.config["SLOW_QUERY_DIR"]
+    entries = read_slow_queries(directory)
+    if not entries:
+        print(f"No slow queries have been logged in {directory}")
+    for entry in entries[:limit]:
+        source = entry["request"] or entry["endpoint"]
+        print(f"{entry['time']}  {entry['ms']:.1f} ms  {entry['endpoint']}  {source}")
+        print("  " + entry["statement"].replace("\n", "\n  "))
+        print(f"  parameters: {entry['parameters']}")
+        for line in entry.get("plan", []):
+            print(f"    {line}")
+        print()
+    if clear:
+        clear_slow_queries(directory)
+        print("The slow query log was cleared")
+
 # Seed Data Function
 
 
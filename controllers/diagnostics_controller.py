@@ -0,0 +1,54 @@
+from flask import Blueprint
+
+from init import db
+from utils.cache import cache_status
+from utils.pool import pool_statuses
+from utils.profiling import request_stats
+
+# This blueprint builds a prefix for the routing to enable shorter code blocks for the Diagnostics Controller.
+# These routes report on the running worker, ie for sizing the connection pool.
+diagnostics_bp = Blueprint("diagnostics", __name__, url_prefix="/diagnostics")
+
+# READ THE CONNECTION POOL STATUS
+
+# This function returns the connection pool status for this worker, for each engine
+# ("primary", and "replica" when there is one).
+# Each includes:
+# - the pool size and how many connections are checked in, checked out (in use) and overflowing
+# - how many checkouts there have been, how many timed out, and how long they waited
+
+
+# This defines the route for a GET request. It is shortened by the above blueprint.
+@diagnostics_bp.route("/pool")
+def get_pool_status():
+    return pool_statuses(db.engines)
+
+
+# READ THE RESPONSE CACHE STATUS
+
+# This function returns the response cache counters for this worker.
+# It includes:
+# - the cache settings and backend (with its entry count and evictions, for the memory backend)
+# - how many lookups were hits and misses, and the hit ratio
+# - how many tags this worker's writes have invalidated
+
+
+# This defines the route for a GET request. It is shortened by the above blueprint.
+@diagnostics_bp.route("/cache")
+def get_cache_status():
+    return cache_status()
+
+
+# READ THE REQUEST TIMINGS
+
+# This function returns the timings of each endpoint for this worker (PROFILING must be on).
+# It includes:
+# - how many requests there were, and their average and longest time
+# - the average number of SQL statements, and the average time in the database and serialising
+# - a histogram of how long the requests took, in milliseconds
+
+
+# This defines the route for a GET request. It is shortened by the above blueprint.
+@diagnostics_bp.route("/requests")
+def get_request_timings():
+    return request_stats.snapshot()
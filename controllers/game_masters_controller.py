@@ -1,14 +1,35 @@
 from flask import Blueprint, request
 from sqlalchemy.exc import IntegrityError, DataError
+from sqlalchemy.orm.exc import StaleDataError
 from psycopg2 import errorcodes
 
 from init import db
 from models.game_masters import GameMaster, game_masters_schema, game_master_schema
+from utils.bulk import bulk_delete, bulk_update
+from utils.cache import cached_entity
+from utils.etags import is_not_modified, is_precondition_failed, not_modified, row_etag, with_etag
+from utils.filtering import apply_filters, get_sort_order
+from utils.listing import list_response
+from utils.lookups import get_entity
+from utils.serializing import timed_dump
+from utils.updates import can_update_directly, changed_values, update_returning
+from utils.upserts import upsert
 
 # This blueprint builds a prefix for the routing to enable shorter code blocks for the Game Master Controller.
 game_masters_bp = Blueprint(
     "game_masters", __name__, url_prefix="/game_masters")
 
+# These columns can be used to filter the list, bulk update and bulk delete routes
+GAME_MASTERS_FILTERS = {
+    "email": GameMaster.email,
+}
+
+# These columns can be used to sort the list routes with ?sort=<column> or ?sort=-<column>
+GAME_MASTERS_SORTS = {
+    "id": GameMaster.id,
+    "email": GameMaster.email,
+}
+
 # CREATE A GAME MASTER
 
 # This function creates a new entry
@@ -40,7 +61,54 @@ def create_game_master():
         db.session.commit()
 
         # This returns the new entry
-        return game_master_schema.dump(new_game_master), 201
+        return timed_dump(game_master_schema, new_game_master), 201
+
+    # This checks for conflicts between requests and conditions, e.g., unique, null (409)
+    except IntegrityError as err:
+        # This checks for breaches of NON-NULL
+        if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
+            return {"message": f"{err.orig.diag.column_name} is required"}, 409
+        # This checks for breaches of UNIQUE
+        if err.orig.pgcode == errorcodes.UNIQUE_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
+
+    except DataError as err:
+        # This handles invalid data (email and phone format)
+        return {"message": err.orig.diag.message_primary}, 400
+
+
+# CREATE OR UPDATE A GAME MASTER BY EMAIL
+
+# This function makes sure a game master with the given email exists with the given details,
+# so a client syncing game masters can send the same request any number of times.
+# To do this, the application:
+# - Loads in the schema, with the email from the url
+# - Inserts the game master, or updates the one with that email (INSERT ... ON CONFLICT DO UPDATE)
+# - Commits and returns the game master: 201 if it was created, 200 if it was updated
+# - Checks for conflicts with other game masters (ie the phone number)
+
+
+# This defines the route for the request. It is shortened by the above blueprint.
+@game_masters_bp.route("/by-email/<email>", methods=["PUT"])
+def upsert_game_master(email):
+
+    # The email is added to the body, so the body has to be an object
+    json_data = request.get_json()
+    if not isinstance(json_data, dict):
+        return {"message": "Request body must be an object"}, 400
+
+    try:
+        # This loads in the game master schema, the email in the url takes the place of one in the body
+        body_data = game_master_schema.load({**json_data, "email": email})
+
+        # This inserts or updates the game master in one statement
+        game_master, created = upsert(GameMaster, body_data, ["email"])
+        db.session.commit()
+
+        # This returns the game master along with its ETag
+        response = with_etag(timed_dump(game_master_schema, game_master), row_etag(game_master))
+        response.status_code = 201 if created else 200
+        return response
 
     # This checks for conflicts between requests and conditions, e.g., unique, null (409)
     except IntegrityError as err:
@@ -55,6 +123,7 @@ def create_game_master():
         # This handles invalid data (email and phone format)
         return {"message": err.orig.diag.message_primary}, 400
 
+
 # READ ALL GAME MASTERS
 
 # This function finds the requested list using an SQL Query and returns it in JSON.
@@ -71,12 +140,13 @@ def create_game_master():
 def get_game_masters():
     # This statement selects all inputs from the game master table using the GameMaster Class
     stmt = db.select(GameMaster)
-    # This retrieves the results as a list. Scalars will provide multiple results.
-    game_masters_list = db.session.scalars(stmt)
-    # This converts the list into a JSON format using .dump
-    data = game_masters_schema.dump(game_masters_list)
-    # This returns the list
-    return data
+    # This adds any filters from the query string (?<column>=<value>) as a WHERE clause
+    stmt = apply_filters(stmt, GAME_MASTERS_FILTERS)
+    # This reads ?sort= and works out the order of the list
+    order = get_sort_order(GAME_MASTERS_SORTS, [GameMaster.id])
+    # This returns the list as a stream (?stream=1), a single page (?limit= or ?after=)
+    # or the whole list, converted into JSON with .dump
+    return list_response(stmt, order, game_masters_schema)
 
 # READ A SELECT GAME MASTER
 
@@ -86,22 +156,24 @@ def get_game_masters():
 # - selects the entity via it's id and filtering it with filter.by
 # - Retrieves the result
 # - if correct, converts to json and returns it
+# - keeps the json in the resource cache, so the next request skips the database
 # - else returns an error message
 
 
 # This defines the route for a GET request. It is shortened by the above blueprint.
 @game_masters_bp.route("/<int:game_master_id>")
 def get_game_master(game_master_id):
-    # This statement selects the game master based on the id and filters it using filter.by
-    stmt = db.select(GameMaster).filter_by(id=game_master_id)
-    # This retrieves the result. Scalar means it retrieves a single result.
-    game_master = db.session.scalar(stmt)
-    # Check if the campaign matching the idea was found
-    if game_master:
-        # if so, convert into a json using .dump
-        data = game_master_schema.dump(game_master)
-        # return the data
-        return data
+    # This finds the game master's data and ETag. Game masters rarely change, so they come
+    # from the resource cache when it has them, and from the database (then cached) when not.
+    cached = cached_entity(GameMaster, game_master_id, game_master_schema, row_etag)
+    # Check if the game master matching the id was found
+    if cached:
+        data, etag = cached
+        # if the client's copy is still current (If-None-Match), return 304
+        if is_not_modified(etag):
+            return not_modified(etag)
+        # return the data along with its ETag
+        return with_etag(data, etag)
     else:
         # else return a 404 error message with the id
         return {"message": f"Game master with id {game_master_id} does not exist"}, 404
@@ -109,6 +181,7 @@ def get_game_master(game_master_id):
 # UPDATE A GAME MASTER
 # This function finds a GameMaster object with the matching id and updates the data
 # To do this, the application:
+# - A PATCH without If-Match skips the lookup and runs one UPDATE ... RETURNING
 # - Finds the GameMaster (select), with the game master id (filter by) and loads it (.load)
 # - If it exists, overwrite the data with the new request
 # - Commits and returns the data
@@ -119,15 +192,29 @@ def get_game_master(game_master_id):
 @game_masters_bp.route("/<int:game_master_id>", methods=["PUT", "PATCH"])
 def update_game_master(game_master_id):
     try:
-        # This finds the game master to be updated
-        stmt = db.select(GameMaster).filter_by(id=game_master_id)
-        game_master = db.session.scalar(stmt)
-
         # This loads the data from the request body
         body_data = game_master_schema.load(request.get_json(), partial=True)
 
+        # A PATCH without If-Match is a single UPDATE ... RETURNING, with no lookup first
+        values = changed_values(GameMaster, body_data)
+        if can_update_directly(values):
+            game_master = update_returning(GameMaster, game_master_id, values)
+            if game_master:
+                # Dump before committing so the row doesn't need to be reloaded afterwards
+                data, etag = timed_dump(game_master_schema, game_master), row_etag(game_master)
+                db.session.commit()
+                return with_etag(data, etag)
+            return {"message": f"Game Master with id {game_master_id} doesn't exist"}, 404
+
+        # This finds the game master to be updated
+        game_master = get_entity(GameMaster, game_master_id)
+
         # If the game master exists
         if game_master:
+            # If the client sent If-Match, it must be the version they are changing
+            if is_precondition_failed(game_master):
+                return {"message": f"Game Master with id {game_master_id} has changed since it was last read"}, 412
+
             # Update the game master data using the data from the request body
             game_master.first_name = body_data.get(
                 "first_name") or game_master.first_name
@@ -136,17 +223,23 @@ def update_game_master(game_master_id):
             game_master.email = body_data.get("email") or game_master.email
             game_master.phone = body_data.get("phone") or game_master.phone
 
-            # Commit the changes
+            # Flush so version_id is bumped, then dump before committing so the row
+            # doesn't need to be reloaded afterwards
+            db.session.flush()
+            data, etag = timed_dump(game_master_schema, game_master), row_etag(game_master)
             db.session.commit()
-
-            # Return the updated data
-            return game_master_schema.dump(game_master)
+            return with_etag(data, etag)
 
         # If the game master doesn't exist
         else:
             # Return a 404 error message with the id
             return {"message": f"Game Master with id {game_master_id} doesn't exist"}, 404
 
+    except StaleDataError:
+        # Another request updated the row between the lookup and the commit
+        db.session.rollback()
+        return {"message": f"Game Master with id {game_master_id} has changed since it was last read"}, 412
+
     except IntegrityError as err:
         # This checks for breaches of NON-NULL
         if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
@@ -171,10 +264,9 @@ def update_game_master(game_master_id):
 # This defines the route for the DELETE request. It is shortened by the above blueprint.
 @game_masters_bp.route("/<int:game_master_id>", methods=["DELETE"])
 def delete_game_master(game_master_id):
-    # This statement selects the game master based on the id and filters it using filter.by
-    stmt = db.select(GameMaster).filter_by(id=game_master_id)
-    # This retrieves the result. Scalar means it retrieves a single result.
-    game_master = db.session.scalar(stmt)
+    # This finds the game master by its id. Rows already loaded in this request
+    # come from the session's identity map instead of a new SELECT.
+    game_master = get_entity(GameMaster, game_master_id)
     # if it exists:
     if game_master:
         # delete the game master
@@ -182,8 +274,61 @@ def delete_game_master(game_master_id):
         # commit the changes
         db.session.commit()
         # return success message
-        return {"message": f"'{game_master.name}' was deleted successfully"}
+        return {"message": f"'{game_master.first_name} {game_master.last_name}' was deleted successfully"}
     # if it doesn't exist
     else:
         # return a 404 message with the id
         return {"message": f"Game Master with id {game_master_id} does not exist"}, 404
+
+
+# UPDATE GAME MASTERS IN BULK
+# This function updates many game masters with a single UPDATE statement
+# To do this, the application:
+# - Picks the game masters by a list of ids or by a filter
+# - Loads the new values with the schema (partial=True)
+# - Runs one UPDATE ... RETURNING and commits
+# - Integrity checks for Non Nullable, Unique and Foreign Key constraints
+
+
+# This defines the route for the bulk UPDATE request. It is shortened by the above blueprint.
+@game_masters_bp.route("/bulk", methods=["PATCH"])
+def update_game_masters_bulk():
+    try:
+        # This updates every selected row and returns the updated rows
+        return bulk_update(GameMaster, game_masters_schema, GAME_MASTERS_FILTERS)
+
+    except IntegrityError as err:
+        # This checks for breaches of NON-NULL
+        if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
+            return {"message": f"{err.orig.diag.column_name} is required"}, 409
+        # This checks for breaches of UNIQUE
+        if err.orig.pgcode == errorcodes.UNIQUE_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
+
+    except DataError as err:
+        # This handles invalid data (email and phone format)
+        return {"message": err.orig.diag.message_primary}, 400
+
+
+# DELETE GAME MASTERS IN BULK
+# This function deletes many game masters with a single DELETE statement
+# To do so, the application:
+# - Picks the game masters by a list of ids or by a filter
+# - Runs one DELETE ... RETURNING and commits
+# - Returns what was deleted
+
+
+# This defines the route for the bulk DELETE request. It is shortened by the above blueprint.
+@game_masters_bp.route("/bulk", methods=["DELETE"])
+def delete_game_masters_bulk():
+    try:
+        # This deletes every selected row
+        return bulk_delete(GameMaster, game_masters_schema, GAME_MASTERS_FILTERS)
+
+    except IntegrityError as err:
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
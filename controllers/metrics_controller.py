@@ -0,0 +1,21 @@
+from flask import Blueprint
+
+from utils.metrics import CONTENT_TYPE, metrics_text
+
+# This blueprint holds the metrics route, which Prometheus reads from /metrics.
+metrics_bp = Blueprint("metrics", __name__)
+
+# READ THE METRICS
+
+# This function returns the request, connection pool and cache metrics in Prometheus' text format.
+# It includes:
+# - the number of requests and a histogram of how long they took, for each blueprint and method
+# - the connections in use and how long requests have waited for one
+# - the response cache hits and misses
+# With METRICS_DIR set these are the totals of every gunicorn worker, otherwise of this one.
+
+
+# This defines the route for a GET request.
+@metrics_bp.route("/metrics")
+def get_metrics():
+    return metrics_text(), 200, {"Content-Type": CONTENT_TYPE}
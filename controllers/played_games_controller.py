@@ -1,14 +1,32 @@
 from flask import Blueprint, request
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 from psycopg2 import errorcodes
 
 from init import db
 from models.played_games import PlayedGame, played_games_schema, played_game_schema
+from utils.bulk import bulk_create, bulk_delete, bulk_update
+from utils.etags import is_not_modified, is_precondition_failed, not_modified, row_etag, with_etag
+from utils.filtering import apply_filters, get_sort_order
+from utils.listing import list_response
+from utils.lookups import get_entity
+from utils.serializing import timed_dump
+from utils.updates import can_update_directly, changed_values, update_returning
 
 # This blueprint builds a prefix for the routing to enable shorter code blocks for the Campaign Controller.
 played_games_bp = Blueprint(
     "played_games", __name__, url_prefix="/played_games")
 
+# These columns can be used to filter the list, bulk update and bulk delete routes
+PLAYED_GAMES_FILTERS = {
+    "campaign_id": PlayedGame.campaign_id,
+}
+
+# These columns can be used to sort the list routes with ?sort=<column> or ?sort=-<column>
+PLAYED_GAMES_SORTS = {
+    "id": PlayedGame.id,
+}
+
 # CREATE A PLAYED GAME
 
 # This function creates a new entry
@@ -38,14 +56,30 @@ def create_played_game():
         db.session.commit()
 
         # This returns the new entry
-        return played_game_schema.dump(new_played_game), 201
+        return timed_dump(played_game_schema, new_played_game), 201
 
- # This checks for conflicts between requests and conditions, e.g., unique, null (409)
+    # This checks for conflicts between requests and conditions, e.g., unique, null (409)
     except IntegrityError as err:
         # This checks for breaches of NON-NULL
         if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
             return {"message": f"{err.orig.diag.column_name} is required"}, 409
 
+# CREATE PLAYED GAMES IN BULK
+
+# This function creates many played games in a single request and transaction
+# To do this, the application:
+# - Loads the list of played games with the schema (many=True)
+# - Inserts them with multi-row INSERT ... RETURNING statements
+# - Commits once and returns the new played games
+# - Reports each conflict against the position of the item that caused it, and creates nothing
+
+
+# This defines the route for the request. It is shortened by the above blueprint.
+@played_games_bp.route("/bulk", methods=["POST"])
+def create_played_games_bulk():
+    # This validates and inserts every played game in the request body
+    return bulk_create(PlayedGame, played_games_schema)
+
 # READ ALL PLAYED GAMES
 
 # This function finds the requested list using an SQL Query and returns it in JSON.
@@ -62,12 +96,13 @@ def create_played_game():
 def get_played_games():
     # This statement selects all inputs from the Played Games table using the Played Games Class
     stmt = db.select(PlayedGame)
-    # This retrieves the results as a list. Scalars will provide multiple results.
-    played_games_list = db.session.scalars(stmt)
-    # This converts the list into a JSON format using .dump
-    data = played_games_schema.dump(played_games_list)
-    # This returns the list
-    return data
+    # This adds any filters from the query string (?<column>=<value>) as a WHERE clause
+    stmt = apply_filters(stmt, PLAYED_GAMES_FILTERS)
+    # This reads ?sort= and works out the order of the list
+    order = get_sort_order(PLAYED_GAMES_SORTS, [PlayedGame.id])
+    # This returns the list as a stream (?stream=1), a single page (?limit= or ?after=)
+    # or the whole list, converted into JSON with .dump
+    return list_response(stmt, order, played_games_schema)
 
 # READ A SELECT PLAYED GAME
 # This function finds a select campaign and returns it as JSON.
@@ -83,17 +118,23 @@ def get_played_games():
 
 @played_games_bp.route("/<int:played_game_id>")
 def get_played_game(played_game_id):
-    stmt = db.select(PlayedGame).filter_by(id=played_game_id)
-    played_game = db.session.scalar(stmt)
+    # This finds the played game by its id. Rows already loaded in this request
+    # come from the session's identity map instead of a new SELECT.
+    played_game = get_entity(PlayedGame, played_game_id)
     if played_game:
-        data = played_game_schema.dump(played_game)
-        return data
+        # if the client's copy is still current (If-None-Match), skip the dump and return 304
+        etag = row_etag(played_game)
+        if is_not_modified(etag):
+            return not_modified(etag)
+        data = timed_dump(played_game_schema, played_game)
+        return with_etag(data, etag)
     else:
         return {"message": f"Played Game with id {played_game_id} does not exist"}, 404
 
 # UPDATE A PLAYED GAME
 # This function finds a PlayedGame object with the matching id and updates the data
 # To do this, the application:
+# - A PATCH without If-Match skips the lookup and runs one UPDATE ... RETURNING
 # - Finds the PlayedGame (select), with the played game id (filter by) and loads it (.load)
 # - If it exists, overwrite the data with the new request
 # - Commits and returns the data
@@ -104,32 +145,52 @@ def get_played_game(played_game_id):
 @played_games_bp.route("/<int:played_game_id>", methods=["PUT", "PATCH"])
 def update_played_game(played_game_id):
     try:
-        # This finds the played game to be updated
-        stmt = db.select(PlayedGame).filter_by(id=played_game_id)
-        played_game = db.session.scalar(stmt)
-
         # This loads the data from the request body
         body_data = played_game_schema.load(request.get_json(), partial=True)
 
+        # A PATCH without If-Match is a single UPDATE ... RETURNING, with no lookup first
+        values = changed_values(PlayedGame, body_data)
+        if can_update_directly(values):
+            played_game = update_returning(PlayedGame, played_game_id, values)
+            if played_game:
+                # Dump before committing so the row doesn't need to be reloaded afterwards
+                data, etag = timed_dump(played_game_schema, played_game), row_etag(played_game)
+                db.session.commit()
+                return with_etag(data, etag)
+            return {"message": f"Played Game with id {played_game_id} doesn't exist"}, 404
+
+        # This finds the played game to be updated
+        played_game = get_entity(PlayedGame, played_game_id)
+
         # If the played game exists
         if played_game:
+            # If the client sent If-Match, it must be the version they are changing
+            if is_precondition_failed(played_game):
+                return {"message": f"Played Game with id {played_game_id} has changed since it was last read"}, 412
+
             # Update the played game data using the data from the request body
             played_game.synopsis = body_data.get(
                 "synopsis") or played_game.synopsis
             played_game.campaign_id = body_data.get(
                 "campaign_id") or played_game.campaign_id
 
-            # Commit the changes
+            # Flush so version_id is bumped, then dump before committing so the row
+            # doesn't need to be reloaded afterwards
+            db.session.flush()
+            data, etag = timed_dump(played_game_schema, played_game), row_etag(played_game)
             db.session.commit()
-
-            # Return the updated data
-            return played_game_schema.dump(played_game)
+            return with_etag(data, etag)
 
         # If the played game doesn't exist
         else:
             # Return a 404 error message with the id
             return {"message": f"Played Game with id {played_game_id} doesn't exist"}, 404
 
+    except StaleDataError:
+        # Another request updated the row between the lookup and the commit
+        db.session.rollback()
+        return {"message": f"Played Game with id {played_game_id} has changed since it was last read"}, 412
+
     except IntegrityError as err:
         # This checks for breaches of NON-NULL
         if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
@@ -147,10 +208,9 @@ def update_played_game(played_game_id):
 # This defines the route for the DELETE request. It is shortened by the above blueprint.
 @played_games_bp.route("/<int:played_game_id>", methods=["DELETE"])
 def delete_played_game(played_game_id):
-    # This statement selects the played game based on the id and filters it using filter.by
-    stmt = db.select(PlayedGame).filter_by(id=played_game_id)
-    # This retrieves the result. Scalar means it retrieves a single result.
-    played_game = db.session.scalar(stmt)
+    # This finds the played game by its id. Rows already loaded in this request
+    # come from the session's identity map instead of a new SELECT.
+    played_game = get_entity(PlayedGame, played_game_id)
     # if it exists
     if played_game:
         # delete the played game
@@ -158,8 +218,54 @@ def delete_played_game(played_game_id):
         # commit the changes
         db.session.commit()
         # return a success message
-        return {"message": f"'{played_game.name}' was deleted successfully"}
+        return {"message": f"Played game {played_game.id} was deleted successfully"}
     # if it doesn't exist
     else:
         # return a 404 error message with the id
         return {"message": f"Played Game with id {played_game_id} does not exist"}, 404
+
+
+# UPDATE PLAYED GAMES IN BULK
+# This function updates many played games with a single UPDATE statement
+# To do this, the application:
+# - Picks the played games by a list of ids or by a filter
+# - Loads the new values with the schema (partial=True)
+# - Runs one UPDATE ... RETURNING and commits
+# - Integrity checks for Non Nullable, Unique and Foreign Key constraints
+
+
+# This defines the route for the bulk UPDATE request. It is shortened by the above blueprint.
+@played_games_bp.route("/bulk", methods=["PATCH"])
+def update_played_games_bulk():
+    try:
+        # This updates every selected row and returns the updated rows
+        return bulk_update(PlayedGame, played_games_schema, PLAYED_GAMES_FILTERS)
+
+    except IntegrityError as err:
+        # This checks for breaches of NON-NULL
+        if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
+            return {"message": f"{err.orig.diag.column_name} is required"}, 409
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
+
+
+# DELETE PLAYED GAMES IN BULK
+# This function deletes many played games with a single DELETE statement
+# To do so, the application:
+# - Picks the played games by a list of ids or by a filter
+# - Runs one DELETE ... RETURNING and commits
+# - Returns what was deleted
+
+
+# This defines the route for the bulk DELETE request. It is shortened by the above blueprint.
+@played_games_bp.route("/bulk", methods=["DELETE"])
+def delete_played_games_bulk():
+    try:
+        # This deletes every selected row
+        return bulk_delete(PlayedGame, played_games_schema, PLAYED_GAMES_FILTERS)
+
+    except IntegrityError as err:
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
@@ -1,14 +1,33 @@
 from flask import Blueprint, request
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 from psycopg2 import errorcodes
 
 from init import db
 from models.player_campaigns import PlayerCampaign, player_campaigns_schema, player_campaign_schema
+from utils.bulk import bulk_delete
+from utils.etags import is_not_modified, is_precondition_failed, not_modified, row_etag, with_etag
+from utils.filtering import apply_filters, get_sort_order
+from utils.listing import list_response
+from utils.lookups import get_entity
+from utils.serializing import timed_dump
+from utils.updates import can_update_directly, changed_values, update_returning
+from utils.upserts import insert_or_get
 
 # This blueprint builds a prefix for the routing to enable shorter code blocks for the PlayerCampaign Controller.
 player_campaigns_bp = Blueprint(
     "player_campaigns", __name__, url_prefix="/player_campaigns")
 
+# These columns can be used to filter the list, bulk update and bulk delete routes
+PLAYER_CAMPAIGNS_FILTERS = {
+    "player_id": PlayerCampaign.player_id,
+    "campaign_id": PlayerCampaign.campaign_id,
+}
+
+# These columns can be used to sort the list routes with ?sort=<column> or ?sort=-<column>
+# Player campaigns are always listed in primary key order
+PLAYER_CAMPAIGNS_SORTS = {}
+
 # CREATE A PLAYER CAMPAIGN
 
 # This function creates a new player campaign
@@ -38,7 +57,7 @@ def create_player_campaign():
         db.session.commit()
 
         # This returns the new player campaign
-        return player_campaign_schema.dump(new_player_campaign), 201
+        return timed_dump(player_campaign_schema, new_player_campaign), 201
 
     # This checks for conflicts between requests and conditions ie unique, null (409)
     except IntegrityError as err:
@@ -66,12 +85,13 @@ def create_player_campaign():
 def get_player_campaigns():
     # This statement selects all inputs from the PlayerCampaign Table
     stmt = db.select(PlayerCampaign)
-    # This retrieves the results as a list. Scalars will provide multiple results.
-    player_campaigns_list = db.session.scalars(stmt)
-    # This converts the list into a JSON format using .dump
-    data = player_campaigns_schema.dump(player_campaigns_list)
-    # This returns the list
-    return data
+    # This adds any filters from the query string (?<column>=<value>) as a WHERE clause
+    stmt = apply_filters(stmt, PLAYER_CAMPAIGNS_FILTERS)
+    # This reads ?sort= and works out the order of the list
+    order = get_sort_order(PLAYER_CAMPAIGNS_SORTS, [PlayerCampaign.player_id, PlayerCampaign.campaign_id])
+    # This returns the list as a stream (?stream=1), a single page (?limit= or ?after=)
+    # or the whole list, converted into JSON with .dump
+    return list_response(stmt, order, player_campaigns_schema)
 
 
 # READ A SELECT PLAYER CAMPAIGN
@@ -88,25 +108,66 @@ def get_player_campaigns():
 # This defines the route for a GET request. It is shortened by the above blueprint.
 @player_campaigns_bp.route("/<int:player_id>/<int:campaign_id>")
 def get_player_campaign(player_id, campaign_id):
-    # This statement selects the entity based on the id and filters it using filter.by
-    stmt = db.select(PlayerCampaign).filter_by(
-        player_id=player_id, campaign_id=campaign_id)
-    # This retrieves the result. Scalar means it retrieves a single result.
-    player_campaign = db.session.scalar(stmt)
+    # This finds the player campaign by its ids. Rows already loaded in this request
+    # come from the session's identity map instead of a new SELECT.
+    player_campaign = get_entity(PlayerCampaign, (player_id, campaign_id))
     # Check if the player campaign matching the ids was found
     if player_campaign:
-        # if so, convert into a json using .dump
-        data = player_campaign_schema.dump(player_campaign)
-        # return the data
-        return data
+        # if the client's copy is still current (If-None-Match), skip the dump and return 304
+        etag = row_etag(player_campaign)
+        if is_not_modified(etag):
+            return not_modified(etag)
+        # if not, convert into a json using .dump
+        data = timed_dump(player_campaign_schema, player_campaign)
+        # return the data along with its ETag
+        return with_etag(data, etag)
     else:
         # return a 404 error message with the ids
         return {"message": f"Player campaign with player_id {player_id} and campaign_id {campaign_id} does not exist"}, 404
 
 
+# ADD A PLAYER TO A CAMPAIGN
+# This function makes sure the player campaign with the ids in the url exists,
+# so a client syncing campaign members can send the same request any number of times.
+# To do this, the application:
+# - Inserts the player campaign unless it already exists (INSERT ... ON CONFLICT DO NOTHING)
+# - Commits and returns it: 201 if it was created, 200 if it was already there
+# - Checks that the player and the campaign exist
+# - A body with different ids moves the player campaign instead, the same as an update
+
+
+# This defines the route for the PUT request. It is shortened by the above blueprint.
+@player_campaigns_bp.route("/<int:player_id>/<int:campaign_id>", methods=["PUT"])
+def upsert_player_campaign(player_id, campaign_id):
+    # PUT used to be an update, so a body that changes the ids still updates the player campaign
+    json_data = request.get_json(silent=True) or {}
+    if isinstance(json_data, dict) and any(
+            key in json_data and json_data[key] != value
+            for key, value in (("player_id", player_id), ("campaign_id", campaign_id))):
+        return update_player_campaign(player_id, campaign_id)
+
+    try:
+        # This inserts the player campaign, or finds the existing one
+        player_campaign, created = insert_or_get(
+            PlayerCampaign, {"player_id": player_id, "campaign_id": campaign_id},
+            ["player_id", "campaign_id"])
+        db.session.commit()
+
+        # This returns the player campaign along with its ETag
+        response = with_etag(timed_dump(player_campaign_schema, player_campaign), row_etag(player_campaign))
+        response.status_code = 201 if created else 200
+        return response
+
+    except IntegrityError as err:
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
+
+
 # UPDATE A PLAYER CAMPAIGN
 # This function finds an object with the matching ids and replaces the contents with the new data
 # To do this, the application:
+# - A PATCH without If-Match skips the lookup and runs one UPDATE ... RETURNING
 # - Finds the player campaign (select), with the player and campaign ids (filter by) and loads it (.load)
 # - If it exists, overwrite the data with the new request
 # - Commits and returns the data
@@ -114,37 +175,56 @@ def get_player_campaign(player_id, campaign_id):
 
 
 # This defines the route for the UPDATE request. It is shortened by the above blueprint.
-@player_campaigns_bp.route("/<int:player_id>/<int:campaign_id>", methods=["PUT", "PATCH"])
+@player_campaigns_bp.route("/<int:player_id>/<int:campaign_id>", methods=["PATCH"])
 def update_player_campaign(player_id, campaign_id):
     try:
-        # This finds the player campaign to be updated
-        stmt = db.select(PlayerCampaign).filter_by(
-            player_id=player_id, campaign_id=campaign_id)
-        player_campaign = db.session.scalar(stmt)
-
         # This loads the data from the request
         body_data = player_campaign_schema.load(
             request.get_json(), partial=True)
 
+        # A PATCH without If-Match is a single UPDATE ... RETURNING, with no lookup first
+        values = changed_values(PlayerCampaign, body_data)
+        if can_update_directly(values):
+            player_campaign = update_returning(PlayerCampaign, (player_id, campaign_id), values)
+            if player_campaign:
+                # Dump before committing so the row doesn't need to be reloaded afterwards
+                data, etag = timed_dump(player_campaign_schema, player_campaign), row_etag(player_campaign)
+                db.session.commit()
+                return with_etag(data, etag)
+            return {"message": f"Player campaign with player_id {player_id} and campaign_id {campaign_id} doesn't exist"}, 404
+
+        # This finds the player campaign to be updated
+        player_campaign = get_entity(PlayerCampaign, (player_id, campaign_id))
+
         # If the player campaign exists
         if player_campaign:
+            # If the client sent If-Match, it must be the version they are changing
+            if is_precondition_failed(player_campaign):
+                return {"message": f"Player campaign with player_id {player_id} and campaign_id {campaign_id} has changed since it was last read"}, 412
+
             # Update the player campaign data using the data from the request body
             player_campaign.player_id = body_data.get(
                 "player_id") or player_campaign.player_id
             player_campaign.campaign_id = body_data.get(
                 "campaign_id") or player_campaign.campaign_id
 
-            # Commit the changes
+            # Flush so version_id is bumped, then dump before committing so the row
+            # doesn't need to be reloaded afterwards
+            db.session.flush()
+            data, etag = timed_dump(player_campaign_schema, player_campaign), row_etag(player_campaign)
             db.session.commit()
-
-            # Return the data
-            return player_campaign_schema.dump(player_campaign)
+            return with_etag(data, etag)
 
         # If the player campaign doesn't exist
         else:
             # Return a 404 error message with the ids
             return {"message": f"Player campaign with player_id {player_id} and campaign_id {campaign_id} doesn't exist"}, 404
 
+    except StaleDataError:
+        # Another request updated the row between the lookup and the commit
+        db.session.rollback()
+        return {"message": f"Player campaign with player_id {player_id} and campaign_id {campaign_id} has changed since it was last read"}, 412
+
     except IntegrityError as err:
         # This checks for breaches of NON-NULL
         if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
@@ -163,11 +243,9 @@ def update_player_campaign(player_id, campaign_id):
 # This defines the route for the DELETE request. It is shortened by the above blueprint.
 @player_campaigns_bp.route("/<int:player_id>/<int:campaign_id>", methods=["DELETE"])
 def delete_player_campaign(player_id, campaign_id):
-    # This statement selects the entity based on the player_id and campaign_id and filters it using filter.by
-    stmt = db.select(PlayerCampaign).filter_by(
-        player_id=player_id, campaign_id=campaign_id)
-    # This retrieves the result. Scalar means it retrieves a single result.
-    player_campaign = db.session.scalar(stmt)
+    # This finds the player campaign by its ids. Rows already loaded in this request
+    # come from the session's identity map instead of a new SELECT.
+    player_campaign = get_entity(PlayerCampaign, (player_id, campaign_id))
     # if it exists:
     if player_campaign:
         # delete the player campaign
@@ -180,3 +258,24 @@ def delete_player_campaign(player_id, campaign_id):
     else:
         # return a 404 error message with the ids
         return {"message": f"Player campaign with player_id {player_id} and campaign_id {campaign_id} does not exist"}, 404
+
+
+# DELETE PLAYER CAMPAIGNS IN BULK
+# This function deletes many player campaigns with a single DELETE statement
+# To do so, the application:
+# - Picks the player campaigns by a filter
+# - Runs one DELETE ... RETURNING and commits
+# - Returns what was deleted
+
+
+# This defines the route for the bulk DELETE request. It is shortened by the above blueprint.
+@player_campaigns_bp.route("/bulk", methods=["DELETE"])
+def delete_player_campaigns_bulk():
+    try:
+        # This deletes every selected row
+        return bulk_delete(PlayerCampaign, player_campaigns_schema, PLAYER_CAMPAIGNS_FILTERS)
+
+    except IntegrityError as err:
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
@@ -1,13 +1,35 @@
 from flask import Blueprint, request
 from sqlalchemy.exc import IntegrityError, DataError
+from sqlalchemy.orm import with_parent
+from sqlalchemy.orm.exc import StaleDataError
 from psycopg2 import errorcodes
 
 from init import db
+from models.campaigns import Campaign, campaigns_schema
 from models.players import Player, players_schema, player_schema
+from utils.bulk import bulk_create, bulk_delete, bulk_update
+from utils.etags import is_not_modified, is_precondition_failed, not_modified, row_etag, with_etag
+from utils.filtering import SortOrder, apply_filters, get_sort_order
+from utils.listing import list_response
+from utils.lookups import get_entity
+from utils.serializing import timed_dump
+from utils.updates import can_update_directly, changed_values, update_returning
+from utils.upserts import upsert
 
 # This blueprint builds a prefix for the routing to enable shorter code blocks for the player Controller.
 players_bp = Blueprint("players", __name__, url_prefix="/players")
 
+# These columns can be used to filter the list, bulk update and bulk delete routes
+PLAYERS_FILTERS = {
+    "email": Player.email,
+}
+
+# These columns can be used to sort the list routes with ?sort=<column> or ?sort=-<column>
+PLAYERS_SORTS = {
+    "id": Player.id,
+    "email": Player.email,
+}
+
 # CREATE A PLAYER
 
 # This function creates a new player
@@ -39,7 +61,53 @@ def create_player():
         db.session.commit()
 
         # This returns the new entry
-        return player_schema.dump(new_player), 201
+        return timed_dump(player_schema, new_player), 201
+
+    # This checks for conflicts between requests and conditions, e.g., unique, null (409)
+    except IntegrityError as err:
+        # This checks for breaches of NON-NULL
+        if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
+            return {"message": f"{err.orig.diag.column_name} is required"}, 409
+        # This checks for breaches of UNIQUE
+        if err.orig.pgcode == errorcodes.UNIQUE_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
+    except DataError as err:
+        # This handles invalid data (email and phone format)
+        return {"message": err.orig.diag.message_primary}, 400
+
+
+# CREATE OR UPDATE A PLAYER BY EMAIL
+
+# This function makes sure a player with the given email exists with the given details,
+# so a client syncing players can send the same request any number of times.
+# To do this, the application:
+# - Loads in the schema, with the email from the url
+# - Inserts the player, or updates the one with that email (INSERT ... ON CONFLICT DO UPDATE)
+# - Commits and returns the player: 201 if it was created, 200 if it was updated
+# - Checks for conflicts with other players (ie the phone number)
+
+
+# This defines the route for the request. It is shortened by the above blueprint.
+@players_bp.route("/by-email/<email>", methods=["PUT"])
+def upsert_player(email):
+
+    # The email is added to the body, so the body has to be an object
+    json_data = request.get_json()
+    if not isinstance(json_data, dict):
+        return {"message": "Request body must be an object"}, 400
+
+    try:
+        # This loads in the player schema, the email in the url takes the place of one in the body
+        body_data = player_schema.load({**json_data, "email": email})
+
+        # This inserts or updates the player in one statement
+        player, created = upsert(Player, body_data, ["email"])
+        db.session.commit()
+
+        # This returns the player along with its ETag
+        response = with_etag(timed_dump(player_schema, player), row_etag(player))
+        response.status_code = 201 if created else 200
+        return response
 
     # This checks for conflicts between requests and conditions, e.g., unique, null (409)
     except IntegrityError as err:
@@ -53,6 +121,29 @@ def create_player():
         # This handles invalid data (email and phone format)
         return {"message": err.orig.diag.message_primary}, 400
 
+
+# CREATE PLAYERS IN BULK
+
+# This function creates many players in a single request and transaction
+# To do this, the application:
+# - Loads the list of players with the schema (many=True)
+# - Inserts them with multi-row INSERT ... RETURNING statements
+# - Commits once and returns the new players
+# - Reports each conflict against the position of the item that caused it, and creates nothing
+
+
+# This defines the route for the request. It is shortened by the above blueprint.
+@players_bp.route("/bulk", methods=["POST"])
+def create_players_bulk():
+
+    try:
+        # This validates and inserts every player in the request body
+        return bulk_create(Player, players_schema)
+
+    except DataError as err:
+        # This handles invalid data (email and phone format)
+        return {"message": err.orig.diag.message_primary}, 400
+
 # READ ALL players
 
 # This function finds the requested list using an SQL Query and returns it in JSON.
@@ -69,12 +160,13 @@ def create_player():
 def get_players():
     # This statement selects all inputs from the players table using the Player Class
     stmt = db.select(Player)
-    # This retrieves the results as a list. Scalars will provide multiple results.
-    players_list = db.session.scalars(stmt)
-    # This converts the list into a JSON format using .dump
-    data = players_schema.dump(players_list)
-    # This returns the list
-    return data
+    # This adds any filters from the query string (?<column>=<value>) as a WHERE clause
+    stmt = apply_filters(stmt, PLAYERS_FILTERS)
+    # This reads ?sort= and works out the order of the list
+    order = get_sort_order(PLAYERS_SORTS, [Player.id])
+    # This returns the list as a stream (?stream=1), a single page (?limit= or ?after=)
+    # or the whole list, converted into JSON with .dump
+    return list_response(stmt, order, players_schema)
 
 # READ A SELECT PLAYER
 
@@ -90,23 +182,47 @@ def get_players():
 # This defines the route for a GET request. It is shortened by the above blueprint.
 @players_bp.route("/<int:player_id>")
 def get_player(player_id):
-    # This statement selects the player based on the id and filters it using filter.by
-    stmt = db.select(Player).filter_by(id=player_id)
-    # This retrieves the result. Scalar means it retrieves a single result.
-    player = db.session.scalar(stmt)
+    # This finds the player by its id. Rows already loaded in this request
+    # come from the session's identity map instead of a new SELECT.
+    player = get_entity(Player, player_id)
     # Check if the player matching the idea was found
     if player:
-        # if so, convert into a json using .dump
-        data = player_schema.dump(player)
-        # return the data
-        return data
+        # if the client's copy is still current (If-None-Match), skip the dump and return 304
+        etag = row_etag(player)
+        if is_not_modified(etag):
+            return not_modified(etag)
+        # if not, convert into a json using .dump
+        data = timed_dump(player_schema, player)
+        # return the data along with its ETag
+        return with_etag(data, etag)
     else:
         # else return a 404 error message with the id
         return {"message": f"Player with id {player_id} does not exist"}, 404
 
+# READ A PLAYER'S CAMPAIGNS
+
+# This function returns the campaigns a player is in.
+# To do this, the application:
+# - finds the player, returning a 404 if they don't exist
+# - selects the campaigns through the player's player campaigns (with_parent)
+# - returns them like the other lists (?stream=1, ?limit= and ?after= all work)
+
+
+# This defines the route for the player's campaigns. It is shortened by the above blueprint.
+@players_bp.route("/<int:player_id>/campaigns")
+def get_campaigns_for_player(player_id):
+    player = get_entity(Player, player_id)
+    if not player:
+        return {"message": f"Player with id {player_id} does not exist"}, 404
+    # Campaigns are linked to players through the player_campaigns table
+    stmt = db.select(Campaign).join(Campaign.players).where(
+        with_parent(player, Player.campaigns))
+    return list_response(stmt, SortOrder([Campaign.id]), campaigns_schema)
+
 # UPDATE A PLAYER
 # This function finds a Player object with the matching id and updates its data
 # To do this, the application:
+# - A PATCH without If-Match skips the lookup and runs one UPDATE ... RETURNING
 # - Finds the Player (select), with the player id (filter by) and loads it (.load)
 # - If it exists, overwrite the data with the new request
 # - Commits and returns the data
@@ -116,15 +232,29 @@ def get_player(player_id):
 @players_bp.route("/<int:player_id>", methods=["PUT", "PATCH"])
 def update_player(player_id):
     try:
-        # This finds the Player to be updated based on player_id
-        stmt = db.select(Player).filter_by(id=player_id)
-        player = db.session.scalar(stmt)
-
         # This loads the data from the request body
         body_data = player_schema.load(request.get_json(), partial=True)
 
+        # A PATCH without If-Match is a single UPDATE ... RETURNING, with no lookup first
+        values = changed_values(Player, body_data)
+        if can_update_directly(values):
+            player = update_returning(Player, player_id, values)
+            if player:
+                # Dump before committing so the row doesn't need to be reloaded afterwards
+                data, etag = timed_dump(player_schema, player), row_etag(player)
+                db.session.commit()
+                return with_etag(data, etag)
+            return {"message": f"Player with id {player_id} doesn't exist"}, 404
+
+        # This finds the Player to be updated based on player_id
+        player = get_entity(Player, player_id)
+
         # If the Player exists
         if player:
+            # If the client sent If-Match, it must be the version they are changing
+            if is_precondition_failed(player):
+                return {"message": f"Player with id {player_id} has changed since it was last read"}, 412
+
             # Update the player data using the data from the request body
             player.first_name = body_data.get(
                 "first_name") or player.first_name
@@ -132,17 +262,23 @@ def update_player(player_id):
             player.email = body_data.get("email") or player.email
             player.phone = body_data.get("phone") or player.phone
 
-            # Commit the changes
+            # Flush so version_id is bumped, then dump before committing so the row
+            # doesn't need to be reloaded afterwards
+            db.session.flush()
+            data, etag = timed_dump(player_schema, player), row_etag(player)
             db.session.commit()
-
-            # Return the updated data
-            return player_schema.dump(player)
+            return with_etag(data, etag)
 
         # If the Player doesn't exist
         else:
             # Return a 404 error message with the player_id
             return {"message": f"Player with id {player_id} doesn't exist"}, 404
 
+    except StaleDataError:
+        # Another request updated the row between the lookup and the commit
+        db.session.rollback()
+        return {"message": f"Player with id {player_id} has changed since it was last read"}, 412
+
     except IntegrityError as err:
         # This checks for breaches of NON-NULL
         if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
@@ -168,10 +304,9 @@ def update_player(player_id):
 
 @players_bp.route("/<int:player_id>", methods=["DELETE"])
 def delete_player(player_id):
-    # This statement selects the player based on the id and filters it using filter.by
-    stmt = db.select(Player).filter_by(id=player_id)
-    # This retrieves the result. Scalar means it retrieves a single result.
-    player = db.session.scalar(stmt)
+    # This finds the player by its id. Rows already loaded in this request
+    # come from the session's identity map instead of a new SELECT.
+    player = get_entity(Player, player_id)
     # if it exists:
     if player:
         # delete the player
@@ -179,8 +314,61 @@ def delete_player(player_id):
         # commit the changes
         db.session.commit()
         # Return success message
-        return {"message": f"'{player.name}' was deleted successfully"}
+        return {"message": f"'{player.first_name} {player.last_name}' was deleted successfully"}
     # if it doesn't exist
     else:
         # return a 404 error message with the id
         return {"message": f"Player with id {player_id} does not exist"}, 404
+
+
+# UPDATE PLAYERS IN BULK
+# This function updates many players with a single UPDATE statement
+# To do this, the application:
+# - Picks the players by a list of ids or by a filter
+# - Loads the new values with the schema (partial=True)
+# - Runs one UPDATE ... RETURNING and commits
+# - Integrity checks for Non Nullable, Unique and Foreign Key constraints
+
+
+# This defines the route for the bulk UPDATE request. It is shortened by the above blueprint.
+@players_bp.route("/bulk", methods=["PATCH"])
+def update_players_bulk():
+    try:
+        # This updates every selected row and returns the updated rows
+        return bulk_update(Player, players_schema, PLAYERS_FILTERS)
+
+    except IntegrityError as err:
+        # This checks for breaches of NON-NULL
+        if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
+            return {"message": f"{err.orig.diag.column_name} is required"}, 409
+        # This checks for breaches of UNIQUE
+        if err.orig.pgcode == errorcodes.UNIQUE_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
+
+    except DataError as err:
+        # This handles invalid data (email and phone format)
+        return {"message": err.orig.diag.message_primary}, 400
+
+
+# DELETE PLAYERS IN BULK
+# This function deletes many players with a single DELETE statement
+# To do so, the application:
+# - Picks the players by a list of ids or by a filter
+# - Runs one DELETE ... RETURNING and commits
+# - Returns what was deleted
+
+
+# This defines the route for the bulk DELETE request. It is shortened by the above blueprint.
+@players_bp.route("/bulk", methods=["DELETE"])
+def delete_players_bulk():
+    try:
+        # This deletes every selected row
+        return bulk_delete(Player, players_schema, PLAYERS_FILTERS)
+
+    except IntegrityError as err:
+        # This checks for breaches of FOREIGN KEY
+        if err.orig.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            return {"message": err.orig.diag.message_detail}, 409
@@ -1,5 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 
-db = SQLAlchemy()
+from utils.routing import RoutingSession
+
+# RoutingSession sends GET reads to the read replica when one is configured
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 ma = Marshmallow()
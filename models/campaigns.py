@@ -1,5 +1,6 @@
-from marshmallow import fields, validate
+from marshmallow import fields
 from init import db, ma
+from utils.validators import short_name
 
 from models.game_masters import GameMaster
 
@@ -8,19 +9,28 @@ class Campaign(db.Model):
     __tablename__ = "campaigns"
 
     id = db.Column(db.Integer, primary_key=True)
+    # Indexed so finding a game master's campaigns doesn't scan the table
     game_master_id = db.Column(db.Integer, db.ForeignKey(
-        "game_masters.id"), nullable=False)
+        "game_masters.id"), nullable=False, index=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
-    genre = db.Column(db.String(100))
+    # Indexed because the campaign list can be filtered by genre
+    genre = db.Column(db.String(100), index=True)
     description = db.Column(db.String(100))
+    # Counts the changes to this row. SQLAlchemy checks and bumps it on every UPDATE,
+    # so two requests editing the same version can't silently overwrite each other.
+    version_id = db.Column(db.Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version_id}
 
     game_master = db.relationship("GameMaster", back_populates="campaigns")
+    # Child rows are removed by ON DELETE CASCADE in the database, so passive_deletes
+    # stops the ORM loading every child just to delete it one at a time
     players = db.relationship(
-        "PlayerCampaign", back_populates="campaign", cascade="all, delete")
+        "PlayerCampaign", back_populates="campaign", cascade="all, delete", passive_deletes=True)
     characters = db.relationship(
-        "Character", back_populates="campaign", cascade="all, delete")
+        "Character", back_populates="campaign", cascade="all, delete", passive_deletes=True)
     played_games = db.relationship(
-        "PlayedGame", back_populates="campaign", cascade="all, delete")
+        "PlayedGame", back_populates="campaign", cascade="all, delete", passive_deletes=True)
 
 
 class CampaignSchema(ma.Schema):
@@ -30,36 +40,15 @@ class CampaignSchema(ma.Schema):
 
     name = fields.Str(
         required=True,
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=short_name
     )
 
     genre = fields.Str(
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=short_name
     )
 
     description = fields.Str(
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=short_name
     )
 
 
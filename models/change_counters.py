@@ -0,0 +1,11 @@
+from init import db
+
+
+class ChangeCounter(db.Model):
+    __tablename__ = "change_counters"
+
+    # One row per table, counting how many times the table has been written to.
+    # The counter is bumped in the same transaction as the write, just before it
+    # commits, and the list endpoints use it to build their ETags.
+    table_name = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
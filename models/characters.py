@@ -1,6 +1,8 @@
 from init import db, ma
 
-from marshmallow import fields, validate
+from marshmallow import fields
+
+from utils.validators import short_name
 
 from models.campaigns import Campaign
 from models.players import Player
@@ -16,13 +18,19 @@ class Character(db.Model):
     )
 
     id = db.Column(db.Integer, primary_key=True)
+    # Indexed so lookups, joins and cascades on these columns don't scan the table
     campaign_id = db.Column(db.Integer, db.ForeignKey(
-        "campaigns.id"), nullable=False)
+        "campaigns.id", ondelete="CASCADE"), nullable=False, index=True)
     player_id = db.Column(db.Integer, db.ForeignKey(
-        "players.id"), nullable=False)
+        "players.id"), nullable=False, index=True)
     name = db.Column(db.String(100), nullable=False)
     backstory = db.Column(db.String(100))
     skills = db.Column(db.String(100))
+    # Counts the changes to this row. SQLAlchemy checks and bumps it on every UPDATE,
+    # so two requests editing the same version can't silently overwrite each other.
+    version_id = db.Column(db.Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version_id}
 
     campaign = db.relationship("Campaign", back_populates="characters")
     player = db.relationship("Player", back_populates="characters")
@@ -34,36 +42,15 @@ class CharacterSchema(ma.Schema):
                   "name", "backstory", "skills")
 
     name = fields.Str(
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=short_name
     )
 
     backstory = fields.Str(
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=short_name
     )
 
     skills = fields.Str(
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=short_name
     )
 
 
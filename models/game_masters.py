@@ -1,5 +1,7 @@
 from init import db, ma
-from marshmallow import fields, validate
+from marshmallow import fields
+
+from utils.validators import email_address, phone_number, short_name
 
 
 class GameMaster(db.Model):
@@ -10,6 +12,11 @@ class GameMaster(db.Model):
     last_name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(100), unique=True, nullable=False)
     phone = db.Column(db.String(20), unique=True, nullable=False)
+    # Counts the changes to this row. SQLAlchemy checks and bumps it on every UPDATE,
+    # so two requests editing the same version can't silently overwrite each other.
+    version_id = db.Column(db.Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version_id}
 
     campaigns = db.relationship("Campaign", back_populates="game_master")
 
@@ -20,47 +27,19 @@ class GameMasterSchema(ma.Schema):
 
     first_name = fields.Str(
         required=True,
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=short_name
     )
     last_name = fields.Str(
         required=True,
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=short_name
     )
     email = fields.Email(
         required=True,
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=email_address
     )
     phone = fields.Str(
         required=True,
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=phone_number
     )
 
 
@@ -1,15 +1,22 @@
-from marshmallow import fields, validate
+from marshmallow import fields
 
 from init import db, ma
+from utils.validators import short_name
 
 
 class PlayedGame(db.Model):
     __tablename__ = "played_games"
 
     id = db.Column(db.Integer, primary_key=True)
+    # Indexed so lookups, joins and cascades on this column don't scan the table
     campaign_id = db.Column(db.Integer, db.ForeignKey(
-        "campaigns.id"), nullable=False)
+        "campaigns.id", ondelete="CASCADE"), nullable=False, index=True)
     synopsis = db.Column(db.String(500))
+    # Counts the changes to this row. SQLAlchemy checks and bumps it on every UPDATE,
+    # so two requests editing the same version can't silently overwrite each other.
+    version_id = db.Column(db.Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version_id}
 
     campaign = db.relationship("Campaign", back_populates="played_games")
 
@@ -19,14 +26,7 @@ class PlayedGameSchema(ma.Schema):
         fields = ("id", "campaign_id", "synopsis")
 
     synopsis = fields.Str(
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=short_name
     )
 
 
@@ -11,9 +11,16 @@ class PlayerCampaign(db.Model):
     )
 
     player_id = db.Column(db.Integer, db.ForeignKey(
-        "players.id"), primary_key=True, nullable=False)
+        "players.id", ondelete="CASCADE"), primary_key=True, nullable=False)
+    # The primary key starts with player_id, so campaign_id needs its own index
+    # for lookups and cascades by campaign
     campaign_id = db.Column(db.Integer, db.ForeignKey(
-        "campaigns.id"), primary_key=True, nullable=False)
+        "campaigns.id", ondelete="CASCADE"), primary_key=True, nullable=False, index=True)
+    # Counts the changes to this row. SQLAlchemy checks and bumps it on every UPDATE,
+    # so two requests editing the same version can't silently overwrite each other.
+    version_id = db.Column(db.Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version_id}
 
     player = db.relationship("Player", back_populates="campaigns")
     campaign = db.relationship("Campaign", back_populates="players")
@@ -1,6 +1,8 @@
 from init import db, ma
 
-from marshmallow import fields, validate
+from marshmallow import fields
+
+from utils.validators import email_address, phone_number, short_name
 
 
 class Player(db.Model):
@@ -11,9 +13,15 @@ class Player(db.Model):
     last_name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(100), unique=True, nullable=False)
     phone = db.Column(db.String(20), unique=True, nullable=False)
+    # Counts the changes to this row. SQLAlchemy checks and bumps it on every UPDATE,
+    # so two requests editing the same version can't silently overwrite each other.
+    version_id = db.Column(db.Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version_id}
 
+    # Player campaigns are removed by ON DELETE CASCADE in the database
     campaigns = db.relationship(
-        "PlayerCampaign", back_populates="player", cascade="all, delete")
+        "PlayerCampaign", back_populates="player", cascade="all, delete", passive_deletes=True)
 
     characters = db.relationship("Character", back_populates="player")
 
@@ -24,48 +32,20 @@ class PlayerSchema(ma.Schema):
 
     first_name = fields.Str(
         required=True,
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=short_name
     )
     last_name = fields.Str(
         required=True,
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=short_name
     )
     email = fields.Email(
         required=True,
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=email_address
     )
 
     phone = fields.Str(
         required=True,
-        validate=[
-            validate.Length(
-                min=1, max=100, error="This field must be between 1 and 100 characters."),
-            validate.Regexp(
-                r'^[A-Za-z\s\-\'&]+$',
-                error="This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
-            ),
-        ]
+        validate=phone_number
     )
 
 
@@ -0,0 +1,99 @@
+import pytest
+
+from app import create_app
+from init import db
+from models.campaigns import Campaign
+from models.characters import Character
+from models.game_masters import GameMaster
+from models.played_games import PlayedGame
+from models.player_campaigns import PlayerCampaign
+from models.players import Player
+
+# TEST FIXTURES
+
+# Each test gets its own app and SQLite database, made with `flask db create`.
+# The response cache, compression and metrics are off, so every response is built
+# from the database and can be compared byte for byte.
+
+
+# This makes apps on the test's database, with any other environment variables given.
+# Several apps share the database like the workers of one server.
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE_URI", f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setenv("RESOURCE_CACHE_TTL", "0")
+    monkeypatch.setenv("COMPRESSION", "false")
+    monkeypatch.setenv("METRICS", "false")
+    apps = []
+
+    def make(**environ):
+        for name, value in environ.items():
+            monkeypatch.setenv(name, value)
+        app = create_app()
+        app.config["TESTING"] = True
+        result = app.test_cli_runner().invoke(args=["db", "create"])
+        assert result.exit_code == 0, result.output
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        with app.app_context():
+            db.engine.dispose()
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# This adds rows with the edge cases the serialisers must agree on:
+# - NULL genres, descriptions, backstories, skills and synopses
+# - a game master, player and campaign with nothing linked to them
+# - text that JSON has to escape, and text that isn't ASCII
+# It returns the ids the tests need, by name.
+@pytest.fixture
+def rows(app):
+    with app.app_context():
+        game_master = GameMaster(first_name="Ada", last_name="Lovelace",
+                                 email="ada@example.com", phone="0400000001")
+        idle_game_master = GameMaster(first_name="Idle", last_name="Master",
+                                      email="idle@example.com", phone="0400000002")
+        player = Player(first_name="Zoë", last_name="O'Brien",
+                        email="zoe@example.com", phone="0400000003")
+        idle_player = Player(first_name="Idle", last_name="Player",
+                             email="idle-player@example.com", phone="0400000004")
+        db.session.add_all([game_master, idle_game_master, player, idle_player])
+        db.session.flush()
+
+        campaign = Campaign(name="Curse of \"Strahd\"", genre=None, description=None,
+                            game_master_id=game_master.id)
+        full_campaign = Campaign(name="Tomb of Annihilation", genre="Horror",
+                                 description="A jungle\nadventure", game_master_id=game_master.id)
+        empty_campaign = Campaign(name="Empty", genre="Fantasy", description="Nothing yet",
+                                  game_master_id=game_master.id)
+        db.session.add_all([campaign, full_campaign, empty_campaign])
+        db.session.flush()
+
+        db.session.add_all([
+            Character(name="Ireena", backstory=None, skills=None,
+                      campaign_id=campaign.id, player_id=player.id),
+            Character(name="Strahd", backstory="Vampire \\ count", skills="Charm",
+                      campaign_id=full_campaign.id, player_id=player.id),
+            PlayedGame(synopsis=None, campaign_id=campaign.id),
+            PlayedGame(synopsis="The party met Ireena", campaign_id=full_campaign.id),
+            PlayerCampaign(player_id=player.id, campaign_id=campaign.id),
+            PlayerCampaign(player_id=player.id, campaign_id=full_campaign.id),
+        ])
+        db.session.commit()
+        return {
+            "campaign": campaign.id,
+            "empty_campaign": empty_campaign.id,
+            "idle_game_master": idle_game_master.id,
+            "idle_player": idle_player.id,
+        }
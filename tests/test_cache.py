@@ -0,0 +1,85 @@
+from sqlalchemy import event
+
+from init import db
+from utils.cache import cache_stats
+
+# RESPONSE CACHE
+
+# These tests run two apps on one database, like two workers of one server,
+# each with the response cache on.
+
+PLAYED_GAME = {"synopsis": "A new session"}
+
+
+def make_workers(make_app, **environ):
+    return [make_app(RESOURCE_CACHE_TTL="30", **environ) for _ in range(2)]
+
+
+# Worker B has the list cached in memory when worker A adds a row.
+# The change counters are shared, so B's cached list is out of date and rebuilt.
+def test_memory_cached_list_sees_other_workers_writes(make_app, rows):
+    first, second = make_workers(make_app)
+    first_client, second_client = first.test_client(), second.test_client()
+
+    cached = second_client.get("/played_games/")
+    hits = cache_stats.snapshot()["hits"]
+    assert second_client.get("/played_games/").get_data() == cached.get_data()
+    assert cache_stats.snapshot()["hits"] == hits + 1
+
+    response = first_client.post("/played_games/", json={**PLAYED_GAME, "campaign_id": rows["campaign"]})
+    assert response.status_code == 201
+
+    expected = first_client.get("/played_games/")
+    actual = second_client.get("/played_games/")
+    assert len(actual.get_json()) == len(cached.get_json()) + 1
+    assert actual.headers["ETag"] == expected.headers["ETag"] != cached.headers["ETag"]
+
+
+# A client with the old ETag gets the new list from the other worker, not a 304
+def test_memory_cached_list_etag_follows_other_workers_writes(make_app, rows):
+    first, second = make_workers(make_app)
+    etag = second.test_client().get("/played_games/").headers["ETag"]
+    first.test_client().post("/played_games/", json={**PLAYED_GAME, "campaign_id": rows["campaign"]})
+    response = second.test_client().get("/played_games/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
+def test_memory_cached_list_is_used_while_nothing_changes(make_app, rows):
+    first, second = make_workers(make_app)
+    client = second.test_client()
+    client.get("/characters/")
+    hits = cache_stats.snapshot()["hits"]
+    with second.app_context():
+        queries = []
+
+        def count(*args):
+            queries.append(args[2])
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            assert client.get("/characters/").status_code == 200
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+    assert cache_stats.snapshot()["hits"] == hits + 1
+    # Only the change counters are read, for the ETag and to check the entry
+    assert all("change_counters" in statement for statement in queries)
+
+
+# The replica is an empty database, so a list read from it is easy to tell apart.
+# Lists are read from the replica and not stored, single rows are read from the primary.
+def test_lists_read_from_the_replica_are_not_stored(make_app, rows, tmp_path):
+    replica_uri = f"sqlite:///{tmp_path / 'replica.db'}"
+    make_app(DATABASE_URI=replica_uri)
+    app = make_app(DATABASE_URI=f"sqlite:///{tmp_path / 'test.db'}",
+                   REPLICA_DATABASE_URI=replica_uri, RESOURCE_CACHE_TTL="30")
+    client = app.test_client()
+
+    for _ in range(2):
+        stats = cache_stats.snapshot()
+        assert client.get("/characters/").get_json() == []
+        assert cache_stats.snapshot()["misses"] == stats["misses"] + 1
+
+    assert client.get(f"/campaigns/{rows['campaign']}").status_code == 200
+    stats = cache_stats.snapshot()
+    assert client.get(f"/campaigns/{rows['campaign']}").status_code == 200
+    assert cache_stats.snapshot()["hits"] == stats["hits"] + 1
@@ -0,0 +1,141 @@
+import pytest
+
+from utils import cache_backends
+from utils.cache import cache_stats
+from utils.cache_backends import RedisBackend
+
+# REDIS BACKEND
+
+# These tests run the Redis backend against a fake client with the only commands it uses
+# (get, set and mget), so they don't need a Redis server or the redis package.
+
+
+class FakeRedisError(Exception):
+    pass
+
+
+# This keeps keys in a dict, and returns bytes like redis.Redis does.
+# Expiry isn't kept, the tests never wait for it.
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def check(self):
+        if self.down:
+            raise FakeRedisError("Connection refused")
+
+    def get(self, key):
+        self.check()
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self.check()
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, px=None, nx=False, xx=False):
+        self.check()
+        if (nx and key in self.data) or (xx and key not in self.data):
+            return None
+        self.data[key] = value.encode() if isinstance(value, str) else value
+        return True
+
+
+# This stands in for the redis module, handing every app the same client
+class FakeRedisModule:
+    RedisError = FakeRedisError
+
+    def __init__(self, client):
+        self.Redis = self
+        self.client = client
+
+    def from_url(self, url, **options):
+        return self.client
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    client = FakeRedis()
+    monkeypatch.setattr(cache_backends, "redis", FakeRedisModule(client))
+    return client
+
+
+# Two workers with the cache in Redis
+@pytest.fixture
+def workers(make_app, rows, fake_redis):
+    return [make_app(CACHE_BACKEND="redis", CACHE_URL="redis://cache:6379/0",
+                     RESOURCE_CACHE_TTL="30") for _ in range(2)]
+
+
+def test_write_in_one_worker_invalidates_the_other(workers, rows):
+    first, second = (app.test_client() for app in workers)
+    url = f"/campaigns/{rows['campaign']}"
+
+    cached = second.get(url)
+    hits = cache_stats.snapshot()["hits"]
+    assert first.get(url).get_data() == cached.get_data()
+    assert cache_stats.snapshot()["hits"] == hits + 1
+
+    assert first.patch(url, json={"description": "Changed"}).status_code == 200
+    response = second.get(url)
+    assert response.get_json()["description"] == "Changed"
+    assert response.headers["ETag"] != cached.headers["ETag"]
+
+
+def test_list_is_shared_and_invalidated(workers, rows):
+    first, second = (app.test_client() for app in workers)
+    cached = second.get("/played_games/")
+    hits = cache_stats.snapshot()["hits"]
+    assert first.get("/played_games/").get_data() == cached.get_data()
+    assert cache_stats.snapshot()["hits"] == hits + 1
+
+    response = first.post("/played_games/", json={"synopsis": "A new session",
+                                                  "campaign_id": rows["campaign"]})
+    assert response.status_code == 201
+    assert len(second.get("/played_games/").get_json()) == len(cached.get_json()) + 1
+
+
+# Invalidating a tag that was never read doesn't create it
+def test_invalidate_leaves_unknown_tags_alone(fake_redis):
+    backend = RedisBackend(fake_redis)
+    backend.invalidate(["players:1"])
+    assert fake_redis.data == {}
+
+    version = backend.tag_versions(["players:1"])["players:1"]
+    backend.invalidate(["players:1"])
+    assert backend.tag_versions(["players:1"])["players:1"] not in (None, version)
+
+
+# Another worker creates the tag between our mget and set, so we use its version
+def test_new_tag_keeps_the_version_another_worker_set(fake_redis):
+    backend = RedisBackend(fake_redis)
+    mget = fake_redis.mget
+
+    def racing_mget(keys):
+        versions = mget(keys)
+        fake_redis.data.setdefault(backend.tag_key("players:*"), b"theirs")
+        fake_redis.mget = mget
+        return versions
+
+    fake_redis.mget = racing_mget
+    assert backend.tag_versions(["players:*"]) == {"players:*": "theirs"}
+
+
+# Without Redis every request is built from the database, and writes still succeed
+def test_requests_carry_on_when_redis_is_down(workers, rows, fake_redis):
+    client = workers[0].test_client()
+    url = f"/campaigns/{rows['campaign']}"
+    expected = client.get(url).get_data()
+
+    fake_redis.down = True
+    stats = cache_stats.snapshot()
+    assert client.get(url).get_data() == expected
+    assert client.get("/players/").status_code == 200
+    assert client.patch(url, json={"description": "Changed"}).status_code == 200
+    assert client.get(url).get_json()["description"] == "Changed"
+    snapshot = cache_stats.snapshot()
+    assert (snapshot["hits"], snapshot["misses"]) == (stats["hits"], stats["misses"])
+
+    # The write's invalidation is retried once Redis is back, so the old entry isn't used
+    fake_redis.down = False
+    assert client.get(url).get_json()["description"] == "Changed"
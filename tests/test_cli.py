@@ -0,0 +1,50 @@
+from sqlalchemy import inspect, text
+
+from init import db
+
+# FLASK DB CREATE
+
+# These tests run `flask db create` again on tables made by an older version of the models,
+# which it has to bring up to date without losing their rows.
+
+
+def create(app):
+    result = app.test_cli_runner().invoke(args=["db", "create"])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+# SQLite can't change a foreign key, so the table is listed to be recreated
+def test_foreign_key_without_cascade_is_reported(app):
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP TABLE played_games"))
+            connection.execute(text(
+                "CREATE TABLE played_games (id INTEGER PRIMARY KEY, synopsis TEXT, "
+                "campaign_id INTEGER NOT NULL REFERENCES campaigns (id), "
+                "version_id INTEGER NOT NULL DEFAULT 1)"))
+    output = create(app)
+    assert "played_games (campaign_id) needs ON DELETE CASCADE" in output
+    assert "characters" not in output
+
+
+def test_up_to_date_tables_are_left_alone(app):
+    with app.app_context():
+        before = inspect(db.engine).get_foreign_keys("characters")
+    assert create(app) == "Tables Successfully Created\n"
+    with app.app_context():
+        assert inspect(db.engine).get_foreign_keys("characters") == before
+
+
+# version_id was added to the models after the first tables were made
+def test_missing_version_id_is_added(app, client, rows):
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE campaigns DROP COLUMN version_id"))
+    assert "Added campaigns.version_id" in create(app)
+
+    response = client.patch(f"/campaigns/{rows['campaign']}", json={"description": "Changed"})
+    assert response.status_code == 200
+    with app.app_context():
+        versions = db.session.scalars(text("SELECT version_id FROM campaigns ORDER BY id")).all()
+    assert sorted(versions) == [1, 1, 2]
@@ -0,0 +1,40 @@
+import zlib
+
+# STREAMED COMPRESSION
+
+# A streamed list is compressed as it is sent, and the compressor is flushed every
+# COMPRESS_FLUSH_SIZE bytes, so the client can read rows before the stream ends.
+
+URL = "/players/?stream=1"
+
+
+def test_stream_sends_rows_as_they_are_compressed(make_app, rows):
+    plain = make_app().test_client().get(URL).get_data()
+    app = make_app(COMPRESSION="true", COMPRESS_FLUSH_SIZE="1")
+    response = app.test_client().get(URL, headers={"Accept-Encoding": "gzip"}, buffered=False)
+    assert response.headers["Content-Encoding"] == "gzip"
+
+    decompressor = zlib.decompressobj(31)
+    received = []
+    for chunk in response.response:
+        received.append(decompressor.decompress(chunk))
+    response.close()
+    # Every row can be read from the chunk it was sent in, before the end of the stream
+    assert received[0] == plain.split(b"\n", 1)[0] + b"\n"
+    assert b"".join(received) == plain
+
+
+def test_stream_without_flushes_is_the_same(make_app, rows):
+    app = make_app(COMPRESSION="true")
+    compressed = app.test_client().get(URL, headers={"Accept-Encoding": "gzip"}).get_data()
+    app.config["COMPRESSION"] = False
+    assert zlib.decompress(compressed, 31) == app.test_client().get(URL).get_data()
+
+
+# after_request hooks run last registered first, so compression has to be registered
+# after the timing hooks for its time to count in theirs
+def test_compression_runs_before_the_timing_hooks(make_app):
+    app = make_app(COMPRESSION="true", PROFILING="true", METRICS="true")
+    hooks = [hook.__name__ for hook in reversed(app.after_request_funcs[None])]
+    assert hooks.index("compress_response") < hooks.index("finish_timing")
+    assert hooks.index("compress_response") < hooks.index("count_request")
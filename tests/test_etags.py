@@ -0,0 +1,104 @@
+from sqlalchemy import event
+
+from init import db
+from models.change_counters import ChangeCounter
+
+# CHANGE COUNTERS
+
+# These tests check that writes bump the change counters behind the list ETags
+# in their own transaction, and that writes that fail leave them alone.
+
+GAME_MASTER = {"first_name": "Grace", "last_name": "Hopper",
+               "email": "grace@example.com", "phone": "0400000009"}
+
+
+def counter(app, table_name):
+    with app.app_context():
+        return db.session.get(ChangeCounter, table_name).version
+
+
+# A write and its counter bump share one connection, so a pool with a single
+# connection is enough for every writer
+def test_write_bumps_its_counter_on_one_connection(app, client, rows):
+    etag = client.get("/game_masters/").headers["ETag"]
+    before = counter(app, "game_masters")
+
+    # The most connections the request had checked out at once
+    checked_out = [0, 0]
+    with app.app_context():
+        engine = db.engine
+
+    def count_checkout(*args):
+        checked_out[0] += 1
+        checked_out[1] = max(checked_out)
+
+    def count_checkin(*args):
+        checked_out[0] -= 1
+
+    event.listen(engine, "checkout", count_checkout)
+    event.listen(engine, "checkin", count_checkin)
+    try:
+        response = client.post("/game_masters/", json=GAME_MASTER)
+    finally:
+        event.remove(engine, "checkout", count_checkout)
+        event.remove(engine, "checkin", count_checkin)
+
+    assert response.status_code == 201
+    assert checked_out[1] == 1
+    assert counter(app, "game_masters") == before + 1
+    assert client.get("/game_masters/").headers["ETag"] != etag
+
+
+def test_update_bumps_its_counter(app, client, rows):
+    before = counter(app, "campaigns")
+    response = client.patch(f"/campaigns/{rows['campaign']}", json={"description": "Changed"})
+    assert response.status_code == 200
+    assert counter(app, "campaigns") == before + 1
+
+
+# A bulk create that conflicts is rolled back, along with its counter bump
+def test_failed_write_keeps_its_counter(app, client, rows):
+    before = counter(app, "players")
+    players = [{"first_name": "Dup", "last_name": "Player",
+                "email": f"dup{n}@example.com", "phone": "0400000100"} for n in range(2)]
+    response = client.post("/players/bulk", json=players)
+    assert response.status_code == 409
+    assert counter(app, "players") == before
+
+
+# Savepoints (one for each bulk batch) don't bump the counter, the whole transaction does once
+def test_bulk_create_bumps_its_counter_once(app, client, rows):
+    app.config["BULK_BATCH_SIZE"] = 1
+    before = counter(app, "players")
+    players = [{"first_name": "Bulk", "last_name": "Player",
+                "email": f"bulk{n}@example.com", "phone": f"04000002{n:02d}"} for n in range(3)]
+    response = client.post("/players/bulk", json=players)
+    assert response.status_code == 201
+    assert counter(app, "players") == before + 1
+
+
+# An update that looks the row up first (here a PATCH with If-Match) dumps it before the
+# commit, so the row isn't read again afterwards to build the response
+def test_update_with_if_match_reads_the_row_once(app, client, rows):
+    url = f"/campaigns/{rows['campaign']}"
+    etag = client.get(url).headers["ETag"]
+    statements = []
+    with app.app_context():
+        engine = db.engine
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        response = client.patch(url, json={"description": "Changed"}, headers={"If-Match": etag})
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    assert response.status_code == 200
+    assert response.get_json()["description"] == "Changed"
+    assert response.headers["ETag"] not in (etag, None)
+    selects = [statement for statement in statements if "FROM campaigns" in statement]
+    assert len(selects) == 1
+    # The ETag is of the new version
+    assert client.get(url).headers["ETag"] == response.headers["ETag"]
@@ -0,0 +1,13 @@
+# METRICS ENDPOINT
+
+# GET /metrics is only registered when METRICS is on.
+
+
+def test_metrics_on(make_app):
+    response = make_app(METRICS="true").test_client().get("/metrics")
+    assert response.status_code == 200
+    assert "rpg_http_requests_total" in response.get_data(as_text=True)
+
+
+def test_metrics_off(make_app):
+    assert make_app(METRICS="false").test_client().get("/metrics").status_code == 404
@@ -0,0 +1,53 @@
+import sqlite3
+
+from sqlalchemy import create_engine
+
+from utils.metrics import render
+from utils.pool import TimedQueuePool, pool_statuses
+
+# CONNECTION POOL STATS
+
+# Each pool times its own checkouts, so the primary's and the replica's are reported apart.
+
+
+def make_engine():
+    return create_engine("sqlite://", poolclass=TimedQueuePool,
+                         creator=lambda: sqlite3.connect(":memory:"))
+
+
+def test_each_pool_keeps_its_own_stats():
+    primary, replica = make_engine(), make_engine()
+    for _ in range(3):
+        with primary.connect():
+            pass
+    with replica.connect():
+        pass
+
+    statuses = pool_statuses({None: primary, "replica": replica})
+    assert statuses["primary"]["checkouts"] == 3
+    assert statuses["replica"]["checkouts"] == 1
+
+    # Disposing the engine replaces the pool, but not its totals
+    primary.dispose()
+    with primary.connect():
+        pass
+    assert pool_statuses({None: primary})["primary"]["checkouts"] == 4
+
+
+def test_metrics_label_the_pools_by_engine():
+    primary, replica = make_engine(), make_engine()
+    with primary.connect():
+        pass
+    worker = {"requests": [], "latency": [], "pool": pool_statuses({None: primary, "replica": replica}),
+              "cache": {"hits": 0, "misses": 0, "invalidated_tags": 0}}
+    text = render([worker, worker])
+    assert 'rpg_db_pool_checkouts_total{engine="primary"} 2' in text
+    assert 'rpg_db_pool_checkouts_total{engine="replica"} 0' in text
+    assert 'rpg_db_pool_size{engine="replica"} 10' in text
+
+
+def test_diagnostics_report_each_engine(client):
+    response = client.get("/diagnostics/pool")
+    assert response.status_code == 200
+    assert list(response.get_json()) == ["primary"]
+    assert response.get_json()["primary"]["checkouts"] == 0
@@ -0,0 +1,143 @@
+import json
+
+import pytest
+from sqlalchemy import inspect
+
+from controllers.cli_controller import LIST_SCHEMAS
+from init import db
+from utils.pagination import encode_cursor
+from utils.serializing import ColumnSerializer, SchemaSerializer, schema_columns
+
+# SERIALISER COMPARISON
+
+# These tests check that FAST_SERIALIZER never changes a response: every list is fetched
+# with the marshmallow schemas and with the column serialiser, and the bodies must be
+# byte-identical. The rows come from the `rows` fixture (NULLs, empty relationships, text
+# that needs escaping), and the pages cover the edges of keyset pagination.
+
+# The list urls, with {name} filled in from the ids of the `rows` fixture
+LIST_URLS = [
+    "/campaigns/",
+    "/campaigns/?sort=-name",
+    "/campaigns/?genre=Horror",
+    "/campaigns/?game_master_id={idle_game_master}",
+    "/characters/",
+    "/characters/?sort=name",
+    "/game_masters/",
+    "/game_masters/?sort=-email",
+    "/played_games/",
+    "/player_campaigns/",
+    "/players/",
+    "/players/?sort=email",
+    "/campaigns/{campaign}/characters",
+    "/campaigns/{campaign}/played_games",
+    "/campaigns/{campaign}/players",
+    "/campaigns/{empty_campaign}/characters",
+    "/campaigns/{empty_campaign}/played_games",
+    "/campaigns/{empty_campaign}/players",
+    "/players/{idle_player}/campaigns",
+]
+
+
+# This fetches the url with the schemas and then with the column serialiser
+def get_both(app, client, url):
+    responses = []
+    for fast in (False, True):
+        app.config["FAST_SERIALIZER"] = fast
+        response = client.get(url)
+        assert response.status_code == 200, response.get_data(as_text=True)
+        responses.append(response)
+    return responses
+
+
+# This adds the next page's cursor to the url
+def page_url(url, limit, cursor=None):
+    separator = "&" if "?" in url else "?"
+    url = f"{url}{separator}limit={limit}"
+    return f"{url}&after={cursor}" if cursor else url
+
+
+@pytest.mark.parametrize("model, schema", LIST_SCHEMAS,
+                         ids=[model.__tablename__ for model, schema in LIST_SCHEMAS])
+def test_every_list_schema_is_flat(model, schema):
+    assert schema_columns(schema, model) is not None
+
+
+@pytest.mark.parametrize("model, schema", LIST_SCHEMAS,
+                         ids=[model.__tablename__ for model, schema in LIST_SCHEMAS])
+def test_column_serializer_dumps_like_the_schema(app, rows, model, schema):
+    with app.app_context():
+        stmt = db.select(model).order_by(*inspect(model).primary_key)
+        serializers = [SchemaSerializer(schema), ColumnSerializer(*schema_columns(schema, model))]
+        expected, actual = (app.json.dumps(serializer.dump(serializer.rows(stmt).all()))
+                            for serializer in serializers)
+    assert actual == expected
+
+
+@pytest.mark.parametrize("url", LIST_URLS)
+def test_full_list_is_identical(app, client, rows, url):
+    schema, columns = get_both(app, client, url.format(**rows))
+    assert columns.get_data() == schema.get_data()
+
+
+@pytest.mark.parametrize("url", LIST_URLS)
+def test_stream_is_identical(app, client, rows, url):
+    schema, columns = get_both(app, client, page_url(url.format(**rows), 1) + "&stream=1")
+    assert columns.get_data() == schema.get_data()
+
+
+# Walking the list one row at a time reaches every row, and each page is identical
+@pytest.mark.parametrize("url", LIST_URLS)
+def test_pages_are_identical(app, client, rows, url):
+    url = url.format(**rows)
+    full = json.loads(get_both(app, client, url)[0].get_data())
+    seen = []
+    cursor = None
+    while True:
+        schema, columns = get_both(app, client, page_url(url, 1, cursor))
+        assert columns.get_data() == schema.get_data()
+        page = schema.get_json()
+        seen.extend(page["data"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == full
+
+
+# A page that holds exactly the rest of the list has no next cursor,
+# and one row fewer leaves a cursor to the last row
+def test_page_of_exactly_the_whole_list(app, client, rows):
+    count = len(get_both(app, client, "/campaigns/")[0].get_json())
+    schema, columns = get_both(app, client, page_url("/campaigns/", count))
+    assert columns.get_data() == schema.get_data()
+    assert schema.get_json()["next_cursor"] is None
+
+    schema, columns = get_both(app, client, page_url("/campaigns/", count - 1))
+    assert columns.get_data() == schema.get_data()
+    cursor = schema.get_json()["next_cursor"]
+    assert cursor is not None
+
+    schema, columns = get_both(app, client, page_url("/campaigns/", count, cursor))
+    assert columns.get_data() == schema.get_data()
+    assert len(schema.get_json()["data"]) == 1
+
+
+# A cursor past the last row gives an empty page without a next cursor
+def test_page_after_the_last_row(app, client, rows):
+    last = get_both(app, client, "/players/")[0].get_json()[-1]
+    schema, columns = get_both(app, client, page_url("/players/", 5, encode_cursor([last["id"]])))
+    assert columns.get_data() == schema.get_data()
+    assert schema.get_json() == {"data": [], "next_cursor": None}
+
+
+def test_empty_list_page(app, client, rows):
+    url = "/campaigns/{empty_campaign}/characters".format(**rows)
+    schema, columns = get_both(app, client, page_url(url, 10))
+    assert columns.get_data() == schema.get_data()
+    assert schema.get_json() == {"data": [], "next_cursor": None}
+
+
+def test_empty_table(app, client):
+    for url in ("/played_games/", page_url("/played_games/", 10)):
+        schema, columns = get_both(app, client, url)
+        assert columns.get_data() == schema.get_data()
@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+# UPSERT BY EMAIL
+
+# PUT /players/by-email/<email> and /game_masters/by-email/<email> add the email in the
+# url to the body, so a body that isn't an object is turned down with a 400.
+
+
+@pytest.mark.parametrize("resource", ["players", "game_masters"])
+@pytest.mark.parametrize("body", [[], ["Grace"], "Grace", 1, None])
+def test_body_must_be_an_object(client, resource, body):
+    response = client.put(f"/{resource}/by-email/grace@example.com",
+                          data=json.dumps(body), content_type="application/json")
+    assert response.status_code == 400
+    assert response.get_json() == {"message": "Request body must be an object"}
+
+
+@pytest.mark.parametrize("resource", ["players", "game_masters"])
+def test_upsert_creates_then_updates(client, resource):
+    url = f"/{resource}/by-email/grace@example.com"
+    body = {"first_name": "Grace", "last_name": "Hopper", "phone": "0400000009"}
+    assert client.put(url, json=body).status_code == 201
+    response = client.put(url, json={**body, "last_name": "Brewster"})
+    assert response.status_code == 200
+    assert response.get_json()["last_name"] == "Brewster"
@@ -0,0 +1,192 @@
+from flask import abort, current_app, request
+from psycopg2 import errorcodes
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+
+from init import db
+from utils.serializing import timed_dump
+
+# BULK ENDPOINTS
+
+# These functions back the /bulk routes, which work on many rows in a single
+# request and a single transaction instead of one request per row.
+
+# How many rows go into each multi-row INSERT statement
+DEFAULT_BULK_BATCH_SIZE = 500
+# The most items a single bulk request can contain
+DEFAULT_BULK_MAX_ITEMS = 10000
+
+
+# This gives the names of the primary key columns for a model
+def primary_key_names(model):
+    return [column.key for column in inspect(model).primary_key]
+
+
+# BULK CREATE
+
+# This function creates every item in the request body in one transaction.
+# To do this, the application:
+# - checks the body is a non-empty list within the size limit
+# - loads it with the schema (many=True reports errors keyed by each item's position)
+# - builds one row per item, leaving the primary key to the database
+# - inserts the rows with multi-row INSERT ... RETURNING statements, BULK_BATCH_SIZE rows at a time,
+#   each batch in a savepoint
+# - if a batch breaks a constraint, inserts its items one at a time to find which ones did
+# - returns the new rows (201), or the conflicts keyed by each item's position (409),
+#   in which case nothing is created
+def bulk_create(model, schema):
+    json_data = request.get_json()
+    max_items = current_app.config.get("BULK_MAX_ITEMS", DEFAULT_BULK_MAX_ITEMS)
+    if not isinstance(json_data, list) or not json_data:
+        abort(400, description="Request body must be a non-empty list")
+    if len(json_data) > max_items:
+        abort(400, description=f"A bulk request can contain at most {max_items} items")
+
+    # Any invalid item raises a ValidationError listing the errors for each item
+    body_data = schema.load(json_data, many=True)
+
+    # Every row gets the same keys so they can all share one INSERT statement
+    keys = primary_key_names(model)
+    columns = [field for field in schema.Meta.fields if field not in keys]
+    rows = [{column: item.get(column) for column in columns}
+            for item in body_data]
+
+    batch_size = current_app.config.get("BULK_BATCH_SIZE", DEFAULT_BULK_BATCH_SIZE)
+    stmt = db.insert(model).returning(model)
+    new_rows = []
+    errors = {}
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        try:
+            with db.session.begin_nested():
+                new_rows.extend(db.session.scalars(
+                    stmt, batch,
+                    execution_options={"insertmanyvalues_page_size": batch_size}).all())
+        except IntegrityError as err:
+            errors.update(item_errors(stmt, batch, start) or {start: [integrity_message(err)]})
+
+    if errors:
+        db.session.rollback()
+        return {"message": errors}, 409
+
+    # Dump before committing so the new rows don't need to be reloaded afterwards
+    data = timed_dump(schema, new_rows)
+    db.session.commit()
+    return data, 201
+
+
+# This inserts the items of a failed batch one at a time, each in its own savepoint,
+# and returns the errors of the ones that break a constraint by their position in the request.
+# An item that clashes with an earlier item of the request is the one reported.
+def item_errors(stmt, batch, start):
+    errors = {}
+    for offset, row in enumerate(batch):
+        try:
+            with db.session.begin_nested():
+                db.session.scalars(stmt, [row]).all()
+        except IntegrityError as err:
+            errors[start + offset] = [integrity_message(err)]
+    return errors
+
+
+# This describes a constraint error, ie "email is required" or "Key (email)=(...) already exists."
+def integrity_message(err):
+    diag = getattr(err.orig, "diag", None)
+    if diag is None:
+        return str(err.orig)
+    if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
+        return f"{diag.column_name} is required"
+    return diag.message_detail or diag.message_primary
+
+
+# BULK UPDATE AND DELETE
+
+# These functions change or remove many rows with one set based UPDATE or DELETE
+# statement, instead of loading and changing each row in Python.
+# The rows are chosen by the request body in one of two ways:
+# - {"ids": [1, 2, 3]} picks rows by their id
+# - {"filter": {"campaign_id": 3}} picks every row matching all the given columns
+# Only the columns passed in as filters can be used, so every filter hits a known column.
+
+
+# This turns the ids or filter in the request body into a WHERE clause
+def bulk_condition(model, filters, json_data):
+    if not isinstance(json_data, dict):
+        abort(400, description="Request body must be an object")
+    ids = json_data.get("ids")
+    where = json_data.get("filter")
+    if (ids is None) == (where is None):
+        abort(400, description="Provide either ids or filter")
+
+    if ids is not None:
+        keys = inspect(model).primary_key
+        max_items = current_app.config.get("BULK_MAX_ITEMS", DEFAULT_BULK_MAX_ITEMS)
+        if len(keys) != 1:
+            abort(400, description="ids are not supported here, use a filter instead")
+        if not isinstance(ids, list) or not ids or not all(
+                isinstance(ident, int) and not isinstance(ident, bool) for ident in ids):
+            abort(400, description="ids must be a non-empty list of whole numbers")
+        if len(ids) > max_items:
+            abort(400, description=f"A bulk request can contain at most {max_items} ids")
+        return keys[0].in_(ids)
+
+    # An empty filter would match the whole table, so it is rejected
+    if not isinstance(where, dict) or not where:
+        abort(400, description="filter must be a non-empty object")
+    conditions = []
+    for name, value in where.items():
+        if name not in filters:
+            allowed = ", ".join(filters) or "nothing"
+            abort(400, description=f"Cannot filter on {name}. Allowed filters: {allowed}")
+        column = filters[name]
+        if isinstance(value, bool) or not isinstance(value, column.type.python_type):
+            abort(400, description=f"Invalid value for filter {name}")
+        conditions.append(column == value)
+    return db.and_(*conditions)
+
+
+# This updates every selected row with the values in the request body.
+# It expects {"ids": [...]} or {"filter": {...}} along with {"values": {...}}
+def bulk_update(model, schema, filters):
+    json_data = request.get_json()
+    condition = bulk_condition(model, filters, json_data)
+
+    values = json_data.get("values")
+    if not isinstance(values, dict) or not values:
+        abort(400, description="values must be a non-empty object")
+    # The same rules as a single PATCH apply, and primary keys can't be changed
+    body_data = schema.load(values, many=False, partial=True)
+    keys = primary_key_names(model)
+    body_data = {key: value for key, value in body_data.items() if key not in keys}
+    if not body_data:
+        abort(400, description="values must contain at least one field to update")
+
+    # Versioned rows move to their next version, so an If-Match taken before this update fails
+    version_id_col = inspect(model).version_id_col
+    if version_id_col is not None:
+        body_data[version_id_col.key] = version_id_col + 1
+
+    # One UPDATE ... RETURNING statement, nothing is loaded into the session first
+    stmt = db.update(model).where(condition).values(
+        **body_data).returning(*model.__table__.columns)
+    rows = db.session.execute(
+        stmt, execution_options={"synchronize_session": False}).all()
+
+    data = timed_dump(schema, [row._mapping for row in rows])
+    db.session.commit()
+    return data
+
+
+# This deletes every selected row.
+# It expects {"ids": [...]} or {"filter": {...}}
+def bulk_delete(model, schema, filters):
+    condition = bulk_condition(model, filters, request.get_json())
+
+    # One DELETE ... RETURNING statement, nothing is loaded into the session first
+    stmt = db.delete(model).where(condition).returning(*model.__table__.columns)
+    rows = db.session.execute(
+        stmt, execution_options={"synchronize_session": False}).all()
+
+    data = timed_dump(schema, [row._mapping for row in rows])
+    db.session.commit()
+    return {"message": f"{len(data)} rows were deleted successfully", "deleted": data}
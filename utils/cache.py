@@ -0,0 +1,237 @@
+import hashlib
+import threading
+
+from flask import current_app, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, inspect
+
+from init import db
+from utils.cache_backends import make_backend
+from utils.etags import collection_etag, with_cascades
+from utils.lookups import get_entity
+from utils.routing import primary_reads, replica_reads
+from utils.serializing import timed_dump
+
+# RESPONSE CACHE
+
+# This cache keeps the dumped data and ETag of single campaigns and game masters, and of
+# list responses, so repeated GETs skip the database and the dump entirely.
+# - Entries are stored in the backend chosen with CACHE_BACKEND (see utils/cache_backends.py):
+#   "memory" for each worker on its own, or "redis" to share them between all workers
+# - Entries expire after RESOURCE_CACHE_TTL seconds (0 turns the cache off), and the memory
+#   backend keeps the RESOURCE_CACHE_SIZE most recently used
+# - Every entry has tags: a row has "<table>:<id>" and "<table>:*", a list has the name of
+#   each table it reads. Committing a write invalidates the tags of what it changed
+#   (see the session events below), which drops the entries in every worker at once.
+#   The memory backend only sees the writes of its own worker, so a cached list is only
+#   used while its ETag still matches the change counters, which every worker shares
+# - Lists longer than CACHE_MAX_LIST_ITEMS rows, and streamed lists, aren't cached
+# - Entries are never stored from the replica, so a replica that is behind can't put old data
+#   under the current tag versions. Single rows are always built from the primary. Lists are
+#   built like any other read (on the replica if the request uses it), and only stored when
+#   they came from the primary, so the biggest reads still go to the replica
+# - GET /diagnostics/cache shows the hit and miss counters
+
+DEFAULT_RESOURCE_CACHE_TTL = 30
+DEFAULT_RESOURCE_CACHE_SIZE = 1024
+DEFAULT_CACHE_MAX_LIST_ITEMS = 1000
+
+
+# This keeps the cache counters for this worker
+class CacheStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def record(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def record_invalidations(self, count):
+        with self.lock:
+            self.invalidations += count
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "invalidated_tags": self.invalidations,
+            }
+
+
+cache_stats = CacheStats()
+
+
+# This sets up the backend for the app, from its config.
+# Redis keeps each tag for twice the entries' ttl, so a tag never expires before its entries.
+def init_cache(app):
+    app.extensions["cache"] = make_backend(
+        app.config.get("CACHE_BACKEND", "memory"),
+        app.config.get("RESOURCE_CACHE_SIZE", DEFAULT_RESOURCE_CACHE_SIZE),
+        app.config.get("CACHE_URL"),
+        tag_ttl=2 * max(app.config.get("RESOURCE_CACHE_TTL", DEFAULT_RESOURCE_CACHE_TTL), 1))
+
+
+# This returns the app's backend, or None if the cache is off
+def get_backend():
+    if current_app.config.get("RESOURCE_CACHE_TTL", DEFAULT_RESOURCE_CACHE_TTL) <= 0:
+        return None
+    return current_app.extensions.get("cache")
+
+
+# This returns the cached value for the key, or builds and stores it.
+# The tag versions are read before building, so if a write commits while the value
+# is being built, the stored entry already belongs to the old versions and is never used.
+# fresh can turn down a hit whose value is out of date for a reason the tags don't cover.
+# With from_primary the value is built from the primary, otherwise it's only stored if
+# none of it was read from the replica.
+def cached(key, tags, build, storable=lambda value: True, fresh=lambda value: True,
+           from_primary=False):
+    backend = get_backend()
+    if backend is None:
+        return build()
+
+    versions = backend.tag_versions(tags)
+    if None in versions.values():
+        # The backend can't be reached, so the cache is skipped
+        return build()
+    entry = backend.get(key)
+    if entry is not None and entry["tags"] == versions and fresh(entry["value"]):
+        cache_stats.record(hit=True)
+        return entry["value"]
+
+    cache_stats.record(hit=False)
+    if from_primary:
+        with primary_reads(db.session):
+            value = build()
+    else:
+        before = replica_reads(db.session)
+        value = build()
+        if replica_reads(db.session) != before:
+            return value
+    if value is not None and storable(value):
+        ttl = current_app.config.get("RESOURCE_CACHE_TTL", DEFAULT_RESOURCE_CACHE_TTL)
+        backend.set(key, {"value": value, "tags": versions}, ttl)
+    return value
+
+
+# This returns the tag of a single row
+def row_tag(table_name, identity):
+    return f"{table_name}:{','.join(str(value) for value in identity)}"
+
+
+# This returns the dumped data and ETag of a row, from the cache if it's there.
+# It returns None if there is no such row.
+def cached_entity(model, ident, schema, etag_for):
+    table_name = model.__table__.name
+    identity = ident if isinstance(ident, tuple) else (ident,)
+
+    def build():
+        entity = get_entity(model, ident)
+        if entity is None:
+            return None
+        return [timed_dump(schema, entity), etag_for(entity)]
+
+    return cached(f"row:{row_tag(table_name, identity)}",
+                  [row_tag(table_name, identity), f"{table_name}:*"], build, from_primary=True)
+
+
+# This returns the data and ETag of a list response, from the cache if it's there.
+# The url and the type of response asked for both change what the list looks like.
+def cached_list(table_names, build):
+    key = hashlib.sha1(repr((request.full_path, request.accept_mimetypes.to_header()))
+                       .encode()).hexdigest()
+    max_items = current_app.config.get("CACHE_MAX_LIST_ITEMS", DEFAULT_CACHE_MAX_LIST_ITEMS)
+
+    # A page is a dict with its rows under "data". A 304 has no data to store.
+    def storable(value):
+        data = value[0]
+        if data is None:
+            return False
+        rows = data["data"] if isinstance(data, dict) else data
+        return len(rows) <= max_items
+
+    # Reading the counters is one small query, instead of the list's query and dump
+    def fresh(value):
+        return get_backend().shared or value[1] == collection_etag(table_names)
+
+    return cached(f"list:{key}", list(table_names), build, storable, fresh)
+
+
+# INVALIDATING ON COMMIT
+
+# These session events remember the tags of what each transaction writes, and
+# invalidate them once it commits.
+# - Adding, changing or deleting an object invalidates its row and its table's lists
+# - A write made with a statement (the bulk and fast update routes and upserts) can change
+#   any row of its table, so it invalidates all of the table's rows and lists
+# - Deletes also invalidate all the rows and lists of the tables that cascade from them
+
+
+# This returns the tags that cover every row and list of the given tables
+def table_tags(table_names):
+    return {tag for name in table_names for tag in (name, f"{name}:*")}
+
+
+# Writes made through the unit of work (add, change or delete an object, then commit)
+@event.listens_for(Session, "after_flush")
+def remember_flushed_tags(session, flush_context):
+    tags = session.info.setdefault("cache_tags", set())
+    for entity in session.new | session.dirty | session.deleted:
+        state = inspect(entity)
+        table_name = state.mapper.local_table.name
+        tags.add(table_name)
+        if state.identity is not None:
+            tags.add(row_tag(table_name, state.identity))
+    deleted = {inspect(entity).mapper.local_table.name for entity in session.deleted}
+    tags.update(table_tags(with_cascades(deleted) - deleted))
+
+
+# Writes made with a statement
+@event.listens_for(Session, "do_orm_execute")
+def remember_statement_tags(orm_execute_state):
+    if orm_execute_state.is_select or not hasattr(orm_execute_state.statement, "table"):
+        return
+    table_name = orm_execute_state.statement.table.name
+    table_names = with_cascades([table_name]) if orm_execute_state.is_delete else {table_name}
+    orm_execute_state.session.info.setdefault("cache_tags", set()).update(table_tags(table_names))
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_committed_tags(session):
+    # A released savepoint isn't committed yet
+    if session.in_nested_transaction():
+        return
+    tags = session.info.pop("cache_tags", None)
+    if not tags:
+        return
+    backend = current_app.extensions.get("cache")
+    if backend is not None:
+        backend.invalidate(tags)
+        cache_stats.record_invalidations(len(tags))
+
+
+# Nothing was written, so nothing needs invalidating
+@event.listens_for(Session, "after_rollback")
+def forget_rolled_back_tags(session):
+    if session.in_nested_transaction():
+        return
+    session.info.pop("cache_tags", None)
+
+
+# This returns the cache settings and counters for this worker
+def cache_status():
+    backend = current_app.extensions.get("cache")
+    status = {"ttl": current_app.config.get("RESOURCE_CACHE_TTL", DEFAULT_RESOURCE_CACHE_TTL)}
+    if backend is not None:
+        status.update(backend.status())
+    status.update(cache_stats.snapshot())
+    return status
@@ -0,0 +1,218 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# redis is optional, it's only needed for CACHE_BACKEND=redis
+try:
+    import redis
+except ImportError:
+    redis = None
+
+log = logging.getLogger(__name__)
+
+# CACHE BACKENDS
+
+# These classes store the cached responses (see utils/cache.py).
+# - MemoryBackend keeps them in the worker, in a least recently used dict with expiry.
+#   Its tags are least recently used too, so reading ids that don't exist can't grow it forever
+# - RedisBackend keeps them in Redis (or anything that speaks its protocol), so every
+#   worker on every node shares the same entries and sees the same invalidations
+# Both store entries by key, and keep a version for each tag. An entry remembers the
+# versions of its tags when it was stored, and only counts while they are unchanged,
+# so invalidating a tag (giving it a new version) drops every entry that has it.
+# Dropping a tag is always safe: it comes back with a new version, so its old entries just miss.
+#
+# A backend has a `shared` attribute, which says if every worker sees its entries and
+# invalidations, and these methods:
+# - get(key): the stored value, or None
+# - set(key, value, ttl): store the value for ttl seconds
+# - tag_versions(tags): the current version of each tag, giving new tags their first version
+# - invalidate(tags): give each existing tag a new version
+# - status(): a dict describing the backend
+
+# The backends that can be set with CACHE_BACKEND
+CACHE_BACKENDS = ("memory", "redis")
+
+# How many tags the memory backend keeps for each entry it can hold.
+# A row has 2 tags and a list 1 or 2, so this leaves room for every entry's tags.
+TAGS_PER_ENTRY = 4
+
+
+# This returns a version no tag has had before, so a tag that was evicted (or
+# lost in a restart) and created again can't match entries stored under its old version
+def new_version():
+    return uuid.uuid4().hex
+
+
+class MemoryBackend:
+    # Another worker's writes never invalidate this worker's entries
+    shared = False
+
+    def __init__(self, max_entries):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.max_tags = max_entries * TAGS_PER_ENTRY
+        self.entries = OrderedDict()
+        self.tags = OrderedDict()
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= now:
+                del self.entries[key]
+                self.expired += 1
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def tag_versions(self, tags):
+        with self.lock:
+            versions = {}
+            for tag in tags:
+                versions[tag] = self.tags.setdefault(tag, new_version())
+                self.tags.move_to_end(tag)
+            while len(self.tags) > self.max_tags:
+                self.tags.popitem(last=False)
+            return versions
+
+    def invalidate(self, tags):
+        with self.lock:
+            # A tag that was never read has no entries to drop
+            for tag in tags:
+                if tag in self.tags:
+                    self.tags[tag] = new_version()
+
+    def status(self):
+        with self.lock:
+            return {
+                "backend": "memory",
+                "max_entries": self.max_entries,
+                "entries": len(self.entries),
+                "tags": len(self.tags),
+                "max_tags": self.max_tags,
+                "expired": self.expired,
+                "evictions": self.evictions,
+            }
+
+
+# This stores entries in Redis as JSON. The client only needs get, set and mget
+# (ie redis.Redis, or a fake with the same methods for trying it out locally).
+# Tags expire after tag_ttl seconds, which should be at least as long as the entries' ttl.
+# If Redis can't be reached, reads are misses and the request carries on without the cache.
+# Invalidations that fail are kept and retried, and until they succeed this worker doesn't
+# use the cache, so an entry a write should have dropped isn't served once Redis is back.
+class RedisBackend:
+    shared = True
+
+    def __init__(self, client, prefix="rpg:", tag_ttl=60):
+        self.client = client
+        self.prefix = prefix
+        self.tag_ttl_ms = max(1, int(tag_ttl * 1000))
+        self.errors = (redis.RedisError, OSError) if redis is not None else (OSError,)
+        # The tags this worker couldn't invalidate, which are retried before the cache is used again
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def entry_key(self, key):
+        return f"{self.prefix}entry:{key}"
+
+    def tag_key(self, tag):
+        return f"{self.prefix}tag:{tag}"
+
+    def get(self, key):
+        try:
+            raw = self.client.get(self.entry_key(key))
+        except self.errors as err:
+            log.warning("Cache read failed: %s", err)
+            return None
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        try:
+            self.client.set(self.entry_key(key), json.dumps(value, separators=(",", ":")),
+                            px=max(1, int(ttl * 1000)))
+        except self.errors as err:
+            log.warning("Cache write failed: %s", err)
+
+    def tag_versions(self, tags):
+        tags = list(tags)
+        if self.pending and not self.retry_invalidations():
+            # Entries of the tags it couldn't invalidate would be out of date, so nothing is used
+            return {tag: None for tag in tags}
+        keys = [self.tag_key(tag) for tag in tags]
+        try:
+            versions = self.client.mget(keys)
+            missing = [key for key, version in zip(keys, versions) if version is None]
+            if missing:
+                # nx, so if another worker created the tag at the same time, both use its version
+                for key in missing:
+                    self.client.set(key, new_version(), nx=True, px=self.tag_ttl_ms)
+                versions = self.client.mget(keys)
+        except self.errors as err:
+            log.warning("Cache read failed: %s", err)
+            # Versions no entry has, so nothing is read or stored while Redis is down
+            return {tag: None for tag in tags}
+        return {tag: decode(version) for tag, version in zip(tags, versions)}
+
+    def invalidate(self, tags):
+        with self.lock:
+            self.pending.update(tags)
+        self.retry_invalidations()
+
+    # This gives the pending tags new versions, keeping the ones that fail.
+    # It returns True once none are left.
+    def retry_invalidations(self):
+        with self.lock:
+            tags, self.pending = self.pending, set()
+        failed = set()
+        # xx, so tags that were never read aren't created
+        for tag in tags:
+            try:
+                self.client.set(self.tag_key(tag), new_version(), xx=True, px=self.tag_ttl_ms)
+            except self.errors as err:
+                log.error("Cache invalidation of %s failed: %s", tag, err)
+                failed.add(tag)
+        with self.lock:
+            self.pending.update(failed)
+            return not self.pending
+
+    def status(self):
+        with self.lock:
+            pending = len(self.pending)
+        return {"backend": "redis", "prefix": self.prefix, "tag_ttl": self.tag_ttl_ms / 1000,
+                "pending_invalidations": pending}
+
+
+# Redis returns bytes unless the client was made with decode_responses
+def decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+# This builds the backend chosen with CACHE_BACKEND
+def make_backend(name, max_entries, url=None, tag_ttl=60):
+    if name not in CACHE_BACKENDS:
+        raise ValueError(f"CACHE_BACKEND must be one of {', '.join(CACHE_BACKENDS)}")
+    if name == "memory":
+        return MemoryBackend(max_entries)
+    if redis is None:
+        raise RuntimeError("CACHE_BACKEND is redis, but the redis package isn't installed")
+    if not url:
+        raise ValueError("CACHE_BACKEND is redis, but CACHE_URL isn't set")
+    return RedisBackend(redis.Redis.from_url(url, socket_timeout=0.5), tag_ttl=tag_ttl)
@@ -0,0 +1,115 @@
+import zlib
+
+from flask import current_app, request
+
+# brotli is optional, without it responses are only compressed with gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# RESPONSE COMPRESSION
+
+# This after_request hook compresses JSON responses for clients that accept it,
+# which shrinks big lists many times over (their keys repeat on every row).
+# To do this, the application:
+# - picks br or gzip from the client's Accept-Encoding (br only if brotli is installed)
+# - skips responses below COMPRESS_MIN_SIZE bytes, so small single rows aren't slowed down
+# - compresses streamed (NDJSON) lists as they are sent, instead of waiting for the end,
+#   and flushes the compressor every COMPRESS_FLUSH_SIZE bytes of rows so the client gets
+#   rows while the list is still being read (otherwise the compressor holds on to them)
+# - marks the ETag as weak, since the bytes differ from the uncompressed response,
+#   and adds Vary: Accept-Encoding so caches keep the versions apart
+
+# The response types worth compressing
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson"}
+
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+DEFAULT_COMPRESS_LEVEL = 6
+# Brotli's higher qualities are too slow for responses made on every request
+DEFAULT_COMPRESS_BROTLI_QUALITY = 4
+# Each flush makes the output a little bigger, so streams are flushed every so many bytes, not every row
+DEFAULT_COMPRESS_FLUSH_SIZE = 64 * 1024
+
+
+# This picks the encoding to use, or None if the client doesn't accept one we have
+def choose_encoding():
+    encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(encodings)
+
+
+# This returns a compressor with .compress(data) and .flush(mode) for the encoding
+def make_compressor(encoding):
+    config = current_app.config
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=config.get(
+            "COMPRESS_BROTLI_QUALITY", DEFAULT_COMPRESS_BROTLI_QUALITY))
+        return BrotliCompressor(compressor)
+    # wbits 31 gives the gzip header and trailer
+    return zlib.compressobj(config.get("COMPRESS_LEVEL", DEFAULT_COMPRESS_LEVEL),
+                            zlib.DEFLATED, 31)
+
+
+# This gives brotli's compressor the same methods as zlib's
+class BrotliCompressor:
+    def __init__(self, compressor):
+        self.compressor = compressor
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    # Z_SYNC_FLUSH sends everything compressed so far, Z_FINISH ends the stream
+    def flush(self, mode=zlib.Z_FINISH):
+        if mode == zlib.Z_FINISH:
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+# This compresses each chunk of a streamed response as it is sent,
+# sending what it has every flush_size bytes of chunks
+def compress_stream(chunks, compressor, flush_size):
+    pending = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= flush_size:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# This compresses the response, when it's worth it and the client accepts it
+def compress_response(response):
+    if not current_app.config.get("COMPRESSION", True):
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or not 200 <= response.status_code < 300:
+        return response
+    if response.status_code == 204 or "Content-Encoding" in response.headers:
+        return response
+
+    # The response depends on Accept-Encoding whether or not it ends up compressed
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        flush_size = current_app.config.get("COMPRESS_FLUSH_SIZE", DEFAULT_COMPRESS_FLUSH_SIZE)
+        response.response = compress_stream(response.response, make_compressor(encoding), flush_size)
+        response.headers.pop("Content-Length", None)
+    else:
+        min_size = current_app.config.get("COMPRESS_MIN_SIZE", DEFAULT_COMPRESS_MIN_SIZE)
+        if response.content_length is None or response.content_length < min_size:
+            return response
+        compressor = make_compressor(encoding)
+        response.set_data(compressor.compress(response.get_data()) + compressor.flush())
+
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,170 @@
+import hashlib
+
+from flask import make_response, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, inspect
+from sqlalchemy.sql.util import find_tables
+
+from init import db
+from models.change_counters import ChangeCounter
+
+# ETAGS AND CONDITIONAL GET
+
+# These functions let clients that poll the API skip downloading data that hasn't changed.
+# Every GET response carries an ETag, and a request sending that ETag back in
+# If-None-Match gets 304 Not Modified without the rows being dumped again.
+# - A single row's ETag is a hash of its identity and version_id (or its column values
+#   for tables without one)
+# - A list's ETag is a hash of the change counters of the tables it reads, plus the url
+#   (so each filter, sort and page has its own ETag)
+# The change counters live in the change_counters table and are bumped by every write
+# as it commits, so a list's ETag changes whenever its data can.
+
+
+# This builds an ETag value from a list of parts
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+# This builds the ETag for a single row (no dump needed).
+# Versioned rows use their version_id, which changes on every UPDATE, so the ETag
+# is also what a client sends back in If-Match to update the row.
+def row_etag(entity):
+    state = inspect(entity)
+    mapper = state.mapper
+    if mapper.version_id_col is not None:
+        version = mapper.get_property_by_column(mapper.version_id_col).key
+        return make_etag(mapper.local_table.name, state.identity, getattr(entity, version))
+    values = tuple(getattr(entity, column.key) for column in mapper.column_attrs)
+    return make_etag(mapper.local_table.name, values)
+
+
+# This finds the names of the tables a statement reads from
+def statement_tables(stmt):
+    return sorted({table.name for from_ in stmt.get_final_froms()
+                   for table in find_tables(from_)})
+
+
+# This builds the ETag for a list from the change counters of the given tables.
+# It returns None (no ETag) if a table has no counter yet, ie before `flask db create` has added it.
+def collection_etag(table_names):
+    counters = db.session.execute(
+        db.select(ChangeCounter.table_name, ChangeCounter.version).where(
+            ChangeCounter.table_name.in_(table_names))).all()
+    if len(counters) != len(set(table_names)):
+        return None
+    # The url and the type of response asked for both change what the list looks like
+    return make_etag(sorted(counters), request.full_path,
+                     request.accept_mimetypes.to_header())
+
+
+# This checks if the client already has the current version
+def is_not_modified(etag):
+    return etag is not None and request.if_none_match.contains_weak(etag)
+
+
+# This checks an update's If-Match header against the row it wants to change.
+# Requests without If-Match are always allowed, so existing clients keep working.
+def is_precondition_failed(entity):
+    return bool(request.if_match) and not request.if_match.contains_weak(row_etag(entity))
+
+
+# This returns 304 Not Modified with no body
+def not_modified(etag):
+    response = make_response("", 304)
+    response.set_etag(etag)
+    return response
+
+
+# This returns the data with its ETag attached
+def with_etag(data, etag):
+    response = make_response(data)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+# BUMPING THE CHANGE COUNTERS
+
+# These session events remember every table a transaction writes to, and bump their
+# counters as it commits. Deleting a row also bumps the tables that cascade from it
+# (ON DELETE CASCADE), since the database removes their rows too.
+# The bump is the last statement before COMMIT, on the session's own connection:
+# - it commits (or rolls back) with the data, so a list's ETag never misses a write
+# - it needs no second connection from the pool
+# - the counter rows are only locked for the COMMIT, not for the whole request, so
+#   writers to the same table don't queue behind each other for long
+# The counters are updated in table name order, so two transactions never lock them in
+# opposite orders and deadlock.
+
+
+# This adds the tables whose rows are deleted along with rows of the given tables
+def with_cascades(table_names):
+    names = set(table_names)
+    # sorted_tables lists parents before children, so chains of cascades are followed
+    for table in db.metadata.sorted_tables:
+        for foreign_key in table.foreign_keys:
+            if foreign_key.ondelete == "CASCADE" and foreign_key.column.table.name in names:
+                names.add(table.name)
+    return names
+
+
+# This remembers the tables the session's current transaction has written to
+def remember_changed_tables(session, table_names):
+    session.info.setdefault("changed_tables", set()).update(table_names)
+
+
+# This adds one to the counters of the given tables, in the session's transaction.
+# It runs on the connection directly, so the statement isn't counted as a write itself.
+def bump_counters(session, table_names):
+    table_names = sorted(set(table_names) - {ChangeCounter.__tablename__})
+    if not table_names:
+        return
+    stmt = db.update(ChangeCounter.__table__).where(
+        ChangeCounter.table_name == db.bindparam("counter_table")).values(
+        version=ChangeCounter.version + 1)
+    connection = session.connection(bind_arguments={"mapper": ChangeCounter})
+    connection.execute(stmt, [{"counter_table": name} for name in table_names])
+
+
+# Writes made through the unit of work (add, change or delete an object, then commit)
+@event.listens_for(Session, "after_flush")
+def remember_flushed_tables(session, flush_context):
+    written = {inspect(entity).mapper.local_table.name
+               for entity in session.new | session.dirty}
+    deleted = {inspect(entity).mapper.local_table.name for entity in session.deleted}
+    remember_changed_tables(session, written | with_cascades(deleted))
+
+
+# Writes made with a statement (the bulk routes and other INSERT, UPDATE or DELETE statements)
+@event.listens_for(Session, "do_orm_execute")
+def remember_statement_tables(orm_execute_state):
+    if orm_execute_state.is_select or not hasattr(orm_execute_state.statement, "table"):
+        return
+    table_name = orm_execute_state.statement.table.name
+    if orm_execute_state.is_delete:
+        remember_changed_tables(orm_execute_state.session, with_cascades([table_name]))
+    else:
+        remember_changed_tables(orm_execute_state.session, [table_name])
+
+
+# The session flushes after before_commit, so it is flushed here first to see every write.
+# Releasing a savepoint fires before_commit too, but nothing is visible to others until
+# the whole transaction commits, so those are skipped.
+@event.listens_for(Session, "before_commit")
+def bump_committed_tables(session):
+    if session.in_nested_transaction():
+        return
+    session.flush()
+    table_names = session.info.pop("changed_tables", None)
+    if table_names:
+        bump_counters(session, table_names)
+
+
+# Nothing was written, so nothing needs bumping.
+# Rolling back a savepoint keeps the writes from before it, so the tables are kept
+@event.listens_for(Session, "after_rollback")
+def forget_rolled_back_tables(session):
+    if session.in_nested_transaction():
+        return
+    session.info.pop("changed_tables", None)
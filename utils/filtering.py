@@ -0,0 +1,81 @@
+from flask import abort, request
+from sqlalchemy import tuple_
+
+# FILTERING AND SORTING
+
+# These functions turn query string parameters on the list endpoints into SQL.
+# Each controller lists the columns that can be filtered or sorted on, so every
+# WHERE and ORDER BY the client can ask for uses a known (indexed) column.
+# To do this, the application:
+# - reads ?<column>=<value> for each allowed filter (repeat it to match any of several values)
+# - reads ?sort=<column> or ?sort=-<column> for descending order
+# - adds the matching WHERE and ORDER BY clauses to the statement
+
+
+# This adds a WHERE clause for every allowed filter in the query string
+def apply_filters(stmt, filters):
+    for name, column in filters.items():
+        values = request.args.getlist(name)
+        if not values:
+            continue
+        try:
+            values = [column.type.python_type(value) for value in values]
+        except ValueError:
+            abort(400, description=f"Invalid value for filter {name}")
+        if len(values) == 1:
+            stmt = stmt.where(column == values[0])
+        else:
+            stmt = stmt.where(column.in_(values))
+    return stmt
+
+
+# This holds the columns a list is ordered by and its direction.
+# The primary key always comes last so that every row has a unique position,
+# which lets the pagination cursor pick up exactly where the last page ended.
+class SortOrder:
+    def __init__(self, columns, descending=False):
+        self.columns = columns
+        self.descending = descending
+
+    # The ORDER BY clauses for the statement
+    def clauses(self):
+        if self.descending:
+            return [column.desc() for column in self.columns]
+        return list(self.columns)
+
+    # The WHERE clause for rows that come after the given key values
+    def after(self, values):
+        if len(self.columns) == 1:
+            left, right = self.columns[0], values[0]
+        else:
+            left, right = tuple_(*self.columns), tuple_(*values)
+        return left < right if self.descending else left > right
+
+
+# This reads ?sort= and returns the order for the list.
+# Sort columns must be NOT NULL, because a NULL can't be compared with a cursor value.
+def get_sort_order(sorts, primary_key):
+    sort = request.args.get("sort")
+    if not sort:
+        return SortOrder(primary_key)
+
+    descending = sort.startswith("-")
+    name = sort.lstrip("-")
+    if name not in sorts:
+        allowed = ", ".join(sorts) or "nothing"
+        abort(400, description=f"Cannot sort on {name}. Allowed sorts: {allowed}")
+
+    column = sorts[name]
+    columns = [column] + [key for key in primary_key if key is not column]
+    return SortOrder(columns, descending)
+
+
+# This reads ?expand=<name>,<name> and returns the names asked for,
+# rejecting anything that isn't in the allowed list
+def get_expand(expands):
+    names = [name for name in request.args.get("expand", "").split(",") if name]
+    for name in names:
+        if name not in expands:
+            allowed = ", ".join(expands)
+            abort(400, description=f"Cannot expand {name}. Allowed expands: {allowed}")
+    return names
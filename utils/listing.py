@@ -0,0 +1,45 @@
+from utils.cache import cached_list
+from utils.etags import collection_etag, is_not_modified, not_modified, statement_tables, with_etag
+from utils.pagination import is_paginated, paginate
+from utils.serializing import get_serializer
+from utils.streaming import stream_rows, wants_stream
+
+# LIST RESPONSES
+
+# This function returns a list statement in whichever form the client asked for.
+# To do this, the application:
+# - returns the list from the response cache when it's there (lists aren't streamed from it)
+# - otherwise works out the list's ETag and returns 304 Not Modified if the client already
+#   has it, before reading any rows
+# - streams the rows as NDJSON if asked (?stream=1 or Accept: application/x-ndjson)
+# - returns one page and a cursor if asked (?limit= or ?after=)
+# - otherwise returns the whole list in the given order
+# The rows are fetched and dumped by the list's serialiser (see utils/serializing.py).
+
+
+def list_response(stmt, order, schema):
+    if wants_stream():
+        etag = collection_etag(statement_tables(stmt))
+        if is_not_modified(etag):
+            return not_modified(etag)
+        return with_etag(stream_rows(stmt, order, get_serializer(stmt, order, schema)), etag)
+
+    # The ETag is checked before the rows are read, so a 304 never runs the list query.
+    # A cached list already has its ETag, so a hit needs no query at all.
+    def build():
+        etag = collection_etag(statement_tables(stmt))
+        if is_not_modified(etag):
+            # No data, which isn't stored in the cache
+            return [None, etag]
+        serializer = get_serializer(stmt, order, schema)
+        if is_paginated():
+            data = paginate(stmt, order, serializer)
+        else:
+            # The serialiser provides the rows, which .dump converts into JSON
+            data = serializer.dump(serializer.rows(stmt.order_by(*order.clauses())).all())
+        return [data, etag]
+
+    data, etag = cached_list(statement_tables(stmt), build)
+    if is_not_modified(etag):
+        return not_modified(etag)
+    return with_etag(data, etag)
@@ -0,0 +1,43 @@
+from flask import current_app, g, has_app_context
+from sqlalchemy import event, inspect
+from flask_sqlalchemy.session import Session
+
+from init import db
+
+# PRIMARY KEY LOOKUPS
+
+# These functions find a single row by its primary key.
+# Session.get checks the session's identity map first, so a row that has already
+# been loaded in this request is returned without going back to the database.
+# On top of that, a per-request memo remembers misses as well as hits so that
+# validating, updating and dumping the same row costs one round trip.
+# To do this, the application:
+# - checks the request memo (if turned on with ENTITY_LOOKUP_MEMO)
+# - otherwise asks the session for the row with Session.get
+# - remembers the result until the session next flushes
+
+
+# This finds a row by its primary key, or returns None if it doesn't exist.
+# Composite keys are passed as a tuple in the order they are declared, ie (player_id, campaign_id)
+def get_entity(model, ident):
+    if not current_app.config.get("ENTITY_LOOKUP_MEMO", True):
+        return db.session.get(model, ident)
+
+    memo = g.setdefault("entity_memo", {})
+    key = (model, ident)
+    if key in memo:
+        entity = memo[key]
+        # Deleted or detached rows are looked up again rather than reused
+        if entity is None or not (inspect(entity).deleted or inspect(entity).detached):
+            return entity
+
+    entity = db.session.get(model, ident)
+    memo[key] = entity
+    return entity
+
+
+# A flush can create or delete rows, so anything remembered before it may be out of date
+@event.listens_for(Session, "after_flush")
+def clear_entity_memo(session, flush_context):
+    if has_app_context():
+        g.pop("entity_memo", None)
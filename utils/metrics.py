@@ -0,0 +1,356 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import weakref
+
+from flask import current_app, g, request
+
+from init import db
+from utils.cache import cache_stats
+from utils.pool import pool_statuses
+
+log = logging.getLogger(__name__)
+
+# PROMETHEUS METRICS
+
+# These functions count every request for GET /metrics, in Prometheus' text format.
+# For each blueprint (campaigns, characters, players, ...) and HTTP method it exports:
+# - rpg_http_requests_total: how many requests there were, for each status code
+# - rpg_http_request_duration_seconds: a histogram of how long they took
+# Along with the connection pool (rpg_db_pool_*, by engine: primary or replica) and
+# response cache (rpg_cache_*) counters.
+#
+# Counting is sharded per thread: each thread adds to its own dicts without a lock, and
+# the shards are only added together when /metrics is read. When a thread stops, its shard
+# is added to a retired total and dropped, so a server that starts new threads (gunicorn's
+# gthread workers, the dev server's thread per request) doesn't keep a shard for each one.
+#
+# Gunicorn runs several worker processes, and Prometheus only reaches one of them per scrape.
+# When METRICS_DIR is set, each worker writes its totals to a file in that folder (at most
+# every METRICS_FLUSH_INTERVAL seconds), and /metrics adds up the files of every worker.
+# - Files of workers that have stopped are kept, so the counters never go backwards
+# - The pool gauges (connections in use, ...) only count workers that are still running
+# - Clear the folder before starting gunicorn, so the totals start again from zero
+
+# The upper bounds (in seconds) of the histogram buckets, which are Prometheus' defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+DEFAULT_METRICS_FLUSH_INTERVAL = 1.0
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# This keeps the request counters of this worker, in one shard for each thread
+class RequestMetrics:
+    def __init__(self):
+        self.local = threading.local()
+        # The lock is only taken when a thread makes or retires its shard, and when they are read
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = new_shard()
+
+    def shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = new_shard()
+            # The owner is only kept by this thread's local, so it is freed when the thread stops
+            owner = self.local.owner = ShardOwner()
+            with self.lock:
+                self.shards.append(shard)
+            weakref.finalize(owner, self.retire, shard)
+        return shard
+
+    # This adds the shard of a stopped thread to the retired total
+    def retire(self, shard):
+        with self.lock:
+            self.shards = [other for other in self.shards if other is not shard]
+            add_shard(self.retired["requests"], self.retired["latency"], shard)
+
+    def observe(self, blueprint, method, status, seconds):
+        shard = self.shard()
+        requests = shard["requests"]
+        key = (blueprint, method, status)
+        requests[key] = requests.get(key, 0) + 1
+
+        # Each series is the count of each bucket, then the sum of the durations
+        latency = shard["latency"]
+        series = latency.get((blueprint, method))
+        if series is None:
+            series = latency[(blueprint, method)] = [0] * len(LATENCY_BUCKETS) + [0.0]
+        series[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        series[-1] += seconds
+
+    # This adds the shards together, as lists of [labels, value] so they can be saved as JSON
+    def totals(self):
+        requests = {}
+        latency = {}
+        with self.lock:
+            shards = list(self.shards)
+            add_shard(requests, latency, self.retired)
+        for shard in shards:
+            add_shard(requests, latency, shard)
+        return {
+            "requests": [[list(key), count] for key, count in requests.items()],
+            "latency": [[list(key), series] for key, series in latency.items()],
+        }
+
+
+class ShardOwner:
+    pass
+
+
+def new_shard():
+    return {"requests": {}, "latency": {}}
+
+
+# This adds a shard's counters to the given totals.
+# Copying a dict or list doesn't let go of the GIL, so the copies are whole even
+# though the shard's thread carries on counting.
+def add_shard(requests, latency, shard):
+    for key, count in shard["requests"].copy().items():
+        requests[key] = requests.get(key, 0) + count
+    for key, series in shard["latency"].copy().items():
+        total = latency.setdefault(key, [0] * len(series))
+        for index, value in enumerate(list(series)):
+            total[index] += value
+
+
+request_metrics = RequestMetrics()
+
+
+# This starts timing the request
+def start_request_timer():
+    g.metrics_start = time.perf_counter()
+
+
+# This counts the request once its response is ready (including errors)
+def count_request(response):
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        request_metrics.observe(request.blueprint or "unmatched", request.method,
+                                str(response.status_code), time.perf_counter() - start)
+        if current_app.config.get("METRICS_DIR"):
+            metrics_files.maybe_flush()
+    return response
+
+
+# This returns everything this worker exports: its request counters and its pool and cache stats
+def worker_totals():
+    totals = request_metrics.totals()
+    totals["pool"] = pool_statuses(db.engines)
+    totals["cache"] = cache_stats.snapshot()
+    return totals
+
+
+# MULTIPROCESS FILES
+
+# This writes this worker's totals to METRICS_DIR, and reads the totals of every worker.
+# A worker's file is named after its process id and a random token, so a new worker
+# that gets the process id of a stopped one doesn't overwrite its counts.
+class MetricsFiles:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_flush = 0.0
+        self.pid = None
+        self.name = None
+
+    def file_name(self):
+        # A worker forked from the process that made the app needs a file of its own
+        pid = os.getpid()
+        if pid != self.pid:
+            self.pid = pid
+            self.name = f"metrics-{pid}-{uuid.uuid4().hex[:8]}.json"
+        return self.name
+
+    # Flushes if the interval has passed. If another thread is already flushing this one
+    # moves on instead of waiting.
+    def maybe_flush(self):
+        interval = current_app.config.get("METRICS_FLUSH_INTERVAL", DEFAULT_METRICS_FLUSH_INTERVAL)
+        if time.monotonic() - self.last_flush < interval:
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.flush()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        directory = current_app.config["METRICS_DIR"]
+        totals = worker_totals()
+        totals["pid"] = os.getpid()
+        path = os.path.join(directory, self.file_name())
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Written to a temporary file first, so a scrape never reads half a file
+            with open(f"{path}.tmp", "w") as file:
+                json.dump(totals, file)
+            os.replace(f"{path}.tmp", path)
+        except OSError as err:
+            log.warning("Could not write the metrics to %s: %s", path, err)
+        self.last_flush = time.monotonic()
+
+    # This returns the totals of every worker that has written a file
+    def read_all(self):
+        directory = current_app.config["METRICS_DIR"]
+        with self.lock:
+            self.flush()
+        workers = []
+        for name in os.listdir(directory):
+            if not (name.startswith("metrics-") and name.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as file:
+                    workers.append(json.load(file))
+            except (OSError, ValueError) as err:
+                log.warning("Could not read the metrics in %s: %s", name, err)
+        return workers
+
+
+metrics_files = MetricsFiles()
+
+
+# This returns whether a worker (on this machine) is still running
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# EXPORTING
+
+# This adds up the totals of several workers
+def combine(workers):
+    requests = {}
+    latency = {}
+    counters = {"hits": 0, "misses": 0, "invalidated_tags": 0}
+    # The pool counters and gauges, by engine
+    pool_counters = {}
+    gauges = {}
+    for worker in workers:
+        for labels, count in worker["requests"]:
+            requests[tuple(labels)] = requests.get(tuple(labels), 0) + count
+        for labels, series in worker["latency"]:
+            total = latency.setdefault(tuple(labels), [0] * len(series))
+            for index, value in enumerate(series):
+                total[index] += value
+        cache = worker["cache"]
+        for name in ("hits", "misses", "invalidated_tags"):
+            counters[name] += cache[name]
+        running = "pid" not in worker or is_running(worker["pid"])
+        for engine, pool in worker["pool"].items():
+            totals = pool_counters.setdefault(
+                engine, {"checkouts": 0, "timeouts": 0, "wait_ms_total": 0.0})
+            for name in totals:
+                totals[name] += pool[name]
+            if running:
+                engine_gauges = gauges.setdefault(engine, {})
+                for name in ("size", "checked_in", "checked_out", "overflow"):
+                    if name in pool:
+                        engine_gauges[name] = engine_gauges.get(name, 0) + pool[name]
+    return requests, latency, counters, pool_counters, gauges
+
+
+# This formats a label set, ie {blueprint="campaigns",method="GET"}
+def format_labels(names, values):
+    pairs = ",".join(f'{name}="{escape(str(value))}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# This formats a number, with Prometheus' spelling of infinity
+def format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# This returns the metrics of the given workers in Prometheus' text format
+def render(workers):
+    requests, latency, counters, pool_counters, gauges = combine(workers)
+    lines = []
+
+    def metric(name, kind, description):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    metric("rpg_http_requests_total", "counter", "Requests handled, by blueprint, method and status.")
+    for labels, count in sorted(requests.items()):
+        lines.append(f"rpg_http_requests_total"
+                     f"{format_labels(('blueprint', 'method', 'status'), labels)} {count}")
+
+    metric("rpg_http_request_duration_seconds", "histogram",
+           "How long requests took, by blueprint and method.")
+    for labels, series in sorted(latency.items()):
+        blueprint, method = labels
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, series):
+            cumulative += count
+            bucket_labels = format_labels(("blueprint", "method", "le"),
+                                          (blueprint, method, format_number(float(bound))))
+            lines.append(f"rpg_http_request_duration_seconds_bucket{bucket_labels} {cumulative}")
+        series_labels = format_labels(("blueprint", "method"), labels)
+        lines.append(f"rpg_http_request_duration_seconds_sum{series_labels} "
+                     f"{format_number(float(series[-1]))}")
+        lines.append(f"rpg_http_request_duration_seconds_count{series_labels} {cumulative}")
+
+    for name, description in (("size", "Connections each pool keeps open."),
+                              ("checked_out", "Connections in use."),
+                              ("checked_in", "Idle connections."),
+                              ("overflow", "Connections open beyond the pool size.")):
+        engines = [engine for engine in sorted(gauges) if name in gauges[engine]]
+        if engines:
+            metric(f"rpg_db_pool_{name}", "gauge", description)
+        for engine in engines:
+            lines.append(f"rpg_db_pool_{name}{format_labels(('engine',), (engine,))} "
+                         f"{gauges[engine][name]}")
+    metric("rpg_db_pool_checkouts_total", "counter", "Connections taken from the pool.")
+    for engine, pool in sorted(pool_counters.items()):
+        lines.append(f"rpg_db_pool_checkouts_total{format_labels(('engine',), (engine,))} "
+                     f"{pool['checkouts']}")
+    metric("rpg_db_pool_timeouts_total", "counter", "Checkouts that timed out waiting for a connection.")
+    for engine, pool in sorted(pool_counters.items()):
+        lines.append(f"rpg_db_pool_timeouts_total{format_labels(('engine',), (engine,))} "
+                     f"{pool['timeouts']}")
+    metric("rpg_db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection.")
+    for engine, pool in sorted(pool_counters.items()):
+        lines.append(f"rpg_db_pool_wait_seconds_total{format_labels(('engine',), (engine,))} "
+                     f"{format_number(pool['wait_ms_total'] / 1000)}")
+
+    metric("rpg_cache_hits_total", "counter", "Response cache lookups that were hits.")
+    lines.append(f"rpg_cache_hits_total {counters['hits']}")
+    metric("rpg_cache_misses_total", "counter", "Response cache lookups that were misses.")
+    lines.append(f"rpg_cache_misses_total {counters['misses']}")
+    metric("rpg_cache_invalidated_tags_total", "counter", "Cache tags invalidated by writes.")
+    lines.append(f"rpg_cache_invalidated_tags_total {counters['invalidated_tags']}")
+    lookups = counters["hits"] + counters["misses"]
+    metric("rpg_cache_hit_ratio", "gauge", "Share of response cache lookups that were hits.")
+    lines.append(f"rpg_cache_hit_ratio {format_number(counters['hits'] / lookups if lookups else 0.0)}")
+
+    return "\n".join(lines) + "\n"
+
+
+# This returns the metrics of this worker, or of every worker when METRICS_DIR is set
+def metrics_text():
+    if current_app.config.get("METRICS_DIR"):
+        return render(metrics_files.read_all())
+    return render([worker_totals()])
+
+
+# This turns on the request counters for the app when METRICS is set
+def init_metrics(app):
+    if not app.config.get("METRICS"):
+        return
+    app.before_request(start_request_timer)
+    app.after_request(count_request)
@@ -0,0 +1,98 @@
+import base64
+import json
+
+from flask import abort, current_app, request
+
+# KEYSET (CURSOR) PAGINATION
+
+# These functions let the list endpoints return one page at a time.
+# Instead of OFFSET (which gets slower the deeper a client reads), each page
+# remembers the key of its last row in an opaque cursor and the next page
+# starts straight after it with a WHERE on the primary key.
+# To do this, the application:
+# - reads ?limit= and ?after= from the query string
+# - decodes the cursor back into key values
+# - filters for rows after those values, ordered by the key
+# - fetches one extra row to know whether there is another page
+# - returns the page along with the cursor for the next one
+
+# Used when the client pages without asking for a specific size
+DEFAULT_PAGE_LIMIT = 50
+# The biggest page a client can ask for
+MAX_PAGE_LIMIT = 500
+
+
+# This checks if the client asked for a page rather than the full list
+def is_paginated():
+    return "limit" in request.args or "after" in request.args
+
+
+# This turns the key values of a row into an opaque url-safe string
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+# This turns a cursor back into key values, rejecting anything malformed.
+# Each value must have the Python type of its column, so a string is never compared with an
+# integer key (which PostgreSQL would reject with a 500)
+def decode_cursor(cursor, columns):
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except ValueError:
+        abort(400, description="Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(columns):
+        abort(400, description="Invalid cursor")
+    for value, column in zip(values, columns):
+        if not is_column_value(value, column):
+            abort(400, description="Invalid cursor")
+    return values
+
+
+# This checks if a decoded value has the type of the column's values.
+# JSON true and false are bools, which Python also counts as ints
+def is_column_value(value, column):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        python_type = (int, str)
+    return isinstance(value, python_type) and not isinstance(value, bool)
+
+
+# This reads and checks the requested page size
+def get_limit():
+    default = current_app.config.get("PAGINATION_DEFAULT_LIMIT", DEFAULT_PAGE_LIMIT)
+    maximum = current_app.config.get("PAGINATION_MAX_LIMIT", MAX_PAGE_LIMIT)
+    limit = request.args.get("limit", default)
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400, description="limit must be a whole number")
+    if not 1 <= limit <= maximum:
+        abort(400, description=f"limit must be between 1 and {maximum}")
+    return limit
+
+
+# This returns a single page of the statement in the given sort order.
+# The cursor holds the values of the order's columns (the sort column, then the primary key)
+def paginate(stmt, order, serializer):
+    limit = get_limit()
+    after = request.args.get("after")
+
+    # Start after the last row of the previous page
+    if after:
+        values = decode_cursor(after, order.columns)
+        stmt = stmt.where(order.after(values))
+
+    # Fetch one extra row so we know if there is a next page
+    stmt = stmt.order_by(*order.clauses()).limit(limit + 1)
+    rows = serializer.rows(stmt).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(
+            getattr(rows[-1], column.key) for column in order.columns)
+
+    return {"data": serializer.dump(rows), "next_cursor": next_cursor}
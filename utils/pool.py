@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+# DATABASE CONNECTION POOL
+
+# These functions build the connection pool settings from environment variables
+# and keep track of how long requests wait for a connection.
+#
+# Environment variables (all optional):
+# - DB_POOL_SIZE: connections each worker keeps open (SQLAlchemy default 5)
+# - DB_MAX_OVERFLOW: extra connections a worker may open under load (default 10)
+# - DB_POOL_TIMEOUT: seconds to wait for a free connection before giving up (default 30)
+# - DB_POOL_RECYCLE: seconds before a connection is replaced (default 1800)
+# - DB_POOL_PRE_PING: test each connection before use, so stale ones after a failover
+#   are replaced instead of failing the request (default on)
+# - DB_STATEMENT_TIMEOUT: milliseconds before PostgreSQL cancels a statement (default none)
+#
+# Each worker can open up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections, so that
+# number times the number of workers should stay below PostgreSQL's max_connections.
+
+
+# This reads an on/off environment variable
+def env_flag(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+# This builds SQLALCHEMY_ENGINE_OPTIONS for the given database url
+def engine_options_from_env(database_uri):
+    options = {
+        "pool_pre_ping": env_flag("DB_POOL_PRE_PING", True),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+    }
+
+    # The sizing options only apply to a queue pool, which is what PostgreSQL uses.
+    # Other databases (ie SQLite while developing) keep their default pool.
+    if not database_uri or make_url(database_uri).get_backend_name() != "postgresql":
+        return options
+
+    options["poolclass"] = TimedQueuePool
+    for env_name, option in (("DB_POOL_SIZE", "pool_size"),
+                             ("DB_MAX_OVERFLOW", "max_overflow"),
+                             ("DB_POOL_TIMEOUT", "pool_timeout")):
+        if env_name in os.environ:
+            options[option] = int(os.environ[env_name])
+
+    statement_timeout = os.environ.get("DB_STATEMENT_TIMEOUT")
+    if statement_timeout:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={int(statement_timeout)}"}
+    return options
+
+
+# This keeps running totals of the connection checkouts of one pool
+class PoolStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, waited, timed_out=False):
+        with self.lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def snapshot(self):
+        with self.lock:
+            average = self.wait_total / self.checkouts if self.checkouts else 0.0
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_ms_total": round(self.wait_total * 1000, 3),
+                "wait_ms_avg": round(average * 1000, 3),
+                "wait_ms_max": round(self.wait_max * 1000, 3),
+            }
+
+
+# A queue pool that times how long each checkout waits for a free connection.
+# _do_get is where QueuePool waits, so timing it covers both the wait and any new connection.
+# Each pool keeps its own stats, so the primary's and the replica's are reported apart.
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    # Disposing an engine replaces its pool, which carries on with the same totals
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - start)
+        return connection
+
+
+# This returns the current state of an engine's pool along with its checkout timings.
+# Pools that aren't timed (ie SQLite's) report no checkouts.
+def pool_status(engine):
+    pool = engine.pool
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        })
+    stats = getattr(pool, "stats", None) or PoolStats()
+    status.update(stats.snapshot())
+    return status
+
+
+# This returns the status of each of the app's pools, by engine
+# ("primary", or the bind key, ie "replica")
+def pool_statuses(engines):
+    return {key or "primary": pool_status(engine) for key, engine in engines.items()}
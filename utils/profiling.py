@@ -0,0 +1,187 @@
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+# REQUEST PROFILING
+
+# These functions time every request and count its SQL statements, when PROFILING is on.
+# For each request the application records:
+# - db: how many statements it ran and how long they took
+# - serialize: how long dumping and encoding the response took
+# - total: how long the whole request took
+# The numbers are sent back in a Server-Timing header (browsers show them in their
+# network tools) and added to a histogram for each endpoint, at GET /diagnostics/requests.
+# A sample of requests (PROFILE_SAMPLE_RATE) also runs under cProfile, and the profiles of
+# those slower than PROFILE_SLOW_MS are saved in PROFILE_DIR, to open with pstats or snakeviz.
+# Streamed lists are timed up to the start of the stream.
+
+# The upper bounds (in milliseconds) of the histogram buckets
+HISTOGRAM_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf"))
+
+DEFAULT_PROFILE_SAMPLE_RATE = 0.0
+DEFAULT_PROFILE_SLOW_MS = 500
+DEFAULT_PROFILE_DIR = "profiles"
+
+
+# This keeps the timings of each endpoint for this worker
+class RequestStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, total_ms, queries, db_ms, serialize_ms):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    "count": 0, "total_ms": 0.0, "max_ms": 0.0, "queries": 0,
+                    "db_ms": 0.0, "serialize_ms": 0.0, "buckets": [0] * len(HISTOGRAM_BUCKETS)}
+            stats["count"] += 1
+            stats["total_ms"] += total_ms
+            stats["max_ms"] = max(stats["max_ms"], total_ms)
+            stats["queries"] += queries
+            stats["db_ms"] += db_ms
+            stats["serialize_ms"] += serialize_ms
+            for index, bound in enumerate(HISTOGRAM_BUCKETS):
+                if total_ms <= bound:
+                    stats["buckets"][index] += 1
+                    break
+
+    def snapshot(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, stats in self.endpoints.items():
+                count = stats["count"]
+                endpoints[endpoint] = {
+                    "count": count,
+                    "avg_ms": round(stats["total_ms"] / count, 3),
+                    "max_ms": round(stats["max_ms"], 3),
+                    "avg_queries": round(stats["queries"] / count, 2),
+                    "avg_db_ms": round(stats["db_ms"] / count, 3),
+                    "avg_serialize_ms": round(stats["serialize_ms"] / count, 3),
+                    # Each bucket counts the requests that took at most that long, but longer than the one before
+                    "histogram": {("+Inf" if bound == float("inf") else str(bound)): number
+                                  for bound, number in zip(HISTOGRAM_BUCKETS, stats["buckets"])},
+                }
+            return endpoints
+
+
+request_stats = RequestStats()
+
+
+# This returns the current request's timings, or None if it isn't being timed
+def current_timing():
+    if not has_request_context():
+        return None
+    return g.get("timing")
+
+
+# This adds the time spent in the block to the current request's timing of that name
+@contextmanager
+def timed(name):
+    timing = current_timing()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing[name] = timing.get(name, 0.0) + time.perf_counter() - start
+
+
+# These engine events count and time the statements of the current request (on every engine,
+# ie the replica too). The start time is kept on the connection, which one thread uses at a time.
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_timing() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timing = current_timing()
+    starts = conn.info.get("query_start")
+    if timing is None or not starts:
+        return
+    timing["queries"] += 1
+    timing["db"] += time.perf_counter() - starts.pop()
+
+
+# This starts timing the request, and profiles a sample of requests
+def start_timing():
+    g.timing = {"start": time.perf_counter(), "queries": 0, "db": 0.0, "serialize": 0.0}
+    rate = current_app.config.get("PROFILE_SAMPLE_RATE", DEFAULT_PROFILE_SAMPLE_RATE)
+    if rate > 0 and random.random() < rate:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running in this thread
+            return
+        g.profiler = profiler
+
+
+# This records the request's timings and adds the Server-Timing header
+def finish_timing(response):
+    timing = g.pop("timing", None)
+    if timing is None:
+        return response
+    total = time.perf_counter() - timing["start"]
+    endpoint = request.endpoint or "unmatched"
+    request_stats.record(endpoint, total * 1000, timing["queries"],
+                         timing["db"] * 1000, timing["serialize"] * 1000)
+
+    response.headers.add("Server-Timing", ", ".join([
+        f'db;dur={timing["db"] * 1000:.2f};desc="{timing["queries"]} queries"',
+        f'serialize;dur={timing["serialize"] * 1000:.2f}',
+        f"total;dur={total * 1000:.2f}",
+    ]))
+
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        if total * 1000 >= current_app.config.get("PROFILE_SLOW_MS", DEFAULT_PROFILE_SLOW_MS):
+            save_profile(profiler, endpoint, total)
+    return response
+
+
+# This saves a profile as <PROFILE_DIR>/<time>-<endpoint>-<ms>ms.prof
+def save_profile(profiler, endpoint, total):
+    directory = current_app.config.get("PROFILE_DIR", DEFAULT_PROFILE_DIR)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{total * 1000:.0f}ms.prof"
+        profiler.dump_stats(os.path.join(directory, name))
+    except OSError as err:
+        log.warning("Could not save the profile of %s: %s", endpoint, err)
+
+
+# This turns on the timings for the app when PROFILING is set
+def init_profiling(app):
+    if not app.config.get("PROFILING"):
+        return
+
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+    app.before_request(start_timing)
+    app.after_request(finish_timing)
+
+    # Encoding the response into JSON counts as serialising it
+    json_response = app.json.response
+
+    def timed_json_response(*args, **kwargs):
+        with timed("serialize"):
+            return json_response(*args, **kwargs)
+
+    app.json.response = timed_json_response
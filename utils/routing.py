@@ -0,0 +1,124 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.exc import SQLAlchemyError
+
+# READ REPLICA ROUTING
+
+# This session sends the reads of GET requests to a read replica, when one is
+# configured with REPLICA_DATABASE_URI, and everything else to the primary.
+# A read goes to the primary instead when:
+# - the request isn't a GET (or HEAD), or isn't for one of the resource blueprints
+# - the session has already written something, so the read sees its own write
+# - the replica is further behind the primary than REPLICA_MAX_LAG seconds, or can't be reached
+# The choice is made once, on the session's first read, and kept in session.info for the
+# rest of the request. If the lag check changed its answer halfway through, a list's ETag
+# could come from the primary and its rows from a replica that is behind.
+
+# The blueprints whose GET routes can read from the replica
+REPLICA_BLUEPRINTS = {"campaigns", "characters", "game_masters",
+                      "played_games", "player_campaigns", "players"}
+
+# PostgreSQL reports the replica as caught up when it has replayed everything it
+# received, otherwise how long ago the last replayed transaction was committed
+REPLICA_LAG_SQL = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.reads_from_replica():
+            self.info["replica_reads"] = self.info.get("replica_reads", 0) + 1
+            return self._db.engines["replica"]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    # This decides if the current statement can go to the replica
+    def reads_from_replica(self):
+        if self._flushing or self.info.get("wrote") or self.info.get("primary_reads"):
+            return False
+        if "replica" not in self.info:
+            self.info["replica"] = self.can_use_replica()
+        return self.info["replica"]
+
+    # This decides if the request's reads can go to the replica
+    def can_use_replica(self):
+        if not has_request_context() or request.method not in ("GET", "HEAD"):
+            return False
+        if request.blueprint not in REPLICA_BLUEPRINTS:
+            return False
+        engine = self._db.engines.get("replica")
+        return engine is not None and replica_lag.is_fresh(engine)
+
+
+# This returns how many statements the session has sent to the replica, so a caller
+# can tell whether something it built came from the replica
+def replica_reads(session):
+    return session.info.get("replica_reads", 0)
+
+
+# This sends the session's reads inside the block to the primary, ie to fill the
+# response cache, which must never keep data a lagging replica returned
+@contextmanager
+def primary_reads(session):
+    previous = session.info.get("primary_reads", False)
+    session.info["primary_reads"] = True
+    try:
+        yield
+    finally:
+        session.info["primary_reads"] = previous
+
+
+# Any write marks the session, so the reads after it in the same session go to the primary
+@event.listens_for(RoutingSession, "after_flush")
+def mark_flush_as_write(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def mark_statement_as_write(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info["wrote"] = True
+
+
+# This checks the replica's lag, at most once every REPLICA_LAG_CHECK_INTERVAL seconds per worker
+class ReplicaLag:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked_at = {}
+        self.fresh = {}
+
+    def is_fresh(self, engine):
+        interval = current_app.config.get("REPLICA_LAG_CHECK_INTERVAL", 1.0)
+        now = time.monotonic()
+        with self.lock:
+            if now - self.checked_at.get(engine, float("-inf")) < interval:
+                return self.fresh[engine]
+            # Other threads keep using the last answer while this one checks
+            self.checked_at[engine] = now
+            self.fresh.setdefault(engine, False)
+
+        fresh = self.check(engine)
+        with self.lock:
+            self.fresh[engine] = fresh
+        return fresh
+
+    def check(self, engine):
+        # Only PostgreSQL replicas report their lag, anything else is trusted
+        if engine.dialect.name != "postgresql":
+            return True
+        max_lag = current_app.config.get("REPLICA_MAX_LAG", 5.0)
+        try:
+            with engine.connect() as connection:
+                lag = connection.execute(REPLICA_LAG_SQL).scalar()
+        except SQLAlchemyError:
+            # A replica that can't be reached falls back to the primary
+            return False
+        return lag is None or float(lag) <= max_lag
+
+
+replica_lag = ReplicaLag()
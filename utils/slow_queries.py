@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+# SLOW QUERY LOG
+
+# These functions record every statement that takes longer than SLOW_QUERY_MS, to find the
+# sequential scans behind slow lists and cascading deletes. For each one the application:
+# - keeps the statement, its bound parameters and the endpoint (or CLI command) that ran it
+# - runs EXPLAIN on it, on the same connection and in the same transaction, so the plan is
+#   the one that was used. It isn't ANALYZEd, so the statement isn't run a second time
+# - adds it to a ring buffer of the last SLOW_QUERY_LOG_SIZE slow statements
+# - saves the buffer to SLOW_QUERY_DIR, one file for each worker, which
+#   `flask db slowlog` reads (newest first)
+# SLOW_QUERY_MS is 0 by default, which turns the log off.
+
+DEFAULT_SLOW_QUERY_LOG_SIZE = 100
+DEFAULT_SLOW_QUERY_DIR = "slow_queries"
+
+# How each database explains a statement without running it
+EXPLAIN_PREFIXES = {
+    "postgresql": "EXPLAIN (ANALYZE off) ",
+    "sqlite": "EXPLAIN QUERY PLAN ",
+}
+
+# The statements that can be explained
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+class SlowQueryLog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threshold_ms = 0
+        self.explain = True
+        self.directory = DEFAULT_SLOW_QUERY_DIR
+        self.entries = deque(maxlen=DEFAULT_SLOW_QUERY_LOG_SIZE)
+        self.pid = None
+        self.name = None
+
+    def configure(self, threshold_ms, size, directory, explain):
+        with self.lock:
+            self.threshold_ms = threshold_ms
+            self.explain = explain
+            self.directory = directory
+            self.entries = deque(self.entries, maxlen=size)
+
+    def file_name(self):
+        # A worker forked from the process that made the app needs a file of its own
+        pid = os.getpid()
+        if pid != self.pid:
+            self.pid = pid
+            self.name = f"slow-{pid}-{uuid.uuid4().hex[:8]}.json"
+        return self.name
+
+    # Slow statements are rare, so the whole buffer is saved each time one is added
+    def add(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+            entries = list(self.entries)
+            path = os.path.join(self.directory, self.file_name())
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                # Written to a temporary file first, so the CLI never reads half a file
+                with open(f"{path}.tmp", "w") as file:
+                    json.dump(entries, file, default=str)
+                os.replace(f"{path}.tmp", path)
+            except OSError as err:
+                log.warning("Could not save the slow query log to %s: %s", path, err)
+
+
+slow_query_log = SlowQueryLog()
+
+
+# These engine events time each statement. The start time is kept on the connection,
+# which one thread uses at a time.
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    if slow_query_log.threshold_ms > 0:
+        conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+
+def check_statement_time(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("slow_query_start")
+    if not starts:
+        return
+    elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+    if elapsed_ms < slow_query_log.threshold_ms:
+        return
+
+    entry = {
+        "time": datetime.now().isoformat(sep=" ", timespec="milliseconds"),
+        "ms": round(elapsed_ms, 3),
+        "endpoint": request.endpoint if has_request_context() else "cli",
+        "request": f"{request.method} {request.full_path.rstrip('?')}" if has_request_context() else None,
+        "statement": statement,
+        "parameters": parameters,
+    }
+    if slow_query_log.explain and not executemany:
+        entry["plan"] = explain(conn, statement, parameters)
+    slow_query_log.add(entry)
+
+
+# This returns the plan of a statement as a list of lines, or the reason there isn't one.
+# On PostgreSQL a failed EXPLAIN would abort the transaction, so it runs inside a savepoint.
+def explain(conn, statement, parameters):
+    prefix = EXPLAIN_PREFIXES.get(conn.dialect.name)
+    if prefix is None:
+        return [f"EXPLAIN isn't supported on {conn.dialect.name}"]
+    if not statement.lstrip().upper().startswith(EXPLAINABLE):
+        return ["Only SELECT, INSERT, UPDATE and DELETE statements are explained"]
+
+    postgresql = conn.dialect.name == "postgresql"
+    # A cursor of its own, so the statement's unread rows are left alone
+    cursor = conn.connection.cursor()
+    try:
+        if postgresql:
+            cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute(prefix + statement, parameters)
+            # PostgreSQL gives one line per row, SQLite's plan detail is the last column
+            plan = [str(row[-1]) for row in cursor.fetchall()]
+        except Exception as err:
+            if postgresql:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            plan = [f"EXPLAIN failed: {err}"]
+        if postgresql:
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+    except Exception as err:
+        plan = [f"EXPLAIN failed: {err}"]
+    finally:
+        cursor.close()
+    return plan
+
+
+# This returns the slow statements of every worker, newest first
+def read_slow_queries(directory):
+    entries = []
+    if not os.path.isdir(directory):
+        return entries
+    for name in os.listdir(directory):
+        if not (name.startswith("slow-") and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as file:
+                entries.extend(json.load(file))
+        except (OSError, ValueError) as err:
+            log.warning("Could not read the slow query log in %s: %s", name, err)
+    entries.sort(key=lambda entry: entry["time"], reverse=True)
+    return entries
+
+
+# This deletes the saved slow statements of every worker
+def clear_slow_queries(directory):
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.startswith("slow-") and name.endswith(".json"):
+            os.remove(os.path.join(directory, name))
+    with slow_query_log.lock:
+        slow_query_log.entries.clear()
+
+
+# This turns on the slow query log for the app when SLOW_QUERY_MS is set
+def init_slow_query_log(app):
+    slow_query_log.configure(
+        app.config.get("SLOW_QUERY_MS", 0),
+        app.config.get("SLOW_QUERY_LOG_SIZE", DEFAULT_SLOW_QUERY_LOG_SIZE),
+        app.config.get("SLOW_QUERY_DIR", DEFAULT_SLOW_QUERY_DIR),
+        app.config.get("SLOW_QUERY_EXPLAIN", True))
+    if slow_query_log.threshold_ms <= 0:
+        return
+    if not event.contains(Engine, "before_cursor_execute", start_statement_timer):
+        event.listen(Engine, "before_cursor_execute", start_statement_timer)
+        event.listen(Engine, "after_cursor_execute", check_statement_time)
@@ -0,0 +1,40 @@
+from flask import Response, current_app, request, stream_with_context
+
+# STREAMING (NDJSON) EXPORTS
+
+# These functions let the list endpoints stream a whole table without holding
+# it in memory. Rows are read from a server side cursor in batches, each row is
+# turned into one line of JSON and sent to the client straight away.
+# To do this, the application:
+# - checks if the client asked for a stream (?stream=1 or Accept: application/x-ndjson)
+# - orders the statement (by its key unless ?sort= says otherwise) so exports come out in a stable order
+# - reads the rows in batches with yield_per
+# - dumps and sends each row as its own line
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+# How many rows are read from the database cursor at a time
+DEFAULT_STREAM_BATCH_SIZE = 1000
+
+
+# This checks if the client asked for a streamed response
+def wants_stream():
+    if request.args.get("stream", "").lower() in ("1", "true", "yes"):
+        return True
+    best = request.accept_mimetypes.best_match(
+        ["application/json", NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+# This streams every row of the statement as newline delimited JSON
+def stream_rows(stmt, order, serializer):
+    batch_size = current_app.config.get(
+        "STREAM_BATCH_SIZE", DEFAULT_STREAM_BATCH_SIZE)
+    stmt = stmt.order_by(*order.clauses()).execution_options(yield_per=batch_size)
+
+    def generate():
+        dumps = current_app.json.dumps
+        for row in serializer.rows(stmt):
+            yield dumps(serializer.dump_one(row), separators=(",", ":")) + "\n"
+
+    # stream_with_context keeps the request (and its session) open until the last row is sent
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
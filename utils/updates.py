@@ -0,0 +1,45 @@
+from flask import request
+from sqlalchemy import inspect
+
+from init import db
+
+# SINGLE STATEMENT UPDATES
+
+# These functions let a PATCH change a row with one UPDATE ... RETURNING statement,
+# instead of loading the row, merging the fields in Python and having the ORM flush it.
+# The fast path is only taken when it gives the same result as the slower one:
+# - the request is a PATCH without If-Match (a client checking the version needs the row first)
+# - the body changes at least one field
+# Empty values are skipped, the same as the update routes keep the current value for them.
+# Primary keys and the version are never set from the body, so a row can't be re-keyed.
+
+
+# This picks the fields of a loaded request body that the update changes
+def changed_values(model, body_data):
+    mapper = inspect(model)
+    fixed = {column.key for column in mapper.primary_key}
+    if mapper.version_id_col is not None:
+        fixed.add(mapper.version_id_col.key)
+    return {key: value for key, value in body_data.items() if value and key not in fixed}
+
+
+# This checks if the update can be made without loading the row first
+def can_update_directly(values):
+    return request.method == "PATCH" and not request.if_match and bool(values)
+
+
+# This updates the row with the given primary key and returns it,
+# or None if there is no such row
+def update_returning(model, ident, values):
+    mapper = inspect(model)
+    idents = ident if isinstance(ident, tuple) else (ident,)
+    values = dict(values)
+    # Versioned rows move to their next version, the same as an ORM update
+    if mapper.version_id_col is not None:
+        values[mapper.version_id_col.key] = mapper.version_id_col + 1
+
+    stmt = db.update(model).where(
+        *[column == value for column, value in zip(mapper.primary_key, idents)]
+    ).values(**values).returning(model)
+    return db.session.scalars(
+        stmt, execution_options={"synchronize_session": False}).one_or_none()
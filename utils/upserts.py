@@ -0,0 +1,61 @@
+from flask import abort
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql, sqlite
+
+from init import db
+
+# UPSERTS
+
+# These functions create a row, or use the one that already has the same unique key,
+# in a single INSERT ... ON CONFLICT ... RETURNING statement.
+# Unlike inserting and catching the UNIQUE violation, nothing fails, so the
+# transaction isn't aborted and the caller doesn't need a second request to find the row.
+
+# The databases whose INSERT supports ON CONFLICT
+UPSERT_DIALECTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+# This builds an INSERT with ON CONFLICT support for the database in use
+def upsert_insert(model):
+    dialect = db.session.get_bind().dialect.name
+    if dialect not in UPSERT_DIALECTS:
+        abort(501, description=f"Upserts are not supported on {dialect}")
+    return UPSERT_DIALECTS[dialect](model)
+
+
+# This inserts the row, or updates the row with the same conflict columns to the new values.
+# It returns the row and whether it was created.
+def upsert(model, values, conflict_columns):
+    mapper = inspect(model)
+    # The database picks the primary key of a new row, and an existing row keeps its own
+    keys = {column.key for column in mapper.primary_key} - set(conflict_columns)
+    values = {key: value for key, value in values.items() if key not in keys}
+    stmt = upsert_insert(model).values(**values)
+    changes = {key: stmt.excluded[key] for key in values if key not in conflict_columns}
+    # An update moves the row to its next version, so a new row is the only one on version 1
+    version_id_col = mapper.version_id_col
+    if version_id_col is not None:
+        changes[version_id_col.key] = version_id_col + 1
+
+    stmt = stmt.on_conflict_do_update(
+        index_elements=conflict_columns, set_=changes).returning(model)
+    entity = db.session.scalars(
+        stmt, execution_options={"populate_existing": True}).one()
+    created = version_id_col is not None and getattr(entity, version_id_col.key) == 1
+    return entity, created
+
+
+# This inserts the row unless one with the same conflict columns exists, leaving that row as it is.
+# It returns the row and whether it was created.
+def insert_or_get(model, values, conflict_columns):
+    stmt = upsert_insert(model).values(**values).on_conflict_do_nothing(
+        index_elements=conflict_columns).returning(model)
+    entity = db.session.scalars(stmt).one_or_none()
+    if entity is not None:
+        return entity, True
+    # Only an existing row needs the second statement
+    existing = db.select(model).filter_by(**{key: values[key] for key in conflict_columns})
+    return db.session.scalars(existing).one(), False
@@ -0,0 +1,61 @@
+import re
+
+from marshmallow import ValidationError, validate
+
+# SHARED VALIDATION RULES
+
+# Every text field in the schemas follows the same rule: a length limit, and only
+# letters, spaces, hyphens, apostrophes and ampersands.
+# This validator checks both in one call, with the same error messages (in the same
+# order) as the separate validate.Length and validate.Regexp validators it replaces.
+# Most values are short ASCII names, which are checked with str methods instead of the regex.
+
+LENGTH_ERROR = "This field must be between {min} and {max} characters."
+NAME_ERROR = "This field can only contain letters (A-Z, a-z), spaces, hyphens (-), apostrophes ('), and ampersands (&)."
+
+# The allowed characters. \s also matches non-ASCII whitespace, so the regex is kept for those values.
+NAME_PATTERN = re.compile(r"^[A-Za-z\s\-'&]+$")
+# The ASCII characters the regex allows, taken from the regex so the two can't disagree
+NAME_CHARACTERS = "".join(
+    character for character in map(chr, range(128)) if NAME_PATTERN.match(character))
+
+
+class ShortName(validate.Validator):
+    def __init__(self, min=1, max=100):
+        self.min = min
+        self.max = max
+        self.length_error = LENGTH_ERROR.format(min=min, max=max)
+
+    def _repr_args(self):
+        return f"min={self.min!r}, max={self.max!r}"
+
+    def __call__(self, value):
+        errors = []
+        if not self.min <= len(value) <= self.max:
+            errors.append(self.length_error)
+        if not is_name(value):
+            errors.append(NAME_ERROR)
+        if errors:
+            raise ValidationError(errors)
+        return value
+
+
+# This checks that a value only has the allowed characters.
+# For ASCII, stripping every allowed character leaves nothing, without running the regex.
+def is_name(value):
+    if value.isascii():
+        return bool(value) and not value.strip(NAME_CHARACTERS)
+    return NAME_PATTERN.match(value) is not None
+
+
+# The rule used by the schemas' text fields
+short_name = ShortName(min=1, max=100)
+
+
+# Emails are checked by fields.Email, so they only need the length limit of their column
+email_address = validate.Length(min=1, max=100, error=LENGTH_ERROR.format(min=1, max=100))
+
+# Phone numbers can have digits, spaces, hyphens, brackets and a leading +,
+# up to the 20 characters of their column
+PHONE_ERROR = "This field can only contain digits, spaces, hyphens (-), brackets and a leading plus (+), up to 20 characters."
+phone_number = validate.Regexp(r"^(?=.{1,20}\Z)\+?[0-9 ()\-]+\Z", error=PHONE_ERROR)